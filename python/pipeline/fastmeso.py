@@ -222,11 +222,12 @@ class ChunkWiseSegmentation(dj.Computed):
 
         # Read corrected scan
         print('Reading scan...')
-        scan = stack.RegistrationOverTime._get_corrected_scan(key)
-
-        # Find best chunk size (~ 10 minutes, last chunk may be slightly smaller than rest)
         p, d = (ChunkWiseMethod() & key).fetch1('pad', 'duration')
         overlap = int(round(p * 60 * fps)) # ~ 2 minutes
+        scan = stack.RegistrationOverTime._get_corrected_scan(key, overlap) # lazily
+        scan_min = scan.min() # corrected in parallel (only read if cached)
+
+        # Find best chunk size (~ 10 minutes, last chunk may be slightly smaller than rest)
         num_chunks = int(np.ceil((num_frames - overlap) / (d * 60 * fps - overlap)))
         chunk_size = int(np.ceil((num_frames - overlap) / num_chunks + overlap)) # *
         # * distributes frames in the last (incomplete) chunk to the other chunks
@@ -250,7 +251,7 @@ class ChunkWiseSegmentation(dj.Computed):
                 uuid.uuid4(), image_height, image_width, chunk.shape[-1])
             mmap_shape = (image_height * image_width, chunk.shape[-1])
             mmap_scan = np.memmap(filename, mode='w+', shape=mmap_shape, dtype=np.float32)
-            mmap_scan[:] = chunk.reshape(mmap_shape, order='F') - scan.min()
+            mmap_scan[:] = chunk.reshape(mmap_shape, order='F') - scan_min
             mmap_scan.flush()
 
             # Extract traces
@@ -3,10 +3,10 @@ import datajoint as dj
 from datajoint.jobs import key_hash
 import matplotlib.pyplot as plt
 import numpy as np
-import scanreader
 
 from . import experiment, notify, shared
 from .utils import galvo_corrections, signal, quality, mask_classification, performance
+from .utils import caching, demux, scan_index
 from .exceptions import PipelineException
 
 
@@ -101,7 +101,7 @@ class ScanInfo(dj.Imported):
         # Read the scan
         print('Reading header...')
         scan_filename = (experiment.Scan() & key).local_filenames_as_wildcard
-        scan = scanreader.read_scan(scan_filename)
+        scan = scan_index.read_scan(scan_filename)
 
         # Get attributes
         tuple_ = key.copy()  # in case key is reused somewhere else
@@ -206,7 +206,8 @@ class Quality(dj.Computed):
     def make(self, key):
         # Read the scan
         scan_filename = (experiment.Scan() & key).local_filenames_as_wildcard
-        scan = scanreader.read_scan(scan_filename)
+        scan = scan_index.read_scan(scan_filename)
+        scan = demux.demultiplexed(key, scan) # read each page once for all fields
 
         # Insert in Quality
         self.insert1(key)
@@ -219,19 +220,11 @@ class Quality(dj.Computed):
                                                  scan, field_id=field_id, channel=channel)
 
                 # Reduce
-                mean_intensities = np.zeros(scan.num_frames)
-                contrasts = np.zeros(scan.num_frames)
-                for frames, chunk_mis, chunk_contrasts, _ in results:
-                    mean_intensities[frames] = chunk_mis
-                    contrasts[frames] = chunk_contrasts
-                sorted_results = sorted(results, key=lambda res: res[0])
-                mean_groups = np.array_split([r[3] for r in sorted_results], 16) # 16 groups
-                frames = np.stack([np.mean(g, axis=0) for g in mean_groups if g.any()], axis=-1)
+                mean_intensities, contrasts, frames = performance.reduce_quality_metrics(
+                    results, scan.num_frames)
 
                 # Compute quantal size
-                middle_frame = int(np.floor(scan.num_frames / 2))
-                mini_scan = scan[field_id, :, :, channel, max(middle_frame - 2000, 0): middle_frame + 2000]
-                mini_scan = mini_scan.astype(np.float32)
+                mini_scan = caching.center_frames(key, scan, field_id, channel, 4000)
                 results = quality.compute_quantal_size(mini_scan)
                 min_intensity, max_intensity, _, _, quantal_size, zero_level = results
                 quantal_frame = (np.mean(mini_scan, axis=-1) - zero_level) / quantal_size
@@ -325,21 +318,31 @@ class RasterCorrection(dj.Computed):
     def key_source(self):
         return ScanInfo * CorrectionChannel & {'pipe_version': CURRENT_VERSION}
 
+    def delete(self, *args, **kwargs):
+        """ Delete rows and drop their corrected fields from the cache (utils.caching).
+
+        Only called when deleting from this table: deletes cascaded from upstream tables
+        skip it and rely on the fingerprint check of the cache (corrections changed).
+        """
+        keys = self.fetch('KEY')
+        super().delete(*args, **kwargs)
+        keys = [key for key in keys if not (self & key)] # user may cancel the delete
+        caching.invalidate(keys)
+
     def make(self, key):
         from scipy.signal import tukey
 
         # Read the scan
         scan_filename = (experiment.Scan() & key).local_filenames_as_wildcard
-        scan = scanreader.read_scan(scan_filename, dtype=np.float32)
+        scan = scan_index.read_scan(scan_filename, dtype=np.float32)
+        scan = demux.demultiplexed(key, scan)
 
         # Select correction channel
         channel = (CorrectionChannel() & key).fetch1('channel') - 1
         field_id = key['field'] -1
 
         # Load some frames from the middle of the scan
-        middle_frame = int(np.floor(scan.num_frames / 2))
-        frames = slice(max(middle_frame - 1000, 0), middle_frame + 1000)
-        mini_scan = scan[field_id, :, :, channel, frames]
+        mini_scan = caching.center_frames(key, scan, field_id, channel, 2000)
 
         # Create results tuple
         tuple_ = key.copy()
@@ -347,14 +350,17 @@ class RasterCorrection(dj.Computed):
         # Create template (average frame tapered to avoid edge artifacts)
         taper = np.sqrt(np.outer(tukey(scan.field_heights[field_id], 0.4),
                                  tukey(scan.field_widths[field_id], 0.4)))
-        anscombed = 2 * np.sqrt(mini_scan - mini_scan.min() + 3 / 8)  # anscombe transform
+        anscombed = mini_scan.astype(np.float32, copy=False)  # anscombe transform
+        anscombed -= anscombed.min() - 3 / 8  # (in place to avoid copies of mini_scan)
+        np.sqrt(anscombed, out=anscombed)
+        anscombed *= 2
         template = np.mean(anscombed, axis=-1) * taper
         tuple_['raster_template'] = template
 
         # Compute raster correction parameters
         if scan.is_bidirectional:
-            tuple_['raster_phase'] = galvo_corrections.compute_raster_phase(template,
-                                                                            scan.temporal_fill_fraction)
+            tuple_['raster_phase'] = galvo_corrections.compute_raster_phase_pyramid(
+                template, scan.temporal_fill_fraction)
         else:
             tuple_['raster_phase'] = 0
 
@@ -392,13 +398,25 @@ class MotionCorrection(dj.Computed):
     def key_source(self):
         return RasterCorrection() & {'pipe_version': CURRENT_VERSION}
 
+    def delete(self, *args, **kwargs):
+        """ Delete rows and drop their corrected fields from the cache (utils.caching).
+
+        Only called when deleting from this table: deletes cascaded from upstream tables
+        skip it and rely on the fingerprint check of the cache (corrections changed).
+        """
+        keys = self.fetch('KEY')
+        super().delete(*args, **kwargs)
+        keys = [key for key in keys if not (self & key)] # user may cancel the delete
+        caching.invalidate(keys)
+
     def make(self, key):
         """Computes the motion shifts per frame needed to correct the scan."""
         from scipy import ndimage
 
         # Read the scan
         scan_filename = (experiment.Scan() & key).local_filenames_as_wildcard
-        scan = scanreader.read_scan(scan_filename)
+        scan = scan_index.read_scan(scan_filename)
+        scan = demux.demultiplexed(key, scan)
 
         # Get some params
         px_height, px_width = (ScanInfo.Field() & key).fetch1('px_height', 'px_width')
@@ -408,17 +426,17 @@ class MotionCorrection(dj.Computed):
         # Load some frames from middle of scan to compute template
         skip_rows = int(round(px_height * 0.10)) # we discard some rows/cols to avoid edge artifacts
         skip_cols = int(round(px_width * 0.10))
-        middle_frame = int(np.floor(scan.num_frames / 2))
-        mini_scan = scan[field_id, skip_rows: -skip_rows, skip_cols: -skip_cols, channel,
-                         max(middle_frame - 1000, 0): middle_frame + 1000]
-        mini_scan = mini_scan.astype(np.float32, copy=False)
+        mini_scan = caching.center_frames(key, scan, field_id, channel, 2000)
+        mini_scan = mini_scan[skip_rows: -skip_rows, skip_cols: -skip_cols]
 
         # Correct mini scan
         correct_raster = (RasterCorrection() & key).get_correct_raster()
         mini_scan = correct_raster(mini_scan)
 
         # Create template
-        mini_scan = 2 * np.sqrt(mini_scan - mini_scan.min() + 3 / 8)  # *
+        mini_scan -= mini_scan.min() - 3 / 8  # * (in place)
+        np.sqrt(mini_scan, out=mini_scan)
+        mini_scan *= 2
         template = np.mean(mini_scan, axis=-1)
         template = ndimage.gaussian_filter(template, 0.7)  # **
         # * Anscombe tranform to normalize noise, increase contrast and decrease outliers' leverage
@@ -428,22 +446,22 @@ class MotionCorrection(dj.Computed):
         f = performance.parallel_motion_shifts # function to map
         raster_phase = (RasterCorrection() & key).fetch1('raster_phase')
         fill_fraction = (ScanInfo() & key).fetch1('fill_fraction')
+        max_y_shift, max_x_shift = 20 / (ScanInfo.Field() & key).microns_per_pixel
         kwargs = {'raster_phase': raster_phase, 'fill_fraction': fill_fraction,
-                  'template': template}
-        results = performance.map_frames(f, scan, field_id=field_id,
-                                         y=slice(skip_rows, -skip_rows),
-                                         x=slice(skip_cols, -skip_cols), channel=channel,
-                                         kwargs=kwargs)
-
-        # Reduce
-        y_shifts = np.zeros(scan.num_frames)
-        x_shifts = np.zeros(scan.num_frames)
-        for frames, chunk_y_shifts, chunk_x_shifts in results:
-            y_shifts[frames] = chunk_y_shifts
-            x_shifts[frames] = chunk_x_shifts
+                  'template': template, 'max_y_shift': max_y_shift,
+                  'max_x_shift': max_x_shift}
+        outputs = {'y_shifts': (scan.num_frames, float),
+                   'x_shifts': (scan.num_frames, float)} # written in place by workers
+        checkpoint_dir = performance.get_checkpoint_dir('meso.MotionCorrection',
+                                                        key_hash(key)) # resume if killed
+        _, outputs = performance.map_frames(f, scan, field_id=field_id,
+                                            y=slice(skip_rows, -skip_rows),
+                                            x=slice(skip_cols, -skip_cols), channel=channel,
+                                            kwargs=kwargs, outputs=outputs,
+                                            checkpoint_dir=checkpoint_dir)
+        y_shifts, x_shifts = outputs['y_shifts'], outputs['x_shifts']
 
         # Detect outliers
-        max_y_shift, max_x_shift = 20 / (ScanInfo.Field() & key).microns_per_pixel
         y_shifts, x_shifts, outliers = galvo_corrections.fix_outliers(y_shifts, x_shifts,
                                                                       max_y_shift, max_x_shift)
 
@@ -514,7 +532,7 @@ class MotionCorrection(dj.Computed):
 
         # Load the scan
         scan_filename = (experiment.Scan() & self).local_filenames_as_wildcard
-        scan = scanreader.read_scan(scan_filename, dtype=np.float32)
+        scan = scan_index.read_scan(scan_filename, dtype=np.float32)
         scan_ = scan[self.fetch1('field') - 1, :, :, channel - 1, start_index: stop_index]
         original_scan = scan_.copy()
 
@@ -602,10 +620,54 @@ class SummaryImages(dj.Computed):
         l6norm_image           : longblob
         """
 
+    class Statistic(dj.Part):
+        definition = """ # other summary statistics of each pixel (see config['performance.summary_statistics'])
+
+        -> master
+        statistic               : varchar(16)   # name in utils.performance.SUMMARY_STATISTICS, e.g., max, std, pnr
+        ---
+        statistic_image         : longblob
+        """
+
+    class ProxyMovie(dj.Part):
+        definition = """ # corrected field downsampled in space and time (for previews)
+
+        -> master
+        ---
+        proxy_movie             : longblob      # average of each 4 x 4 block of pixels and ~1 sec of frames (height x width x num_frames)
+        proxy_fps               : float         # (Hz) frames per second of the proxy movie
+        """
+
+        def save_video(self, filename='proxy_movie.gif', speedup=10, max_frames=300):
+            """ Save the proxy movie (played speedup times faster) as a gif or mp4.
+
+            :param string filename: Output filename (path + filename).
+            :param int speedup: How many seconds of the scan per second of video.
+            :param int max_frames: Maximum number of frames in the video; frames are
+                sampled evenly from the proxy movie if it is longer.
+
+            :returns: Filename of the video.
+            """
+            import imageio
+
+            proxy_movie, proxy_fps = self.fetch1('proxy_movie', 'proxy_fps')
+            frames = np.linspace(0, proxy_movie.shape[-1] - 1,
+                                 min(max_frames, proxy_movie.shape[-1])).astype(int)
+            proxy_movie = np.clip(proxy_movie[..., frames], None,
+                                  np.percentile(proxy_movie, 99.5))
+            video = signal.float2uint8(proxy_movie).transpose([2, 0, 1])
+            step = frames[1] - frames[0] if len(frames) > 1 else 1
+            imageio.mimsave(filename, video, duration=step / (proxy_fps * speedup))
+
+            return filename
+
     def make(self, key):
+        from . import config
+
         # Read the scan
         scan_filename = (experiment.Scan() & key).local_filenames_as_wildcard
-        scan = scanreader.read_scan(scan_filename)
+        scan = scan_index.read_scan(scan_filename)
+        scan = demux.demultiplexed(key, scan)
 
         for channel in range(scan.num_channels):
             # Map: Compute some statistics in different chunks of the scan
@@ -615,48 +677,67 @@ class SummaryImages(dj.Computed):
             y_shifts, x_shifts = (MotionCorrection() & key).fetch1('y_shifts', 'x_shifts')
             kwargs = {'raster_phase': raster_phase, 'fill_fraction': fill_fraction,
                       'y_shifts': y_shifts, 'x_shifts': x_shifts}
-            results = performance.map_frames(f, scan, field_id=key['field'] -1,
-                                             channel=channel, kwargs=kwargs)
-
-            # Reduce: Compute average images
-            average_image = np.sum([r[0] for r in results], axis=0) / scan.num_frames
-            l6norm_image = np.sum([r[1] for r in results], axis=0) ** (1 / 6)
-
-            # Reduce: Compute correlation image
-            sum_x = np.sum([r[2] for r in results], axis=0) # h x w
-            sum_sqx = np.sum([r[3] for r in results], axis=0) # h x w
-            sum_xy = np.sum([r[4] for r in results], axis=0) # h x w x 8
-            denom_factor = np.sqrt(scan.num_frames * sum_sqx - sum_x ** 2)
-            corrs = np.zeros(sum_xy.shape)
-            for k in [0, 1, 2, 3]:
-                rotated_corrs = np.rot90(corrs, k=k)
-                rotated_sum_x = np.rot90(sum_x, k=k)
-                rotated_dfactor = np.rot90(denom_factor, k=k)
-                rotated_sum_xy = np.rot90(sum_xy, k=k)
-
-                # Compute correlation
-                rotated_corrs[1:, :, k] = (scan.num_frames * rotated_sum_xy[1:, :, k] -
-                                           rotated_sum_x[1:] * rotated_sum_x[:-1]) / \
-                                          (rotated_dfactor[1:] * rotated_dfactor[:-1])
-                rotated_corrs[1:, 1:, 4 + k] = ((scan.num_frames * rotated_sum_xy[1:, 1:, 4 + k] -
-                                                 rotated_sum_x[1:, 1:] * rotated_sum_x[:-1, : -1]) /
-                                                (rotated_dfactor[1:, 1:] * rotated_dfactor[:-1, :-1]))
-
-                # Return back to original orientation
-                corrs = np.rot90(rotated_corrs, k=4 - k)
-
-            correlation_image = np.sum(corrs, axis=-1)
-            norm_factor = 5 * np.ones(correlation_image.shape) # edges
-            norm_factor[[0, -1, 0, -1], [0, -1, -1, 0]] = 3 # corners
-            norm_factor[1:-1, 1:-1] = 8 # center
-            correlation_image /= norm_factor
+            image_height, image_width = (ScanInfo.Field() & key).fetch1('px_height', 'px_width')
+            proxy_bin_size = max(1, int(round(scan.fps))) # ~1 Hz
+            num_proxy_frames = int(np.ceil(scan.num_frames / proxy_bin_size))
+            kwargs['proxy_bin_size'] = proxy_bin_size
+            other_statistics = [name for name in
+                                config.get('performance.summary_statistics', []) if name
+                                not in performance.DEFAULT_SUMMARY_STATISTICS]
+            statistics = performance.DEFAULT_SUMMARY_STATISTICS + other_statistics
+            kwargs['statistics'] = statistics
+            outputs = performance.summary_outputs(image_height, image_width,
+                                                  num_proxy_frames, statistics=statistics)
+            motion_key = (MotionCorrection() & key).fetch1('KEY')
+            field_scan, kwargs = caching.corrected_scan(motion_key, channel, scan,
+                                                        key['field'] - 1, kwargs)
+            kernels = {'summary': {'f': f, 'kwargs': kwargs, 'outputs': outputs}}
+
+            # Extract traces of segmentations over this field in the same pass
+            field_key = {**key, 'channel': channel + 1}
+            segmentation_keys = ((Segmentation() & field_key) - Fluorescence()).fetch('KEY')
+            corrections = {k: kwargs[k] for k in ['raster_phase', 'fill_fraction',
+                                                  'y_shifts', 'x_shifts']}
+            segmentation_masks = []
+            for i, segmentation_key in enumerate(segmentation_keys):
+                mask_ids, pixels, weights = (Segmentation.Mask() & segmentation_key).fetch(
+                    'mask_id', 'pixels', 'weights')
+                kernels['traces{}'.format(i)] = {
+                    'f': performance.parallel_fluorescence,
+                    'kwargs': {**corrections, 'mask_pixels': pixels, 'mask_weights': weights},
+                    'outputs': {'traces': ((len(mask_ids), scan.num_frames), np.float32)}}
+                segmentation_masks.append(mask_ids)
+            fused = performance.fuse_frames(kernels, field_scan, field_id=key['field'] - 1,
+                                            channel=channel)
+            _, outputs = fused['summary']
+
+            # Reduce: Compute average, l6-norm and correlation images
+            images = performance.reduce_summary_images(outputs, statistics)
+            average_image, l6norm_image, correlation_image = (images['mean'],
+                                                              images['l6norm'],
+                                                              images['correlation'])
+            proxy_movie = performance.reduce_proxy_movie(outputs['proxy'],
+                                                         scan.num_frames, proxy_bin_size)
 
             # Insert
-            field_key = {**key, 'channel': channel + 1}
             self.insert1(field_key)
             self.Average().insert1({**field_key, 'average_image': average_image})
             self.L6Norm().insert1({**field_key, 'l6norm_image': l6norm_image})
             self.Correlation().insert1({**field_key, 'correlation_image': correlation_image})
+            self.ProxyMovie().insert1({**field_key, 'proxy_movie': proxy_movie,
+                                       'proxy_fps': scan.fps / proxy_bin_size})
+            self.Statistic().insert([{**field_key, 'statistic': name,
+                                      'statistic_image': images[name]}
+                                     for name in other_statistics])
+            for i, segmentation_key in enumerate(segmentation_keys):
+                _, trace_outputs = fused['traces{}'.format(i)]
+                Fluorescence().insert1(segmentation_key, allow_direct_insert=True,
+                                       skip_duplicates=True)
+                Fluorescence.Trace().insert([{**segmentation_key, 'mask_id': mask_id,
+                                              'trace': trace} for mask_id, trace in
+                                             zip(segmentation_masks[i],
+                                                 trace_outputs['traces'])],
+                                            allow_direct_insert=True, skip_duplicates=True)
 
         self.notify(key, scan.num_channels)
 
@@ -686,6 +767,15 @@ class SummaryImages(dj.Computed):
         slack_user = notify.SlackUser() & (experiment.Session() & key)
         slack_user.notify(file=img_filename, file_title=msg, channel='#pipeline_quality')
 
+        # Send proxy movie
+        for channel in range(num_channels):
+            channel_key = {**key, 'channel': channel + 1}
+            video_filename = '/tmp/' + key_hash(channel_key) + '.gif'
+            (SummaryImages.ProxyMovie() & channel_key).save_video(video_filename)
+            msg = ('proxy movie for {animal_id}-{session}-{scan_idx} field {field} '
+                   'channel {channel}').format(**channel_key)
+            slack_user.notify(file=video_filename, file_title=msg)
+
 
 @schema
 class SegmentationTask(dj.Manual):
@@ -830,7 +920,8 @@ class Segmentation(dj.Computed):
             # Read scan
             print('Reading scan...')
             scan_filename = (experiment.Scan() & key).local_filenames_as_wildcard
-            scan = scanreader.read_scan(scan_filename)
+            scan = scan_index.read_scan(scan_filename)
+            scan = demux.demultiplexed(key, scan)
 
             # Create memory mapped file (as expected by CaImAn)
             print('Creating memory mapped file...')
@@ -846,6 +937,9 @@ class Segmentation(dj.Computed):
             y_shifts, x_shifts = (MotionCorrection() & key).fetch1('y_shifts', 'x_shifts')
             kwargs = {'raster_phase': raster_phase, 'fill_fraction': fill_fraction,
                       'y_shifts': y_shifts, 'x_shifts': x_shifts, 'mmap_scan': mmap_scan}
+            motion_key = (MotionCorrection() & key).fetch1('KEY')
+            scan, kwargs = caching.corrected_scan(motion_key, channel, scan, field_id,
+                                                  kwargs)
             results = performance.map_frames(f, scan, field_id=field_id, channel=channel,
                                              kwargs=kwargs)
 
@@ -961,7 +1055,7 @@ class Segmentation(dj.Computed):
             channel = self.fetch1('channel') - 1
             field_id = self.fetch1('field') - 1
             scan_filename = (experiment.Scan() & self).local_filenames_as_wildcard
-            scan = scanreader.read_scan(scan_filename, dtype=np.float32)
+            scan = scan_index.read_scan(scan_filename, dtype=np.float32)
             scan_ = scan[field_id, :, :, channel, start_index: stop_index]
 
             # Correct the scan
@@ -1170,7 +1264,8 @@ class Fluorescence(dj.Computed):
         field_id = key['field'] - 1
         channel = key['channel'] - 1
         scan_filename = (experiment.Scan() & key).local_filenames_as_wildcard
-        scan = scanreader.read_scan(scan_filename)
+        scan = scan_index.read_scan(scan_filename)
+        scan = demux.demultiplexed(key, scan)
 
         # Map: Extract traces
         print('Creating fluorescence traces...')
@@ -1181,12 +1276,14 @@ class Fluorescence(dj.Computed):
         mask_ids, pixels, weights = (Segmentation.Mask() & key).fetch('mask_id', 'pixels', 'weights')
         kwargs = {'raster_phase': raster_phase, 'fill_fraction': fill_fraction, 'y_shifts': y_shifts,
                   'x_shifts': x_shifts, 'mask_pixels': pixels, 'mask_weights': weights}
-        results = performance.map_frames(f, scan, field_id=field_id, channel=channel, kwargs=kwargs)
-
-        # Reduce: Concatenate
-        traces = np.zeros((len(mask_ids), scan.num_frames), dtype=np.float32)
-        for frames, chunk_traces in results:
-                traces[:, frames] = chunk_traces
+        motion_key = (MotionCorrection() & key).fetch1('KEY')
+        scan, kwargs = caching.corrected_scan(motion_key, channel, scan, field_id, kwargs)
+        outputs = {'traces': ((len(mask_ids), scan.num_frames), np.float32)}
+        checkpoint_dir = performance.get_checkpoint_dir('meso.Fluorescence', key_hash(key))
+        _, outputs = performance.map_frames(f, scan, field_id=field_id, channel=channel,
+                                            kwargs=kwargs, outputs=outputs,
+                                            checkpoint_dir=checkpoint_dir)
+        traces = outputs['traces'] # written in place by workers
 
         # Insert
         self.insert1(key)
@@ -13,7 +13,21 @@ validators = collections.defaultdict(lambda: lambda value: True)
 
 default = OrderedDict({
     'path.mounts': '/mnt/',
-    'display.tracking': False
+    'display.tracking': False,
+    'performance.memory_budget_in_GB': None, # None: use 80% of the (cgroup) memory limit
+    'performance.scratch_dir': '/tmp/pipeline_checkpoints', # checkpoints of map_frames jobs; node-local by default, set to shared storage to resume jobs on other nodes
+    'performance.stats_log': None, # file to log timing of map_frames/map_fields chunks
+    'performance.summary_statistics': [], # other statistics saved by SummaryImages, e.g., ['max', 'std', 'pnr']
+    'cache.corrected_scans_dir': None, # None: do not cache corrected fields
+    'cache.corrected_scans_size_in_GB': 500,
+    'cache.samples_dir': None, # None: do not cache center frames
+    'cache.samples_expiry_in_hours': 24,
+    'cache.samples_size_in_GB': 10,
+    'cache.demux_dir': None, # None: read fields of meso scans from the raw tiffs
+    'cache.scan_index_dir': None, # None: open scans with scanreader
+    'cache.staging_dir': None, # None: read scans directly from path.mounts
+    'cache.staging_size_in_GB': 1000,
+    'cache.archive_dir': None # None: do not look for archived scans (see utils.archive)
 })
 
 
@@ -3,7 +3,6 @@ import datajoint as dj
 from datajoint.jobs import key_hash
 import matplotlib.pyplot as plt
 import numpy as np
-import scanreader
 from scipy import signal
 from scipy import ndimage
 from scipy import optimize
@@ -12,7 +11,8 @@ import itertools
 from . import experiment, notify, shared, reso, meso
 anatomy = dj.create_virtual_module('pipeline_anatomy','pipeline_anatomy')
 
-from .utils import galvo_corrections, stitching, performance, enhancement
+from .utils import galvo_corrections, stitching, performance, enhancement, caching
+from .utils import scan_index
 from .utils.signal import mirrconv, float2uint8
 from .exceptions import PipelineException
 
@@ -143,7 +143,7 @@ class StackInfo(dj.Imported):
         for filename_key in filename_keys:
             stack_filename = (experiment.Stack.Filename() &
                               filename_key).local_filenames_as_wildcard
-            stacks.append(scanreader.read_scan(stack_filename))
+            stacks.append(scan_index.read_scan(stack_filename, use_index=False))
         num_rois_per_file = [(s.num_rois if s.is_multiROI else 1) for s in stacks]
 
         # Create Stack tuple
@@ -216,7 +216,7 @@ class Quality(dj.Computed):
             # Load ROI
             roi_filename = (experiment.Stack.Filename() &
                             roi_tuple).local_filenames_as_wildcard
-            roi = scanreader.read_scan(roi_filename)
+            roi = scan_index.read_scan(roi_filename, use_index=False)
 
             for channel in range((StackInfo() & key).fetch1('nchannels')):
                 # Map: Compute quality metrics in each field
@@ -319,7 +319,7 @@ class RasterCorrection(dj.Computed):
             # Read the ROI
             filename_rel = (experiment.Stack.Filename() & (StackInfo.ROI() & key))
             roi_filename = filename_rel.local_filenames_as_wildcard
-            roi = scanreader.read_scan(roi_filename)
+            roi = scan_index.read_scan(roi_filename, use_index=False)
 
             # Compute some parameters
             skip_fields = max(1, int(round(len(field_ids) * 0.10)))
@@ -398,7 +398,7 @@ class MotionCorrection(dj.Computed):
             # Read the ROI
             filename_rel = (experiment.Stack.Filename() & (StackInfo.ROI() & key))
             roi_filename = filename_rel.local_filenames_as_wildcard
-            roi = scanreader.read_scan(roi_filename)
+            roi = scan_index.read_scan(roi_filename, use_index=False)
 
             # Compute some params
             skip_rows = int(round(image_height * 0.10))
@@ -468,7 +468,7 @@ class MotionCorrection(dj.Computed):
 
         # Load ROI
         roi_filename = (experiment.Stack.Filename() & self).local_filenames_as_wildcard
-        roi = scanreader.read_scan(roi_filename)
+        roi = scan_index.read_scan(roi_filename, use_index=False)
 
         # Map: Apply corrections to each field in parallel
         f = performance.parallel_correct_stack  # function to map
@@ -543,7 +543,7 @@ class Stitching(dj.Computed):
             # Load ROI
             roi_filename = (experiment.Stack.Filename() &
                             roi_tuple).local_filenames_as_wildcard
-            roi = scanreader.read_scan(roi_filename)
+            roi = scan_index.read_scan(roi_filename, use_index=False)
 
             # Map: Apply corrections to each field in parallel
             f = performance.parallel_correct_stack  # function to map
@@ -767,7 +767,7 @@ class CorrectedStack(dj.Computed):
                 # Load ROI
                 roi_filename = (experiment.Stack.Filename() &
                                 roi_tuple).local_filenames_as_wildcard
-                roi = scanreader.read_scan(roi_filename)
+                roi = scan_index.read_scan(roi_filename, use_index=False)
 
                 # Map: Apply corrections to each field in parallel
                 f = performance.parallel_correct_stack  # function to map
@@ -2002,7 +2002,9 @@ class RegistrationOverTime(dj.Computed):
                      'channel': key['scan_channel']}
         pipe = (reso if reso.ScanInfo & field_key else meso if meso.ScanInfo & field_key
         else None)
-        scan = RegistrationOverTime._get_corrected_scan(field_key)
+        fps = (pipe.ScanInfo & field_key).fetch1('fps')
+        overlap = int(round(3 * 60 * fps))  # ~ 3 minutes
+        scan = RegistrationOverTime._get_corrected_scan(field_key, overlap)
 
         # Get initial estimate of field depth from experimenters
         field_z = (pipe.ScanInfo.Field & field_key).fetch1('z')
@@ -2013,9 +2015,7 @@ class RegistrationOverTime(dj.Computed):
                 field_z, *z_limits))
 
         # Compute best chunk size: each lasts the same (~15 minutes)
-        fps = (pipe.ScanInfo & field_key).fetch1('fps')
         num_frames = scan.shape[-1]
-        overlap = int(round(3 * 60 * fps))  # ~ 3 minutes
         num_chunks = int(np.ceil((num_frames - overlap) / (15 * 60 * fps - overlap)))
         chunk_size = int(np.floor((num_frames - overlap) / num_chunks + overlap))  # *
         # * distributes frames in the last (incomplete) chunk to the other chunks
@@ -2279,31 +2279,13 @@ class RegistrationOverTime(dj.Computed):
                                            {'session': key['stack_session']})
         slack_user.notify(file=img_filename, file_title=msg)
 
-    def _get_corrected_scan(key):
-        # Read scan
-        scan_filename = (experiment.Scan & key).local_filenames_as_wildcard
-        scan = scanreader.read_scan(scan_filename)
+    def _get_corrected_scan(key, overlap=0):
+        """ Corrected field (read and corrected lazily, see utils.caching.CorrectedScan).
 
-        # Get some params
-        pipe = reso if (reso.ScanInfo() & key) else meso
-
-        # Map: Correct scan in parallel
-        f = performance.parallel_correct_scan  # function to map
-        raster_phase = (pipe.RasterCorrection & key).fetch1('raster_phase')
-        fill_fraction = (pipe.ScanInfo & key).fetch1('fill_fraction')
-        y_shifts, x_shifts = (pipe.MotionCorrection & key).fetch1('y_shifts', 'x_shifts')
-        kwargs = {'raster_phase': raster_phase, 'fill_fraction': fill_fraction,
-                  'y_shifts': y_shifts, 'x_shifts': x_shifts}
-        results = performance.map_frames(f, scan, field_id=key['field'] - 1,
-                                         channel=key['channel'] - 1, kwargs=kwargs)
-
-        # Reduce: Make a single array (height x width x num_frames)
-        height, width, _ = results[0][1].shape
-        corrected_scan = np.zeros([height, width, scan.num_frames], dtype=np.float32)
-        for frames, chunk in results:
-            corrected_scan[..., frames] = chunk
-
-        return corrected_scan
+        :param dict key: Key of the field with the channel to correct.
+        :param int overlap: Frames shared by consecutive chunks read from it.
+        """
+        return caching.get_corrected_scan(key, chunk_size=500, overlap=overlap)
 
     def session_plot(self):
         """ Create a registration plot for the session"""
@@ -0,0 +1,183 @@
+""" Compressed archive of raw scans.
+
+ScanImage writes uncompressed int16 pages; reading some frames (or a crop) of a field
+means reading whole pages of every field and channel. archive_scan() rewrites each field
+and channel of a scan as an HDF5 dataset chunked in frames x tiles and compressed
+losslessly (shuffle + gzip), so reads touch only the chunks they need. ArchivedScan
+reads these files with the same indexing as scanreader.
+
+Archived scans are found in config['cache.archive_dir'] (which mirrors the directories of
+the original files) and used by scan_index.read_scan() instead of the tiff files.
+"""
+import numpy as np
+import os
+import glob
+import pickle
+
+from . import scan_index
+from ..exceptions import PipelineException
+
+
+def archive_filename(wildcard):
+    """ Where the archive of the scan with these files goes (None if disabled)."""
+    from .. import config
+
+    archive_dir = config.get('cache.archive_dir')
+    if archive_dir is None:
+        return None
+    scan_dir, scan_name = os.path.split(os.path.abspath(os.path.expanduser(wildcard)))
+    scan_name = scan_name.replace('*', '').rsplit('.tif', 1)[0]
+    return os.path.join(archive_dir, scan_dir.lstrip(os.sep), scan_name + '.h5')
+
+
+def archive_scan(scan, filename, chunk_frames=64, tile_size=128, compression_level=4,
+                 original_filenames=None):
+    """ Save all fields and channels of the scan in a compressed HDF5 file.
+
+    :param Scan scan: Scan as returned by scanreader (read with its original dtype).
+    :param string filename: HDF5 file to create. Written to a temporary file first.
+    :param int chunk_frames: Number of frames per chunk.
+    :param int tile_size: Height and width of each chunk.
+    :param int compression_level: gzip compression level (0-9).
+    :param list original_filenames: Tiff files of the scan (used to read attributes
+        not saved in the archive). Defaults to scan.filenames.
+    """
+    import h5py
+
+    if original_filenames is None:
+        original_filenames = getattr(scan, 'filenames', [])
+
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    tmp_filename = filename + '.tmp'
+    with h5py.File(tmp_filename, 'w') as f:
+        # Save header
+        header = {}
+        for name in scan_index.HEADER_ATTRIBUTES:
+            try:
+                header[name] = getattr(scan, name)
+            except Exception: # not defined for this kind of scan
+                pass
+        f.attrs['header'] = np.void(pickle.dumps(header))
+        f.attrs['filenames'] = [str(name) for name in original_filenames]
+
+        # Save fields (a few chunks at a time)
+        num_frames = scan.num_frames
+        for field_id in range(scan.num_fields):
+            height, width = scan.field_heights[field_id], scan.field_widths[field_id]
+            for channel in range(scan.num_channels):
+                print('Archiving field', field_id + 1, 'channel', channel + 1)
+                chunks = (min(chunk_frames, num_frames), min(tile_size, height),
+                          min(tile_size, width))
+                dataset = f.create_dataset(_dataset_name(field_id, channel),
+                                           shape=(num_frames, height, width),
+                                           dtype=scan.dtype, chunks=chunks,
+                                           compression='gzip',
+                                           compression_opts=compression_level,
+                                           shuffle=True)
+                for start in range(0, num_frames, chunk_frames * 8):
+                    frames = slice(start, min(start + chunk_frames * 8, num_frames))
+                    block = scan[field_id, :, :, channel, frames]
+                    dataset[frames] = np.moveaxis(block, -1, 0)
+    os.replace(tmp_filename, filename)
+
+
+def convert(wildcard):
+    """ Archive the scan with these files in config['cache.archive_dir'].
+
+    Once archived, scan_index.read_scan() reads the archive rather than the tiff files.
+
+    :param string wildcard: Files of the scan, e.g., as returned by
+        experiment.Scan.local_filenames_as_wildcard.
+
+    :returns: Filename of the archive.
+    """
+    filename = archive_filename(wildcard)
+    if filename is None:
+        raise PipelineException("Set config['cache.archive_dir'] to archive scans.")
+    if not os.path.isfile(filename):
+        scan = scan_index.read_scan(wildcard) # maybe from the staging cache
+        original_filenames = sorted(glob.glob(os.path.expanduser(wildcard)))
+        archive_scan(scan, filename, original_filenames=original_filenames)
+
+    return filename
+
+
+def _dataset_name(field_id, channel):
+    return 'field{}/channel{}'.format(field_id + 1, channel + 1)
+
+
+class ArchivedScan:
+    """ Scan saved by archive_scan(). Indexed as a scanreader scan.
+
+    scan[field_id, y, x, channel, frames] returns a (height x width x num_frames) array
+    (field_id and channel should be integers); only the chunks with those frames and
+    pixels are read. Header attributes are the ones saved with the archive; others are
+    taken from the original scan (opened with scanreader if needed).
+
+    :param string filename: HDF5 file.
+    :param np.dtype dtype: Data type of returned arrays (as in scanreader.read_scan).
+    :param int cache_size_in_MB: Size of the HDF5 chunk cache.
+    """
+    def __init__(self, filename, dtype=np.int16, cache_size_in_MB=256):
+        import h5py
+
+        self.filename = filename
+        self.dtype = dtype
+        self.file = h5py.File(filename, 'r', rdcc_nbytes=cache_size_in_MB * 1024**2,
+                              rdcc_nslots=10007)
+        self.header_attributes = pickle.loads(self.file.attrs['header'].tobytes())
+        self.original_filenames = list(self.file.attrs['filenames'])
+        self._scan = None
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        header_attributes = self.__dict__.get('header_attributes', {})
+        if name in header_attributes:
+            return header_attributes[name]
+        return getattr(self._open_scan(), name)
+
+    def _open_scan(self):
+        """ Original scan (for attributes not saved in the archive)."""
+        if self._scan is None:
+            import scanreader
+            if not self.original_filenames:
+                raise PipelineException('Original files of {} are unknown'.format(
+                    self.filename))
+            self._scan = scanreader.read_scan(self.original_filenames, dtype=self.dtype)
+        return self._scan
+
+    def __getstate__(self):
+        return {'filename': self.filename, 'dtype': self.dtype}
+
+    def __setstate__(self, state):
+        self.__init__(state['filename'], state['dtype'])
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key, )
+        field_id, y, x, channel, frames = key + (slice(None), ) * (5 - len(key))
+        dataset = self.file[_dataset_name(field_id, channel)]
+
+        # Read only the chunks needed (h5py selections need increasing indices)
+        if _is_simple(frames):
+            frames_to_read, order = frames, None
+        else:
+            frame_ids = np.arange(dataset.shape[0])[frames]
+            frames_to_read, order = np.unique(frame_ids, return_inverse=True)
+        if _is_simple(y) and _is_simple(x):
+            chunk = dataset[frames_to_read, y, x]
+        else:
+            chunk = dataset[frames_to_read]
+            chunk = chunk[y, x] if chunk.ndim == 2 else chunk[:, y, x]
+        if order is not None:
+            chunk = chunk[order]
+
+        if not isinstance(frames, (int, np.integer)):
+            chunk = np.moveaxis(chunk, 0, -1) # frames last
+        return chunk.astype(self.dtype, copy=False)
+
+
+def _is_simple(index):
+    """ Whether index can be passed directly to h5py (integer or increasing slice)."""
+    return (isinstance(index, (int, np.integer)) or
+            (isinstance(index, slice) and (index.step or 1) > 0))
@@ -0,0 +1,586 @@
+""" On-disk cache of raster and motion corrected fields.
+
+Summary images, segmentation, fluorescence traces and registration over time all need
+the corrected field; rather than correcting the raw scan again in each of them, the
+corrected field is written once (as a float32 memory mapped file) and read by all.
+
+The cache is disabled unless config['cache.corrected_scans_dir'] is set. Its size on
+disk is bounded by config['cache.corrected_scans_size_in_GB']; least recently used
+fields are evicted first.
+
+Quality, RasterCorrection and MotionCorrection also read the same frames from the
+middle of the scan; if config['cache.samples_dir'] is set, center_frames() reads them
+once and keeps them (raw) there (see center_frames).
+
+Where only some frames are needed (or the cache is disabled), get_corrected_scan()
+returns a CorrectedScan: an array-like view of the field that reads and corrects frames
+as they are indexed.
+"""
+import numpy as np
+import os
+import json
+import time
+import uuid
+import hashlib
+import collections
+
+from . import performance
+
+
+def get_cache():
+    """ Returns the CorrectedScanCache set up in config (None if disabled)."""
+    from .. import config
+
+    directory = config.get('cache.corrected_scans_dir')
+    if directory is None:
+        return None
+    return CorrectedScanCache(directory, config.get('cache.corrected_scans_size_in_GB'))
+
+
+def fingerprint(raster_phase, fill_fraction, y_shifts, x_shifts):
+    """ Hash of the corrections applied to a field.
+
+    Cached fields are only reused if their corrections did not change (e.g., if
+    MotionCorrection was deleted and populated again).
+    """
+    md5 = hashlib.md5()
+    for value in [raster_phase, fill_fraction, y_shifts, x_shifts]:
+        md5.update(np.ascontiguousarray(value, dtype=np.float64).tobytes())
+    return md5.hexdigest()
+
+
+class CachedField:
+    """ Corrected field in the cache. Can be passed to performance.map_frames as a scan.
+
+    Frames are stored contiguously (num_frames x height x width) so chunks of frames
+    are sequential reads. Indexing follows scanreader, i.e., field[field_id, y, x,
+    channel, frames] returns a (height x width x num_frames) array; field_id and channel
+    are ignored (the file holds a single field and channel).
+
+    :param string filename: Memory mapped file.
+    :param tuple shape: (num_frames, height, width).
+    """
+    def __init__(self, filename, shape):
+        self.filename = filename
+        self.data = np.memmap(filename, dtype=np.float32, mode='r', shape=tuple(shape))
+        self.dtype = self.data.dtype
+        self.num_frames, self.image_height, self.image_width = self.data.shape
+
+    def __getitem__(self, key):
+        _, y, x, _, frames = key
+        chunk = self.data[frames, y, x]
+        if isinstance(frames, (int, np.integer)): # single frame
+            return chunk
+        return np.moveaxis(chunk, 0, -1) # frames last
+
+    def as_array(self):
+        """ Returns the (read-only) field as a (height x width x num_frames) array."""
+        return np.moveaxis(self.data, 0, -1)
+
+
+class CorrectedScanCache:
+    """ Directory with corrected fields. One data and one metadata file per field.
+
+    :param string directory: Where to save the fields. Created if needed.
+    :param float max_size_in_GB: Maximum size of the cache. None for no limit.
+    """
+    def __init__(self, directory, max_size_in_GB=None):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_size_in_GB = max_size_in_GB
+
+    def _filenames(self, key):
+        from datajoint.jobs import key_hash
+
+        name = os.path.join(self.directory, key_hash(key))
+        return name + '.dat', name + '.json'
+
+    def _entries(self):
+        """ Returns list of (metadata_filename, metadata) of all fields in the cache."""
+        entries = []
+        for filename in os.listdir(self.directory):
+            if filename.endswith('.json'):
+                filename = os.path.join(self.directory, filename)
+                try:
+                    with open(filename) as f:
+                        entries.append((filename, json.load(f)))
+                except (OSError, ValueError): # deleted or being written
+                    continue
+        return entries
+
+    def _remove(self, metadata_filename):
+        for filename in [metadata_filename, metadata_filename[:-len('.json')] + '.dat']:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+    def get(self, key, fingerprint):
+        """ Returns the cached field for this key or None if not cached (or outdated).
+
+        :param dict key: MotionCorrection key plus the channel of the field.
+        :param string fingerprint: Fingerprint of the corrections (see fingerprint()).
+        """
+        data_filename, metadata_filename = self._filenames(key)
+        try:
+            with open(metadata_filename) as f:
+                metadata = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if metadata['fingerprint'] != fingerprint or not os.path.isfile(data_filename):
+            self._remove(metadata_filename)
+            return None
+
+        os.utime(metadata_filename) # mark as recently used
+        return CachedField(data_filename, metadata['shape'])
+
+    def create(self, key, fingerprint, scan, field_id, channel, kwargs):
+        """ Correct the field and save it in the cache.
+
+        :param dict key: MotionCorrection key plus the channel of the field.
+        :param string fingerprint: Fingerprint of the corrections (see fingerprint()).
+        :param Scan scan: Scan as returned by scanreader.
+        :param int field_id, channel: Field and channel to correct. 0-based.
+        :param dict kwargs: raster_phase, fill_fraction, y_shifts and x_shifts.
+
+        :returns: CachedField.
+        """
+        data_filename, metadata_filename = self._filenames(key)
+
+        # Make space
+        image_height, image_width = scan[field_id, :, :, channel, 0].shape
+        shape = (scan.num_frames, image_height, image_width)
+        self.evict(np.prod(shape) * 4)
+
+        # Map: correct field and write it to a temporary file
+        print('Saving corrected field in cache...')
+        tmp_filename = '{}.{}.tmp'.format(data_filename, uuid.uuid4())
+        cached_field = np.memmap(tmp_filename, dtype=np.float32, mode='w+', shape=shape)
+        try:
+            performance.map_frames(performance.parallel_cache_field, scan,
+                                   field_id=field_id, channel=channel,
+                                   kwargs={**kwargs, 'cached_field': cached_field})
+            cached_field.flush()
+            del cached_field
+            os.replace(tmp_filename, data_filename)
+        except BaseException:
+            os.remove(tmp_filename)
+            raise
+
+        # Write metadata (once data is in place)
+        metadata = {'key': {k: str(v) for k, v in key.items()}, 'shape': shape,
+                    'fingerprint': fingerprint}
+        with open(metadata_filename + '.tmp', 'w') as f:
+            json.dump(metadata, f, default=int)
+        os.replace(metadata_filename + '.tmp', metadata_filename)
+
+        return CachedField(data_filename, shape)
+
+    def evict(self, num_bytes=0):
+        """ Delete least recently used fields until num_bytes more fit in the cache."""
+        if self.max_size_in_GB is None:
+            return
+
+        max_bytes = self.max_size_in_GB * 1024**3 - num_bytes
+        entries = sorted(self._entries(), key=lambda e: os.path.getmtime(e[0]))
+        sizes = [int(np.prod(metadata['shape'])) * 4 for _, metadata in entries]
+        total_bytes = sum(sizes)
+        for (metadata_filename, _), size in zip(entries, sizes):
+            if total_bytes <= max_bytes:
+                break
+            self._remove(metadata_filename)
+            total_bytes -= size
+
+    def invalidate(self, keys):
+        """ Delete fields matching any of these keys (e.g., of deleted MotionCorrection or
+        RasterCorrection rows)."""
+        keys = [{k: str(v) for k, v in key.items()} for key in keys]
+        for metadata_filename, metadata in self._entries():
+            if any(all(metadata['key'].get(k) == v for k, v in key.items())
+                   for key in keys):
+                self._remove(metadata_filename)
+
+
+def corrected_scan(key, channel, scan, field_id, kwargs):
+    """ Use the cached corrected field (if the cache is enabled) instead of the raw scan.
+
+    :param dict key: MotionCorrection key.
+    :param int channel: Channel to correct. 0-based.
+    :param Scan scan: Scan as returned by scanreader.
+    :param int field_id: Field to correct. 0-based.
+    :param dict kwargs: raster_phase, fill_fraction, y_shifts and x_shifts (and any other
+        kwargs for the parallel_* function).
+
+    :returns: (scan, kwargs) tuple. If the cache is enabled, scan is the cached
+        corrected field (created if needed) and corrections in kwargs are replaced by
+        no-ops so it is not corrected twice. Otherwise, scan and kwargs are unchanged.
+    """
+    cache = get_cache()
+    if cache is None:
+        return scan, kwargs
+
+    # Get cached field
+    cache_key = {**key, 'channel': channel + 1}
+    corrections = {k: kwargs[k] for k in ['raster_phase', 'fill_fraction', 'y_shifts',
+                                          'x_shifts']}
+    hash_ = fingerprint(**corrections)
+    field = cache.get(cache_key, hash_)
+    if field is None:
+        field = cache.create(cache_key, hash_, scan, field_id, channel, corrections)
+
+    # Skip corrections
+    num_frames = len(kwargs['y_shifts'])
+    kwargs = {**kwargs, 'raster_phase': 0, 'y_shifts': np.zeros(num_frames),
+              'x_shifts': np.zeros(num_frames)}
+
+    return field, kwargs
+
+
+class CorrectedScan:
+    """ Raster and motion corrected field; frames are read and corrected as needed.
+
+    Behaves like a (height x width x num_frames) float32 array: it can be sliced in y, x
+    and frames (e.g., scan[..., 100:200] or scan[:, :, 5]) and np.asarray(scan) returns
+    the whole corrected field. Frames are read and corrected in chunks of chunk_size
+    frames and the last cache_size chunks are kept in memory, so overlapping requests
+    are not corrected twice. If parallel, chunks missing for a request are corrected in
+    the worker pool (performance.imap_frames). It can also be indexed as a scanreader
+    scan (scan[field_id, y, x, channel, frames]; field_id and channel are ignored) and
+    passed to performance.map_frames with no corrections in kwargs.
+
+    :param Scan scan: Scan as returned by scanreader (or a CachedField).
+    :param int field_id, channel: Field and channel to correct. 0-based.
+    :param float raster_phase: Raster phase used for raster correction.
+    :param float fill_fraction: Fill fraction used for raster correction.
+    :param np.array y_shifts, x_shifts: Motion shifts per frame.
+    :param int chunk_size: Number of frames read and corrected at a time.
+    :param int cache_size: Number of corrected chunks kept in memory.
+    :param bool parallel: Whether to correct several chunks at a time in parallel.
+    """
+    def __init__(self, scan, field_id, channel, raster_phase, fill_fraction, y_shifts,
+                 x_shifts, chunk_size=200, cache_size=5, parallel=False):
+        self.scan = scan
+        self.field_id = field_id
+        self.channel = channel
+        self.raster_phase = raster_phase
+        self.fill_fraction = fill_fraction
+        self.y_shifts = y_shifts
+        self.x_shifts = x_shifts
+        self.chunk_size = chunk_size
+        self.cache_size = cache_size
+        self.parallel = parallel
+
+        height, width = scan[field_id, :, :, channel, 0].shape
+        self.num_frames = len(y_shifts)
+        self.shape = (height, width, self.num_frames)
+        self.ndim = 3
+        self.dtype = np.dtype(np.float32)
+        self._chunks = collections.OrderedDict() # chunk_id: corrected chunk (LRU order)
+        self._range = None # (min, max) of the corrected field, once computed
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        field = self[:, :, :]
+        return field if dtype is None else field.astype(dtype, copy=False)
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key, )
+        if len(key) == 5: # scanreader indexing
+            _, y, x, _, frames = key
+            key = (y, x, frames)
+        ellipsis = [i for i, k in enumerate(key) if k is Ellipsis]
+        if ellipsis:
+            i = ellipsis[0]
+            key = key[:i] + (slice(None), ) * (4 - len(key)) + key[i + 1:]
+        y, x, frames = key + (slice(None), ) * (3 - len(key))
+
+        # Get corrected chunks
+        frame_ids = np.arange(self.num_frames)[frames]
+        chunks = self._get_chunks(np.unique(frame_ids // self.chunk_size))
+        if np.ndim(frame_ids) == 0: # single frame
+            chunk_id, frame = divmod(int(frame_ids), self.chunk_size)
+            return chunks[chunk_id][y, x, frame]
+
+        # Gather frames (in the order requested)
+        chunk_ids = frame_ids // self.chunk_size
+        splits = np.flatnonzero(np.diff(chunk_ids)) + 1
+        pieces = [chunks[ids[0] // self.chunk_size][y, x][..., ids % self.chunk_size]
+                  for ids in np.split(frame_ids, splits) if len(ids) > 0]
+        if not pieces: # no frames requested
+            return np.zeros(self[y, x, 0].shape + (0, ), dtype=self.dtype)
+        return pieces[0] if len(pieces) == 1 else np.concatenate(pieces, axis=-1)
+
+    def _get_chunks(self, chunk_ids):
+        """ Returns a dictionary with the corrected chunks (chunk_id: chunk)."""
+        chunks = {}
+        for chunk_id in chunk_ids:
+            if chunk_id in self._chunks:
+                self._chunks.move_to_end(chunk_id) # mark as recently used
+                chunks[chunk_id] = self._chunks[chunk_id]
+
+        # Read and correct missing chunks
+        missing = [chunk_id for chunk_id in chunk_ids if chunk_id not in chunks]
+        if self.parallel and len(missing) > 1:
+            corrected = self._correct_chunks_in_parallel(missing)
+        else:
+            corrected = ((chunk_id, self._correct_chunk(chunk_id)) for chunk_id in missing)
+        for chunk_id, chunk in corrected:
+            chunks[chunk_id] = chunk
+
+            # Keep it in memory (drop least recently used chunks)
+            self._chunks[chunk_id] = chunk
+            if len(self._chunks) > self.cache_size:
+                self._chunks.popitem(last=False)
+
+        return chunks
+
+    def _frames(self, chunk_id):
+        return slice(chunk_id * self.chunk_size, min((chunk_id + 1) * self.chunk_size,
+                                                     self.num_frames))
+
+    def _correct_chunk(self, chunk_id):
+        """ Read and correct one chunk in this process."""
+        from .performance import _correct_field
+
+        frames = self._frames(chunk_id)
+        chunk = self.scan[self.field_id, :, :, self.channel, frames]
+        chunk = np.array(chunk, dtype=np.float32) # copy (corrected in place)
+        return _correct_field(chunk, self.raster_phase, self.fill_fraction,
+                              self.x_shifts[frames], self.y_shifts[frames])
+
+    def _correct_chunks_in_parallel(self, chunk_ids):
+        """ Correct chunks in the worker pool. Yields (chunk_id, chunk) tuples in order.
+
+        Each run of consecutive chunks is mapped with imap_frames using chunks of
+        chunk_size frames so each result is one of our chunks.
+        """
+        runs = np.split(chunk_ids, np.flatnonzero(np.diff(chunk_ids) != 1) + 1)
+        for run in runs:
+            start, stop = self._frames(run[0]).start, self._frames(run[-1]).stop
+            kwargs = {'raster_phase': self.raster_phase,
+                      'fill_fraction': self.fill_fraction,
+                      'y_shifts': self.y_shifts[start: stop],
+                      'x_shifts': self.x_shifts[start: stop]}
+            bytes_per_frame = np.prod(self.shape[:2]) * 4
+            results = performance.imap_frames(performance.parallel_correct_scan,
+                _FrameRange(self.scan, start, stop), self.field_id, self.channel,
+                kwargs=kwargs, chunk_size_in_GB=self.chunk_size * bytes_per_frame / 1024**3)
+            for frames, chunk in results:
+                yield (start + frames.start) // self.chunk_size, chunk
+
+    def _compute_range(self):
+        """ Minimum and maximum of the corrected field.
+
+        Computed in a single pass (cache_size chunks at a time so they are corrected in
+        parallel) and saved, so min() and max() do not correct the field twice.
+        """
+        if self._range is None:
+            num_chunks = int(np.ceil(self.num_frames / self.chunk_size))
+            min_, max_ = np.inf, -np.inf
+            for first_chunk in range(0, num_chunks, self.cache_size):
+                chunk_ids = list(range(first_chunk, min(first_chunk + self.cache_size,
+                                                        num_chunks)))
+                for chunk in self._get_chunks(chunk_ids).values():
+                    min_, max_ = min(min_, chunk.min()), max(max_, chunk.max())
+            self._range = (min_, max_)
+        return self._range
+
+    def min(self):
+        """ Minimum of the corrected field."""
+        return self._compute_range()[0]
+
+    def max(self):
+        """ Maximum of the corrected field."""
+        return self._compute_range()[1]
+
+
+class _FrameRange:
+    """ Frames [start, stop) of a scan. Indexed as a scanreader scan (for map_frames)."""
+    def __init__(self, scan, start, stop):
+        self.scan = scan
+        self.start = start
+        self.num_frames = stop - start
+
+    def __getitem__(self, key):
+        field_id, y, x, channel, frames = key
+        if isinstance(frames, slice):
+            frames = slice(self.start + frames.start, self.start + frames.stop)
+        else:
+            frames = self.start + frames
+        return self.scan[field_id, y, x, channel, frames]
+
+
+def get_corrected_scan(key, chunk_size=200, cache_size=5, overlap=0):
+    """ Lazily corrected field (CorrectedScan) of a MotionCorrection key.
+
+    If the corrected scans cache is enabled, the field is corrected once (in parallel,
+    with map_frames) and saved in it if needed, and then only read from the cache.
+    Otherwise, frames are corrected as they are requested.
+
+    :param dict key: Key of a reso or meso MotionCorrection row. If key has a channel,
+        that channel is corrected; otherwise, the one in CorrectionChannel.
+    :param int chunk_size, cache_size: See CorrectedScan.
+    :param int overlap: Number of frames shared by consecutive requests (e.g., windows
+        that overlap). The cache is made big enough to keep them corrected.
+
+    :returns: CorrectedScan.
+    """
+    from .. import experiment, reso, meso
+    from . import demux, scan_index
+
+    # Get corrections
+    pipe = reso if (reso.ScanInfo() & key) else meso
+    motion_key = (pipe.MotionCorrection() & key).fetch1('KEY')
+    channel = key['channel'] if 'channel' in key else (pipe.CorrectionChannel() &
+                                                       key).fetch1('channel')
+    raster_phase = (pipe.RasterCorrection() & key).fetch1('raster_phase')
+    fill_fraction = (pipe.ScanInfo() & key).fetch1('fill_fraction')
+    y_shifts, x_shifts = (pipe.MotionCorrection() & key).fetch1('y_shifts', 'x_shifts')
+
+    cache_size = max(cache_size, int(np.ceil(overlap / chunk_size)) + 1)
+
+    # Use the corrected field if cached
+    cache = get_cache()
+    hash_ = fingerprint(raster_phase, fill_fraction, y_shifts, x_shifts)
+    cache_key = {**motion_key, 'channel': channel}
+    field = None if cache is None else cache.get(cache_key, hash_)
+    if field is None:
+        # Read the scan
+        scan_filename = (experiment.Scan() & key).local_filenames_as_wildcard
+        scan = scan_index.read_scan(scan_filename)
+        if pipe == meso:
+            scan = demux.demultiplexed(key, scan)
+
+        # Correct it (in parallel) and save it in the cache
+        if cache is not None:
+            corrections = {'raster_phase': raster_phase, 'fill_fraction': fill_fraction,
+                           'y_shifts': y_shifts, 'x_shifts': x_shifts}
+            field = cache.create(cache_key, hash_, scan, key['field'] - 1, channel - 1,
+                                 corrections)
+    if field is not None:
+        no_shifts = np.zeros(len(y_shifts))
+        return CorrectedScan(field, 0, 0, 0, fill_fraction, no_shifts, no_shifts,
+                             chunk_size, cache_size) # only read, no need to parallelize
+
+    return CorrectedScan(scan, key['field'] - 1, channel - 1, raster_phase, fill_fraction,
+                         y_shifts, x_shifts, chunk_size, cache_size, parallel=True)
+
+
+def invalidate(keys):
+    """ Delete cached fields of these (deleted) keys. No-op if the cache is disabled."""
+    cache = get_cache()
+    if cache is not None:
+        cache.invalidate(keys)
+
+
+def _center_slice(total_frames, num_frames):
+    """ Slice with num_frames frames around the middle of the scan (as used in Quality,
+    RasterCorrection and MotionCorrection)."""
+    middle_frame = int(np.floor(total_frames / 2))
+    return slice(max(middle_frame - num_frames // 2, 0),
+                 min(middle_frame + num_frames // 2, total_frames))
+
+
+def _purge_samples(directory, expiry_in_hours, max_size_in_GB, num_bytes=0):
+    """ Delete samples not used in the last expiry_in_hours and then least recently used
+    samples until num_bytes more fit in max_size_in_GB."""
+    entries = []
+    for filename in os.listdir(directory):
+        filename = os.path.join(directory, filename)
+        try:
+            entries.append((os.path.getmtime(filename), os.path.getsize(filename),
+                            filename))
+        except OSError: # deleted by another process
+            pass
+
+    min_mtime = time.time() - expiry_in_hours * 3600
+    max_bytes = max_size_in_GB * 1024**3 - num_bytes
+    total_bytes = sum(size for _, size, _ in entries)
+    for mtime, size, filename in sorted(entries):
+        if mtime >= min_mtime and total_bytes <= max_bytes:
+            break
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+        total_bytes -= size
+
+
+def _find_sample(directory, name, frames):
+    """ Filename and frames of a saved sample that contains frames (None if none)."""
+    for filename in os.listdir(directory):
+        if filename.startswith(name + '_') and filename.endswith('.npy'):
+            try:
+                start, stop = map(int, filename[len(name) + 1: -len('.npy')].split('-'))
+            except ValueError: # temporary file
+                continue
+            if start <= frames.start and frames.stop <= stop:
+                return os.path.join(directory, filename), slice(start, stop)
+    return None, None
+
+
+def center_frames(key, scan, field_id, channel, num_frames=2000):
+    """ Frames from the middle of the scan, read once per field and channel.
+
+    If config['cache.samples_dir'] is set (disabled by default), the frames are saved
+    there the first time they are requested and later requests for the same (or fewer)
+    frames are served from there. Samples are kept for
+    config['cache.samples_expiry_in_hours'] and least recently used samples are deleted
+    once they take more than config['cache.samples_size_in_GB']. Results are the same as
+    reading scan[field_id, :, :, channel, middle - num_frames // 2: middle +
+    num_frames // 2] directly.
+
+    :param dict key: Key of the scan (animal_id, session, scan_idx).
+    :param Scan scan: Scan as returned by scanreader.
+    :param int field_id, channel: Field and channel to read. 0-based.
+    :param int num_frames: Number of frames around the middle of the scan.
+
+    :returns: (height x width x num_frames) float32 array. A copy; it can be modified in
+        place.
+    """
+    from datajoint.jobs import key_hash
+    from .. import config
+
+    frames = _center_slice(scan.num_frames, num_frames)
+    directory = config.get('cache.samples_dir')
+    if directory is None:
+        return scan[field_id, :, :, channel, frames].astype(np.float32)
+    os.makedirs(directory, exist_ok=True)
+
+    # Get cached sample with these frames
+    sample_key = {'animal_id': key['animal_id'], 'session': key['session'],
+                  'scan_idx': key['scan_idx'], 'field': field_id + 1,
+                  'channel': channel + 1, 'num_frames': scan.num_frames} # scan may grow
+    name = key_hash(sample_key)
+    filename, sample_frames = _find_sample(directory, name, frames)
+    if filename is not None:
+        try:
+            sample = np.load(filename, mmap_mode='r')
+            os.utime(filename) # mark as recently used
+            start = frames.start - sample_frames.start
+            return np.array(sample[:, :, start: start + frames.stop - frames.start],
+                            dtype=np.float32)
+        except (OSError, ValueError): # evicted by another process
+            pass
+
+    # Read only the requested frames and save them (if they fit)
+    sample = scan[field_id, :, :, channel, frames]
+    max_size_in_GB = config.get('cache.samples_size_in_GB', 10)
+    if sample.nbytes <= max_size_in_GB * 1024**3:
+        for old_filename in os.listdir(directory): # smaller samples of this field
+            if old_filename.startswith(name + '_') and '.tmp' not in old_filename:
+                try:
+                    os.remove(os.path.join(directory, old_filename))
+                except OSError:
+                    pass
+        _purge_samples(directory, config.get('cache.samples_expiry_in_hours', 24),
+                       max_size_in_GB, sample.nbytes)
+        filename = os.path.join(directory, '{}_{}-{}.npy'.format(name, frames.start,
+                                                                frames.stop))
+        tmp_filename = '{}.{}.tmp.npy'.format(filename[:-len('.npy')], uuid.uuid4())
+        np.save(tmp_filename, sample)
+        os.replace(tmp_filename, filename)
+
+    return sample.astype(np.float32)
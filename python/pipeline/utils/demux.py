@@ -0,0 +1,239 @@
+""" Single pass demultiplexing of mesoscope (multiROI) scans.
+
+Each page of a multiROI ScanImage tiff holds (stacked vertically) the strips of all ROIs
+imaged at one depth; fields are assembled from one or more of these strips. Rather than
+having every field job parse all pages of the scan to extract its own strip,
+demultiplex() reads each page once and writes every field and channel to its own local
+file (frames stored contiguously). DemuxedScan reads these files and can be used in
+place of the scan (e.g., passed to performance.map_frames).
+
+Demultiplexing is disabled unless config['cache.demux_dir'] is set. Demultiplexed scans
+are keyed by the scan key and the name, size and modification time of its files (as the
+scan index, see utils.scan_index), so they are created again if the files change.
+"""
+import numpy as np
+import os
+import json
+import time
+import uuid
+import shutil
+
+from ..exceptions import PipelineException
+
+
+def demultiplex(filenames, fields, num_frames, num_channels, num_slices,
+                num_flyback_frames=0, directory='.'):
+    """ Read all pages of the scan once and save each field and channel separately.
+
+    Pages are ordered by channel, slice (plus fly back frames) and frame, i.e., page
+    p has channel p % num_channels, slice (p // num_channels) % (num_slices +
+    num_flyback_frames) and frame p // (num_channels * (num_slices + num_flyback_frames)).
+
+    :param list filenames: Tiff files of the scan (in order).
+    :param list fields: Layout of each field as in scanreader's multiROI scan.fields:
+        objects with slice_id (0-based), height, width and lists yslices, xslices
+        (where each ROI strip is in the page) and output_yslices, output_xslices (where
+        it goes in the field).
+    :param int num_frames: Number of frames in the scan. Pages after it are ignored.
+    :param int num_channels: Number of channels in the scan.
+    :param int num_slices: Number of scanning depths in the scan.
+    :param int num_flyback_frames: Number of fly back frames after the slices of each
+        volume.
+    :param string directory: Where to save the fields. Created if needed.
+
+    :returns: Dictionary with metadata of the demultiplexed scan (also saved as
+        metadata.json in the directory).
+    """
+    import tifffile
+
+    os.makedirs(directory, exist_ok=True)
+    pages_per_frame = num_channels * (num_slices + num_flyback_frames)
+
+    fields_per_slice = [[(i, f) for i, f in enumerate(fields) if f.slice_id == slice_id]
+                        for slice_id in range(num_slices)]
+
+    # Copy the strips of each page to their fields
+    data = None # (field_id, channel): memmap; created once the page dtype is known
+    page_id = 0
+    for filename in filenames:
+        if page_id >= num_frames * pages_per_frame:
+            break
+        with tifffile.TiffFile(filename) as tif:
+            for page in tif.pages:
+                frame, page_in_frame = divmod(page_id, pages_per_frame)
+                slice_id, channel = divmod(page_in_frame, num_channels)
+                if frame >= num_frames:
+                    break
+                page_id += 1
+                if slice_id >= num_slices: # fly back frame
+                    continue
+
+                page = page.asarray()
+                if data is None:
+                    dtype = page.dtype
+                    data = {}
+                    for i, field in enumerate(fields):
+                        for c in range(num_channels):
+                            filename_ = os.path.join(directory, _data_filename(i, c))
+                            data[(i, c)] = np.memmap(filename_, dtype=dtype, mode='w+',
+                                shape=(num_frames, field.height, field.width))
+                for field_id, field in fields_per_slice[slice_id]:
+                    field_data = data[(field_id, channel)]
+                    for ys, xs, out_ys, out_xs in zip(field.yslices, field.xslices,
+                                                      field.output_yslices,
+                                                      field.output_xslices):
+                        field_data[frame, out_ys, out_xs] = page[ys, xs]
+
+    if page_id < num_frames * pages_per_frame:
+        raise PipelineException('Scan has {} pages, expected {}'.format(page_id,
+            num_frames * pages_per_frame))
+    if data is None:
+        raise PipelineException('No pages to demultiplex (num_frames={}, '
+                                'num_slices={})'.format(num_frames, num_slices))
+    for field_data in data.values():
+        field_data.flush()
+    del data
+
+    # Save metadata
+    metadata = {'num_frames': num_frames, 'num_channels': num_channels,
+                'dtype': np.dtype(dtype).str,
+                'field_heights': [f.height for f in fields],
+                'field_widths': [f.width for f in fields]}
+    with open(os.path.join(directory, 'metadata.json'), 'w') as f:
+        json.dump(metadata, f)
+
+    return metadata
+
+
+def _data_filename(field_id, channel):
+    return 'field{}_channel{}.dat'.format(field_id + 1, channel + 1)
+
+
+class DemuxedScan:
+    """ Scan demultiplexed by demultiplex(). Can be passed to performance.map_frames.
+
+    Indexing follows scanreader, i.e., scan[field_id, y, x, channel, frames] returns a
+    (height x width x num_frames) array; field_id and channel should be integers. Other
+    attributes (fps, is_bidirectional, ...) are taken from the original scan.
+
+    :param string directory: Directory where the scan was demultiplexed.
+    :param Scan scan: Original scan as returned by scanreader (used for its header).
+    :param np.dtype dtype: Data type of returned chunks. Defaults to scan.dtype or to the
+        data type of the pages if no scan is given.
+    """
+    def __init__(self, directory, scan=None, dtype=None):
+        with open(os.path.join(directory, 'metadata.json')) as f:
+            metadata = json.load(f)
+        self.directory = directory
+        self.scan = scan
+        self.num_frames = metadata['num_frames']
+        self.num_channels = metadata['num_channels']
+        self.num_fields = len(metadata['field_heights'])
+        self.field_heights = metadata['field_heights']
+        self.field_widths = metadata['field_widths']
+        if dtype is None:
+            dtype = metadata['dtype'] if scan is None else scan.dtype
+        self.dtype = np.dtype(dtype)
+
+        self._data = {}
+        for field_id, (height, width) in enumerate(zip(self.field_heights,
+                                                       self.field_widths)):
+            for channel in range(self.num_channels):
+                filename = os.path.join(directory, _data_filename(field_id, channel))
+                self._data[(field_id, channel)] = np.memmap(filename,
+                    dtype=metadata['dtype'], mode='r',
+                    shape=(self.num_frames, height, width))
+
+    def __getattr__(self, name):
+        if name.startswith('_') or self.__dict__.get('scan') is None:
+            raise AttributeError(name)
+        return getattr(self.scan, name)
+
+    def __getitem__(self, key):
+        field_id, y, x, channel, frames = key
+        chunk = self._data[(field_id, channel)][frames, y, x]
+        if not isinstance(frames, (int, np.integer)):
+            chunk = np.moveaxis(chunk, 0, -1) # frames last
+        return np.array(chunk, dtype=self.dtype)
+
+
+def demultiplexed(key, scan):
+    """ Use the demultiplexed scan (if enabled) instead of the raw multiROI scan.
+
+    The scan is demultiplexed the first time it is requested (by any field) and saved in
+    config['cache.demux_dir']. Other jobs of the same scan wait for it to finish.
+
+    :param dict key: Key of the scan (animal_id, session, scan_idx).
+    :param Scan scan: Scan as returned by scanreader.
+
+    :returns: DemuxedScan or the original scan if demultiplexing is disabled or not
+        supported for this scan (frames averaged in the tiff files).
+    """
+    from datajoint.jobs import key_hash
+    from .. import config
+    from .scan_index import files_hash
+
+    demux_dir = config.get('cache.demux_dir')
+    if demux_dir is None:
+        return scan
+
+    if getattr(scan, '_num_averaged_frames', 1) != 1: # pages are not one per frame
+        print('Warning: Scan has averaged frames. Not demultiplexing it.')
+        return scan
+
+    scan_key = {'animal_id': key['animal_id'], 'session': key['session'],
+                'scan_idx': key['scan_idx']}
+    directory = os.path.join(demux_dir, '{}_{}'.format(key_hash(scan_key),
+                                                       files_hash(scan.filenames)))
+    while not os.path.isfile(os.path.join(directory, 'metadata.json')):
+        os.makedirs(demux_dir, exist_ok=True)
+        if _acquire_lock(directory + '.lock'):
+            try:
+                _demultiplex_scan(scan, directory)
+            finally:
+                os.remove(directory + '.lock')
+        else:
+            time.sleep(10) # being demultiplexed by another job
+
+    return DemuxedScan(directory, scan)
+
+
+def _acquire_lock(lock_filename, stale_after=600):
+    """ Create the lock file; False if it already exists. Locks not updated for
+    stale_after seconds (e.g., of killed jobs) are removed."""
+    try:
+        if time.time() - os.path.getmtime(lock_filename) > stale_after:
+            os.remove(lock_filename)
+    except OSError: # no lock (or removed by another job)
+        pass
+    try:
+        os.close(os.open(lock_filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        return True
+    except FileExistsError:
+        return False
+
+
+def _demultiplex_scan(scan, directory):
+    """ Demultiplex scan into directory (written to a temporary directory first)."""
+    import threading
+
+    print('Demultiplexing scan...')
+    tmp_directory = '{}.{}.tmp'.format(directory, uuid.uuid4())
+
+    # Keep the lock fresh while demultiplexing
+    done = threading.Event()
+    def touch_lock():
+        while not done.wait(60):
+            os.utime(directory + '.lock')
+    threading.Thread(target=touch_lock, daemon=True).start()
+
+    try:
+        demultiplex(scan.filenames, scan.fields, scan.num_frames, scan.num_channels,
+                    scan.num_scanning_depths, scan._num_fly_back_frames, tmp_directory)
+        shutil.rmtree(directory, ignore_errors=True)
+        os.replace(tmp_directory, directory)
+    except BaseException:
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+        raise
+    finally:
+        done.set()
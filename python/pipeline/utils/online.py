@@ -0,0 +1,333 @@
+""" Online (during acquisition) raster and motion correction of resonant scans.
+
+TiffTail follows the tiff files of a scan while ScanImage writes them and returns the
+new frames of one field and channel; OnlineMotionCorrection estimates the raster phase
+(from the first frames) and the motion shifts of each new frame against a running
+template.
+
+correct_online() runs both for a scan in experiment.Scan and saves the results in
+config['performance.scratch_dir']. Once the scan is complete (and ScanInfo has been
+populated), reso.RasterCorrection and reso.MotionCorrection use these results rather
+than reading the scan again; rows are otherwise created as usual.
+"""
+import numpy as np
+import os
+import glob
+import time
+
+from . import galvo_corrections
+from ..exceptions import PipelineException
+
+
+class TiffTail:
+    """ Follows the tiff files of a (non multiROI) ScanImage scan as they are written.
+
+    ScanImage writes one page per channel, per field (plus fly back frames) and per
+    frame, in that order, and starts a new file every few thousand pages. Pages are
+    read once they are complete: all pages in a file followed by a newer file or whose
+    size did not change since the previous poll, all but the last page otherwise.
+
+    :param string wildcard: Pattern of the tiff files, e.g., as returned by
+        experiment.Scan.local_filenames_as_wildcard. Files are read in sorted order.
+    :param int num_fields: Number of fields (slices) in the scan.
+    :param int num_channels: Number of channels in the scan.
+    :param int field_id, channel: Field and channel to return. 0-based.
+    :param int num_flyback_frames: Number of fly back frames recorded after the fields
+        of each volume.
+    """
+    def __init__(self, wildcard, num_fields=1, num_channels=1, field_id=0, channel=0,
+                 num_flyback_frames=0):
+        self.wildcard = wildcard
+        self.pages_per_frame = (num_fields + num_flyback_frames) * num_channels
+        self.page_offset = field_id * num_channels + channel # page of field in a frame
+        self.num_pages = 0 # number of complete pages read (from all files)
+        self._read_pages = {} # filename: number of pages read from the file
+        self._sizes = {} # filename: size of the file in the previous poll
+
+    def read(self):
+        """ Read new complete pages.
+
+        :returns: New frames of the field and channel (height x width x num_frames) or
+            None if there are no new frames.
+        """
+        import logging
+        import tifffile
+        logging.getLogger('tifffile').setLevel(logging.CRITICAL) # logs pages being written
+
+        frames = []
+        filenames = sorted(glob.glob(self.wildcard))
+        for i, filename in enumerate(filenames):
+            size = os.path.getsize(filename)
+            is_complete = i < len(filenames) - 1 or size == self._sizes.get(filename)
+            self._sizes[filename] = size
+            try:
+                with tifffile.TiffFile(filename) as tif:
+                    num_pages = len(tif.pages) if is_complete else len(tif.pages) - 1
+                    for page in range(self._read_pages.get(filename, 0), num_pages):
+                        if self.num_pages % self.pages_per_frame == self.page_offset:
+                            frames.append(tif.pages[page].asarray())
+                        self.num_pages += 1
+                        self._read_pages[filename] = page + 1
+            except ValueError: # header still being written
+                break
+
+        return np.stack(frames, axis=-1) if frames else None
+
+    def follow(self, chunk_size=500, poll_interval=5, timeout=120):
+        """ Yield new frames as they are written.
+
+        :param int chunk_size: Minimum number of frames per chunk (except the last one).
+        :param float poll_interval: Seconds to wait between reads.
+        :param float timeout: Stop once no new pages have been written in this many
+            seconds (the scan is assumed complete).
+
+        :returns: Generator of (height x width x num_frames) arrays.
+        """
+        chunks, num_frames = [], 0
+        last_change = time.time()
+        while True:
+            num_pages = self.num_pages
+            new_frames = self.read()
+            if self.num_pages > num_pages or self._is_growing():
+                last_change = time.time()
+            if new_frames is not None:
+                chunks.append(new_frames)
+                num_frames += new_frames.shape[-1]
+
+            is_done = time.time() - last_change > timeout
+            if chunks and (num_frames >= chunk_size or is_done):
+                yield np.concatenate(chunks, axis=-1)
+                chunks, num_frames = [], 0
+            if is_done:
+                return
+            time.sleep(poll_interval)
+
+    def _is_growing(self):
+        """ Whether any file changed size (or was created) since the previous read."""
+        filenames = sorted(glob.glob(self.wildcard))
+        return any(os.path.getsize(f) != self._sizes.get(f) for f in filenames)
+
+
+class OnlineMotionCorrection:
+    """ Raster and motion correction of a field as its frames arrive.
+
+    The first num_template_frames frames are used to compute the raster phase (as in
+    reso.RasterCorrection) and the initial motion template (as in reso.MotionCorrection).
+    Afterwards, each new chunk is raster corrected and registered against the template
+    (see galvo_corrections.compute_motion_shifts_pyramid); the template is then updated
+    with the running average of the motion corrected frames.
+
+    :param float fill_fraction: Temporal fill fraction of the scan.
+    :param bool is_bidirectional: Whether the scan is bidirectional (needs raster
+        correction).
+    :param float max_y_shift/max_x_shift: Maximum shifts (in pixels) expected. None for
+        no limit.
+    :param int num_template_frames: Number of frames used to create the templates.
+    """
+    def __init__(self, fill_fraction, is_bidirectional=True, max_y_shift=None,
+                 max_x_shift=None, num_template_frames=1000):
+        self.fill_fraction = fill_fraction
+        self.is_bidirectional = is_bidirectional
+        self.max_y_shift = max_y_shift
+        self.max_x_shift = max_x_shift
+        self.num_template_frames = num_template_frames
+
+        self.raster_phase = None
+        self.raster_template = None
+        self.motion_template = None
+        self.y_shifts = []
+        self.x_shifts = []
+        self._pending = [] # frames received before the templates were created
+        self._template_sum = None # sum of anscombed corrected frames
+        self._template_count = 0
+
+    @property
+    def num_frames(self):
+        """ Number of frames received."""
+        return sum(len(s) for s in self.y_shifts) + sum(f.shape[-1] for f in self._pending)
+
+    def update(self, frames):
+        """ Correct new frames.
+
+        :param np.array frames: New frames (height x width x num_frames).
+        """
+        self._pending.append(np.asarray(frames, dtype=np.float32))
+        if self.motion_template is None:
+            if sum(f.shape[-1] for f in self._pending) < self.num_template_frames:
+                return # wait for more frames
+            self._create_templates(np.concatenate(self._pending, axis=-1))
+
+        frames = np.concatenate(self._pending, axis=-1)
+        self._pending = []
+        self._register(frames)
+
+    def finish(self):
+        """ Correct any frames left and return the results.
+
+        :returns: Dictionary with raster_phase, raster_template, motion_template,
+            y_shifts and x_shifts (not yet centered or corrected for outliers).
+        """
+        if self._pending:
+            frames = np.concatenate(self._pending, axis=-1)
+            self._pending = []
+            if self.motion_template is None: # scan shorter than num_template_frames
+                self._create_templates(frames)
+            self._register(frames)
+
+        return {'raster_phase': self.raster_phase, 'raster_template': self.raster_template,
+                'motion_template': self.motion_template,
+                'y_shifts': np.concatenate(self.y_shifts),
+                'x_shifts': np.concatenate(self.x_shifts)}
+
+    def _skip(self, shape):
+        """ Rows and columns discarded to avoid edge artifacts (as in MotionCorrection)."""
+        return int(round(shape[0] * 0.10)), int(round(shape[1] * 0.10))
+
+    def _create_templates(self, frames):
+        from scipy import ndimage
+        from scipy.signal import tukey
+
+        # Raster template (average frame tapered to avoid edge artifacts) and phase
+        image_height, image_width = frames.shape[:2]
+        taper = np.sqrt(np.outer(tukey(image_height, 0.4), tukey(image_width, 0.4)))
+        self.raster_template = np.mean(_anscombe(frames.copy()), axis=-1) * taper
+        if self.is_bidirectional:
+            self.raster_phase = galvo_corrections.compute_raster_phase_pyramid(
+                self.raster_template, self.fill_fraction)
+        else:
+            self.raster_phase = 0
+
+        # Motion template
+        skip_rows, skip_cols = self._skip(frames.shape)
+        cropped = self._correct_raster(frames[skip_rows: -skip_rows, skip_cols: -skip_cols])
+        self._template_sum = np.sum(_anscombe(cropped), axis=-1, dtype=float)
+        self._template_count = frames.shape[-1]
+        self.motion_template = ndimage.gaussian_filter(self._template_sum /
+                                                       self._template_count, 0.7)
+
+    def _correct_raster(self, frames):
+        frames = frames.copy()
+        if abs(self.raster_phase) > 1e-7:
+            frames = galvo_corrections.correct_raster(frames, self.raster_phase,
+                                                      self.fill_fraction)
+        return frames
+
+    def _register(self, frames):
+        from scipy import ndimage
+
+        # Compute shifts
+        skip_rows, skip_cols = self._skip(frames.shape)
+        cropped = self._correct_raster(frames[skip_rows: -skip_rows, skip_cols: -skip_cols])
+        y_shifts, x_shifts = galvo_corrections.compute_motion_shifts_pyramid(
+            cropped, self.motion_template, self.max_y_shift, self.max_x_shift)
+        self.y_shifts.append(y_shifts)
+        self.x_shifts.append(x_shifts)
+
+        # Update template with motion corrected frames
+        corrected = galvo_corrections.correct_motion(_anscombe(cropped), x_shifts, y_shifts)
+        self._template_sum += np.sum(corrected, axis=-1, dtype=float)
+        self._template_count += frames.shape[-1]
+        self.motion_template = ndimage.gaussian_filter(self._template_sum /
+                                                       self._template_count, 0.7)
+
+
+def _anscombe(frames):
+    """ Anscombe transform (2 * sqrt(x - min + 3/8)) of a float array, in place."""
+    frames -= frames.min() - 3 / 8
+    np.sqrt(frames, out=frames)
+    frames *= 2
+
+    return frames
+
+
+def results_filename(key):
+    """ File where results of correct_online() are saved for this field.
+
+    :param dict key: Key with animal_id, session, scan_idx and field (other attributes
+        are ignored).
+    """
+    from datajoint.jobs import key_hash
+    from .. import config
+
+    field_key = {k: key[k] for k in ['animal_id', 'session', 'scan_idx', 'field']}
+    return os.path.join(config['performance.scratch_dir'], 'online',
+                        key_hash(field_key) + '.npz')
+
+
+def load_results(key, channel, num_frames):
+    """ Results of correct_online() for this field (None if there are none).
+
+    Results are ignored if they were computed in another channel or for a different
+    number of frames (e.g., if online correction was stopped before the scan ended).
+
+    :param dict key: Key with animal_id, session, scan_idx and field.
+    :param int channel: Correction channel. Starts at 1.
+    :param int num_frames: Number of frames in the scan.
+
+    :returns: Dictionary with raster_phase, raster_template, motion_template, y_shifts
+        and x_shifts.
+    """
+    filename = results_filename(key)
+    if not os.path.isfile(filename):
+        return None
+
+    with np.load(filename) as data:
+        results = {k: data[k] for k in data.files}
+    if results.pop('channel') != channel or len(results['y_shifts']) != num_frames:
+        return None
+    results['raster_phase'] = float(results['raster_phase'])
+
+    return results
+
+
+def correct_online(key, channel=1, chunk_size=500, poll_interval=5, timeout=120,
+                   num_template_frames=1000):
+    """ Correct a field of a scan while it is being acquired.
+
+    Waits for the first tiff file of the scan, follows its files (see TiffTail) and
+    saves the results (see load_results) once no new pages have been written in
+    timeout seconds.
+
+    :param dict key: Key with animal_id, session, scan_idx (in experiment.Scan) and field.
+    :param int channel: Channel used for correction (as in CorrectionChannel). Starts at 1.
+    :param int chunk_size: Number of frames corrected at a time.
+    :param float poll_interval: Seconds between reads of the tiff files.
+    :param float timeout: Seconds without new pages after which the scan is complete.
+    :param int num_template_frames: Number of (initial) frames used to create templates.
+
+    :returns: Dictionary with the results.
+    """
+    import scanreader
+    from .. import experiment
+
+    # Wait for the first file
+    wildcard = (experiment.Scan() & key).local_filenames_as_wildcard
+    waiting_since = time.time()
+    while not glob.glob(wildcard):
+        if time.time() - waiting_since > timeout:
+            raise PipelineException('No files found at {}'.format(wildcard))
+        time.sleep(poll_interval)
+    time.sleep(poll_interval) # give ScanImage time to write the header
+
+    # Read scan parameters from the header
+    scan = scanreader.read_scan(sorted(glob.glob(wildcard))[0])
+    tail = TiffTail(wildcard, num_fields=scan.num_fields,
+                    num_channels=scan.num_channels, field_id=key['field'] - 1,
+                    channel=channel - 1, num_flyback_frames=scan._num_fly_back_frames)
+    corrector = OnlineMotionCorrection(scan.temporal_fill_fraction,
+                                       scan.is_bidirectional,
+                                       num_template_frames=num_template_frames)
+
+    # Correct frames as they arrive
+    for frames in tail.follow(chunk_size, poll_interval, timeout):
+        corrector.update(frames)
+        print(time.ctime(), 'Corrected frames:', corrector.num_frames)
+    results = corrector.finish()
+
+    # Save results
+    filename = results_filename(key)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    np.savez(filename + '.tmp.npz', channel=channel, **results)
+    os.replace(filename + '.tmp.npz', filename)
+
+    return results
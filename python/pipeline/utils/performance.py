@@ -1,11 +1,1275 @@
 import numpy as np
 import multiprocessing as mp
 from . import galvo_corrections
+from ..exceptions import PipelineException
 import time
+import atexit
+import traceback
+import functools
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError: # python < 3.8
+    shared_memory = resource_tracker = None
+
+
+class SharedMemoryQueue:
+    """ Queue of (label, chunk) tuples that moves chunks through shared memory.
+
+    Works as a ring buffer of shared memory blocks: put() copies the chunk into a free
+    block and only sends a small (label, block_name, shape, dtype) handle through the
+    queue; get() returns a numpy array that reads directly from the shared block, so
+    chunks are never pickled or copied on the worker side.
+
+    A block is given back to the ring when the same consumer calls get() again, so
+    workers should be done with a chunk before asking for the next one (as all
+    parallel_* functions in this module are). Blocks held by consumers that die are
+    reclaimed by the producer while it waits for a free block. Stop signals ((label,
+    None) tuples) are passed through as usual; consumers should call release() once
+    they are done to close the blocks they attached (WorkerPool does).
+
+    Blocks are created lazily (sized to the chunk that first needs them) and live in
+    /dev/shm, make sure it is big enough (docker's default is 64 MB). Needs python 3.8+.
+    """
+    def __init__(self, manager, num_blocks):
+        if shared_memory is None:
+            raise PipelineException('SharedMemoryQueue needs python 3.8 or newer.')
+
+        # Start the tracker before workers are created so they all share it
+        resource_tracker.ensure_running()
+
+        self.handles = manager.Queue(maxsize=num_blocks)
+        self.free_blocks = manager.Queue()
+        for i in range(num_blocks):
+            self.free_blocks.put(i)
+        self.in_use = manager.dict() # pid: block_id being used by that consumer
+        self._blocks = {} # block_id: SharedMemory, only in the producer
+        self._attached = {} # block_name: SharedMemory, only in consumers
+        self._current_block = None # block_id being used by this consumer
+
+    def __getstate__(self):
+        return {'handles': self.handles, 'free_blocks': self.free_blocks,
+                'in_use': self.in_use}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._blocks = {}
+        self._attached = {}
+        self._current_block = None
+
+    def put(self, item, timeout=None):
+        import queue
+
+        label, chunk = item
+        if chunk is None: # stop signal
+            self.handles.put((label, None, None, None, None), timeout=timeout)
+            return
+
+        # Get a free block (locks until a consumer releases one)
+        block_id = self._get_free_block(timeout)
+        block = self._blocks.get(block_id)
+        if block is None or block.size < chunk.nbytes:
+            if block is not None: # too small, replace it
+                block.close()
+                block.unlink()
+            block = shared_memory.SharedMemory(create=True, size=max(chunk.nbytes, 1))
+            self._blocks[block_id] = block
+
+        # Copy chunk to shared memory and send its handle
+        shared_chunk = np.ndarray(chunk.shape, dtype=chunk.dtype, buffer=block.buf)
+        shared_chunk[:] = chunk
+        self.handles.put((label, block_id, block.name, chunk.shape, chunk.dtype.str))
+
+    def _get_free_block(self, timeout=None, interval=1):
+        """ Wait for a free block, reclaiming blocks of dead consumers every interval s.
+
+        :raises queue.Full: If no block is freed in timeout seconds.
+        """
+        import queue
+
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            wait = interval if deadline is None else min(interval, deadline - time.time())
+            try:
+                return self.free_blocks.get(timeout=max(wait, 0))
+            except queue.Empty:
+                if self._reclaim_blocks() == 0 and deadline is not None and \
+                        time.time() >= deadline:
+                    raise queue.Full
+
+    def _reclaim_blocks(self):
+        """ Put blocks held by consumers that died back in the ring.
+
+        :returns: Number of blocks reclaimed.
+        """
+        import os
+
+        num_reclaimed = 0
+        for pid, block_id in list(self.in_use.items()):
+            try:
+                os.kill(pid, 0) # check whether the process exists
+            except ProcessLookupError:
+                if self.in_use.pop(pid, None) is not None:
+                    self.free_blocks.put(block_id)
+                    num_reclaimed += 1
+            except PermissionError: # exists but owned by someone else
+                pass
+        return num_reclaimed
+
+    def get(self):
+        import os
+
+        # Release the block used for the previous chunk
+        if self._current_block is not None:
+            self.in_use.pop(os.getpid(), None)
+            self.free_blocks.put(self._current_block)
+            self._current_block = None
+
+        label, block_id, block_name, shape, dtype = self.handles.get()
+        if block_id is None: # stop signal
+            return label, None
+
+        if block_name not in self._attached:
+            self._attached[block_name] = shared_memory.SharedMemory(name=block_name)
+        self._current_block = block_id
+        self.in_use[os.getpid()] = block_id
+        chunk = np.ndarray(shape, dtype=dtype, buffer=self._attached[block_name].buf)
+
+        return label, chunk
+
+    def qsize(self):
+        return self.handles.qsize()
+
+    def drain(self):
+        """ Drop the chunks waiting in the queue (and give their blocks back)."""
+        import queue
+
+        while True:
+            try:
+                _, block_id, _, _, _ = self.handles.get_nowait()
+            except queue.Empty:
+                return
+            if block_id is not None:
+                self.free_blocks.put(block_id)
+
+    def release(self):
+        """ Close the blocks attached by this consumer. Called once its job is done."""
+        for block_name, block in list(self._attached.items()):
+            try:
+                block.close()
+            except BufferError: # a chunk still points to it, closed when collected
+                continue
+            del self._attached[block_name]
+
+    def close(self):
+        """ Free all shared memory blocks. Called by the producer once workers are done."""
+        for block in self._blocks.values():
+            block.close()
+            block.unlink()
+        self._blocks = {}
+
+
+class ScanReaderQueue:
+    """ Queue of (label, chunk) tuples where chunks are read by the consumer.
+
+    The producer only sends (label, scan_slices) tuples; get() reads scan[scan_slices]
+    in the consumer, opening the scan files (once per process) with scanreader. This
+    way TIFF reads run in parallel in every worker rather than in the producer.
+
+    :param Manager manager: Multiprocessing manager used to create the queue.
+    :param int queue_size: Maximum number of slices waiting in the queue.
+    :param list filenames: Files of the scan, as in scan.filenames.
+    :param np.dtype dtype: Data type used to read the scan.
+    """
+    def __init__(self, manager, queue_size, filenames, dtype):
+        self.queue = manager.Queue(maxsize=queue_size)
+        self.filenames = filenames
+        self.dtype = dtype
+        self._scan = None # opened lazily in each consumer
+        self.read_time = None # seconds spent reading the last chunk (in the consumer)
+
+    def __getstate__(self):
+        return {'queue': self.queue, 'filenames': self.filenames, 'dtype': self.dtype}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._scan = None
+        self.read_time = None
+
+    def put(self, item, timeout=None):
+        self.queue.put(item, timeout=timeout) # (label, scan_slices) tuple
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    def drain(self):
+        """ Drop the slices waiting in the queue."""
+        _drain_chunk_queue(self.queue)
+
+    def get(self):
+        import scanreader
+
+        label, scan_slices = self.queue.get()
+        if scan_slices is None: # stop signal
+            return label, None
+
+        start_time = time.time()
+        if self._scan is None:
+            self._scan = scanreader.read_scan(self.filenames, dtype=self.dtype)
+        chunk = self._scan[scan_slices]
+        self.read_time = time.time() - start_time
+
+        return label, chunk
+
+
+class WorkerPool:
+    """ Long-lived pool of processes used to run map_frames/map_fields jobs.
+
+    Starting processes (and importing numpy, scipy, pyfftw, etc. in them) is slow, so
+    rather than creating new processes for every map_frames call, the same pool can be
+    reused across fields, channels and tables. A job is a function with the same
+    signature as the parallel_* functions in this module: f(chunks, results, **kwargs);
+    it is sent to every process in the pool and runs until it consumes a stop signal.
+
+    A monitor thread replaces processes that die (e.g., killed by the OOM killer) and
+    resubmits the job they were running so the job still consumes all chunks. The chunk
+    the process was working on is lost; map_frames detects and requeues it.
+
+    Several jobs can run at the same time (e.g., a map_frames call while an imap_frames
+    generator is being consumed); submit() returns a job id so each caller only waits
+    for (and sees the failures of) its own job.
+
+    The pool is shut down at exit (or when close() is called).
+
+    :param int num_processes: Number of processes in the pool.
+    """
+    def __init__(self, num_processes=10):
+        import threading
+
+        # Start the tracker before the workers so they share it (see SharedMemoryQueue)
+        if resource_tracker is not None:
+            resource_tracker.ensure_running()
+
+        self.num_processes = num_processes
+        self.manager = mp.Manager()
+        self.jobs = mp.Queue()
+        self.done = mp.Queue()
+        self.running = self.manager.dict() # pid: ticket of the job it is running
+        self.processes = [self._start_process() for i in range(num_processes)]
+        self.num_deaths = 0 # number of processes that died while running a job
+
+        self._pending = {} # ticket: (job_id, job), for jobs submitted but not finished
+        self._failed = {} # job_id: number of processes where the job raised
+        self._num_tickets = 0 # used to create tickets
+        self._num_jobs = 0 # used to create job ids
+        self._lock = threading.Lock()
+        self._closing = threading.Event()
+        self._monitor = threading.Thread(target=self._monitor_processes, daemon=True)
+        self._monitor.start()
+
+        atexit.register(self.close)
+
+    def _start_process(self):
+        p = mp.Process(target=_pool_worker, args=(self.jobs, self.done, self.running),
+                       daemon=True)
+        p.start()
+        return p
+
+    def _monitor_processes(self, interval=1):
+        """ Replace dead processes and resubmit the job they were running."""
+        while not self._closing.wait(interval):
+            with self._lock:
+                for i, p in enumerate(self.processes):
+                    if p.is_alive() or self._closing.is_set():
+                        continue
+                    ticket = self.running.pop(p.pid, None)
+                    print('Warning: Worker process {} died (exit code {}). Starting a new'
+                          ' one.'.format(p.pid, p.exitcode))
+                    self.processes[i] = self._start_process()
+                    if ticket in self._pending:
+                        self.jobs.put((ticket, self._pending[ticket][1]))
+                        self.num_deaths += 1
+
+    @property
+    def is_alive(self):
+        return len(self.processes) > 0
+
+    def submit(self, f, chunks, results, kwargs={}, num_workers=None):
+        """ Send job f(chunks, results, **kwargs) to num_workers processes in the pool.
+
+        :param int num_workers: Number of processes that run the job (each consumes one
+            stop signal). Defaults to every process in the pool.
+
+        :returns: Id of the job (to wait for or check it).
+        """
+        if not self.is_alive:
+            raise PipelineException('Worker pool has already been closed.')
+        num_workers = (self.num_processes if num_workers is None else
+                       min(num_workers, self.num_processes))
+        kwargs = {k: _to_picklable(v) for k, v in kwargs.items()}
+        with self._lock:
+            job_id = self._num_jobs
+            self._num_jobs += 1
+            for i in range(num_workers):
+                ticket = self._num_tickets
+                self._num_tickets += 1
+                self._pending[ticket] = (job_id, (f, chunks, results, kwargs))
+                self.jobs.put((ticket, self._pending[ticket][1]))
+
+        return job_id
+
+    def _collect(self, timeout=0):
+        """ Record finished tickets (waits up to timeout seconds for the first one)."""
+        import queue
+
+        while True:
+            try:
+                ticket, succeeded = (self.done.get(timeout=timeout) if timeout > 0 else
+                                     self.done.get_nowait())
+            except queue.Empty:
+                return
+            with self._lock:
+                pending = self._pending.pop(ticket, None) # None if resubmitted and done
+                if pending is not None and not succeeded:
+                    self._failed[pending[0]] = self._failed.get(pending[0], 0) + 1
+            timeout = 0
+
+    def is_running(self, job_id):
+        """ Whether any process is still running (or about to run) job job_id."""
+        with self._lock:
+            return any(pending[0] == job_id for pending in self._pending.values())
+
+    def _raise_if_failed(self, job_id):
+        with self._lock:
+            num_failed = self._failed.pop(job_id, 0)
+        if num_failed > 0:
+            raise PipelineException('Job failed in {} worker processes.'.format(num_failed))
+
+    def wait(self, job_id, interval=1):
+        """ Wait for job job_id to finish in every process (other jobs are not waited for).
+
+        :raises PipelineException: If the job raised an exception in any process.
+        """
+        while self.is_running(job_id):
+            self._collect(timeout=interval)
+        self._raise_if_failed(job_id)
+
+    def check(self, job_id):
+        """ Check (without waiting) whether job job_id has failed in any process.
+
+        :raises PipelineException: If the job raised an exception in any process.
+        """
+        self._collect()
+        self._raise_if_failed(job_id)
+
+    def cancel(self, job_id, chunks, interval=1):
+        """ Stop job job_id without affecting other jobs running in the pool.
+
+        Chunks waiting in the queue are dropped and stop signals are sent until every
+        process running the job is done (after the chunk it is working on). Failures of
+        the job are discarded. If the pool is broken (e.g., its manager was killed by a
+        KeyboardInterrupt), the pool is closed instead.
+
+        :param queue chunks: Queue the job consumes chunks from.
+        """
+        import queue
+
+        try:
+            _drain_chunk_queue(chunks)
+            while self.is_running(job_id):
+                try:
+                    chunks.put((None, None), timeout=interval)
+                except queue.Full:
+                    pass
+                self._collect()
+        except Exception:
+            self.close(terminate=True)
+        with self._lock:
+            self._failed.pop(job_id, None)
+
+    def close(self, terminate=False):
+        """ Stop all processes in the pool.
+
+        :param bool terminate: Kill processes rather than waiting for them to finish
+            their current job. Use it when a job was interrupted.
+        """
+        if not self.is_alive:
+            return
+
+        self._closing.set()
+        self._monitor.join()
+        if terminate:
+            for p in self.processes:
+                p.terminate()
+        else:
+            for p in self.processes:
+                self.jobs.put(None) # stop signal
+        for p in self.processes:
+            p.join()
+        self.manager.shutdown()
+        self.processes = []
+        self._pending = {}
+        self._failed = {}
+
+        atexit.unregister(self.close)
+
+
+def _pool_worker(jobs, done, running):
+    """ Run jobs sent to a WorkerPool until a None job is received."""
+    import os
+
+    while True:
+        job = jobs.get()
+        if job is None: # stop signal
+            return
+
+        ticket, (f, chunks, results, kwargs) = job
+        running[os.getpid()] = ticket
+        kwargs = {k: _from_picklable(v) for k, v in kwargs.items()}
+        try:
+            f(chunks, results, **kwargs)
+            succeeded = True
+        except Exception:
+            traceback.print_exc()
+            succeeded = False
+        if hasattr(chunks, 'release'): # e.g., close shared memory blocks
+            chunks.release()
+        del running[os.getpid()]
+        done.put((ticket, succeeded))
+
+
+class _MemmapHandle:
+    """ Picklable reference to a np.memmap (pickling the array itself copies the data)."""
+    def __init__(self, memmap):
+        self.filename = memmap.filename
+        self.dtype = memmap.dtype
+        self.shape = memmap.shape
+        self.offset = memmap.offset
+        self.order = 'F' if (memmap.flags.f_contiguous and not
+                             memmap.flags.c_contiguous) else 'C'
+
+
+def _to_picklable(value):
+    """ Replace values that cannot be sent to the pool workers as is."""
+    if isinstance(value, np.memmap) and value.filename is not None:
+        return _MemmapHandle(value)
+    elif isinstance(value, dict): # e.g., a dictionary of memmaps
+        return {k: _to_picklable(v) for k, v in value.items()}
+    return value
+
+
+def _from_picklable(value):
+    """ Undo _to_picklable in the worker."""
+    if isinstance(value, _MemmapHandle):
+        return np.memmap(value.filename, dtype=value.dtype, mode='r+', shape=value.shape,
+                         offset=value.offset, order=value.order)
+    elif isinstance(value, dict):
+        return {k: _from_picklable(v) for k, v in value.items()}
+    return value
+
+
+_worker_pool = None # shared pool used by map_frames/map_fields
+
+
+def get_worker_pool():
+    """ Returns the worker pool shared by all map_frames/map_fields calls in this process.
+
+    The pool is created on first use (with as many processes as autotune() would ever
+    use: one per available CPU minus one for the producer, at most 10) and reused
+    afterwards. Jobs that need fewer processes only run in some of them (see
+    WorkerPool.submit), so the pool is not restarted between jobs.
+
+    :returns: A WorkerPool.
+    """
+    global _worker_pool
+    if _worker_pool is None or not _worker_pool.is_alive:
+        _worker_pool = WorkerPool(max(min(10, get_cpu_limit() - 1), 1))
+    return _worker_pool
+
+
+def has_shared_memory(nbytes=0):
+    """ Whether shared memory blocks totalling nbytes can be created.
+
+    Shared memory needs python 3.8+ and lives in /dev/shm, which is only 64 MB in docker
+    containers unless shm_size is set; writing past its size kills the process (SIGBUS).
+    """
+    import os
+
+    if shared_memory is None:
+        return False
+    try:
+        stats = os.statvfs('/dev/shm')
+    except OSError: # no /dev/shm (e.g., macOS), nothing to check
+        return True
+
+    return stats.f_bavail * stats.f_frsize >= nbytes
+
+
+def _make_chunk_queue(manager, transport, queue_size, num_processes, scan,
+                      chunk_size_in_GB=0):
+    """ Create the queue used to send chunks to the workers.
+
+    :param Manager manager: Multiprocessing manager used to create queues.
+    :param string transport: How chunks are sent to the workers:
+        'queue': Chunks are pickled through the manager process.
+        'shared_memory': Chunks are copied into a ring of shared memory blocks. Falls
+            back to 'queue' if shared memory is not available or /dev/shm is too small.
+        'scanreader': Only scan slices are sent; workers read the chunks themselves.
+    :param int queue_size: Maximum number of chunks waiting in the queue.
+    :param int num_processes: Number of workers consuming from the queue.
+    :param Scan scan: Scan object that will be mapped.
+    :param float chunk_size_in_GB: Size of each chunk (to check /dev/shm is big enough).
+    """
+    if transport == 'shared_memory':
+        # one block per queued chunk plus one being processed by each worker
+        num_blocks = queue_size + num_processes
+        if has_shared_memory(num_blocks * chunk_size_in_GB * 1024**3):
+            chunks = SharedMemoryQueue(manager, num_blocks=num_blocks)
+        else:
+            print("Warning: Not enough shared memory for transport='shared_memory'. "
+                  "Using transport='queue'.")
+            chunks = manager.Queue(maxsize=queue_size)
+    elif transport == 'scanreader':
+        chunks = ScanReaderQueue(manager, queue_size, scan.filenames, scan.dtype)
+    elif transport == 'queue':
+        chunks = manager.Queue(maxsize=queue_size)
+    else:
+        raise PipelineException('Unrecognized transport {}'.format(transport))
+
+    return chunks
+
+
+def _close_chunk_queue(chunks):
+    """ Release any resources held by the chunk queue."""
+    if isinstance(chunks, SharedMemoryQueue):
+        chunks.close()
+
+
+def _drain_chunk_queue(chunks):
+    """ Drop the chunks waiting in the queue (e.g., when its job is cancelled)."""
+    import queue
+
+    chunks = getattr(chunks, 'chunks', chunks) # queue wrapped by _TrackedChunks
+    if hasattr(chunks, 'drain'):
+        chunks.drain()
+        return
+    while True:
+        try:
+            chunks.get_nowait()
+        except queue.Empty:
+            return
+
+
+class ResultsQueue:
+    """ List-like wrapper around a queue so workers can append() results to it.
+
+    Lets the parent consume results as soon as they are produced rather than after all
+    workers are done (as with a manager.list()).
+    """
+    def __init__(self, manager):
+        self.queue = manager.Queue()
+
+    def append(self, result):
+        self.queue.put(result)
+
+    def get(self, timeout=None):
+        return self.queue.get(timeout=timeout)
+
+
+class SharedOutputs:
+    """ Named arrays in shared memory that workers can write their results to.
+
+    Workers write (or accumulate) their part of the output directly, e.g.,
+    outputs['traces'][:, frames] = traces, so results never go through the manager.
+    Use the lock when several workers update the same values (accumulators).
+
+    If a directory is given, arrays are memory-mapped files in it (rather than shared
+    memory blocks) so they survive the process; existing files are reused (to resume a
+    checkpointed job, see ChunkCheckpoint). Memory-mapped files (in a temporary
+    directory deleted by close()) are also used if shared memory is not available or
+    /dev/shm is too small for the arrays (see has_shared_memory).
+
+    :param Manager manager: Multiprocessing manager used to create the lock.
+    :param dict specs: Dictionary with name: (shape, dtype) pairs. Arrays start at zero.
+    :param string directory: Directory for memory-mapped arrays. Optional.
+    """
+    def __init__(self, manager, specs, directory=None):
+        import os
+        import tempfile
+
+        specs = {name: (tuple(np.atleast_1d(shape)), np.dtype(dtype)) for name, (shape,
+                 dtype) in specs.items()}
+        total_bytes = sum(int(np.prod(shape)) * dtype.itemsize for shape, dtype in
+                          specs.values())
+        self._tmp_directory = None # deleted in close()
+        if directory is None and not has_shared_memory(total_bytes):
+            print('Warning: Not enough shared memory for the outputs. Using memory-mapped '
+                  'files.')
+            directory = self._tmp_directory = tempfile.mkdtemp(prefix='outputs_')
+
+        self.lock = manager.Lock()
+        self.specs = {} # name: (shape, dtype, block_name or filename)
+        self._blocks = {} # block_name: SharedMemory (or filename: memmap)
+        for name, (shape, dtype) in specs.items():
+            nbytes = int(np.prod(shape)) * dtype.itemsize
+            if directory is None:
+                block = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+                np.ndarray(shape, dtype=dtype, buffer=block.buf).fill(0)
+                self.specs[name] = (shape, dtype.str, block.name)
+                self._blocks[block.name] = block
+            else:
+                filename = os.path.join(directory, name + '.dat')
+                exists = os.path.isfile(filename) and os.path.getsize(filename) == nbytes
+                array = np.memmap(filename, dtype=dtype, shape=shape,
+                                  mode='r+' if exists else 'w+') # w+ fills with zeros
+                self.specs[name] = (shape, dtype.str, filename)
+                self._blocks[filename] = array
+
+    def __getstate__(self):
+        return {'lock': self.lock, 'specs': self.specs}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._blocks = {} # attached lazily in workers
+        self._tmp_directory = None
+
+    def __getitem__(self, name):
+        shape, dtype, block_name = self.specs[name]
+        if block_name not in self._blocks:
+            if block_name.endswith('.dat'):
+                self._blocks[block_name] = np.memmap(block_name, dtype=dtype,
+                                                     shape=shape, mode='r+')
+            else:
+                self._blocks[block_name] = shared_memory.SharedMemory(name=block_name)
+
+        block = self._blocks[block_name]
+        if isinstance(block, np.memmap):
+            return block
+        return np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+    def copy(self):
+        """ Returns a dictionary with a (non-shared) copy of each array."""
+        return {name: np.array(self[name]) for name in self.specs}
+
+    def close(self):
+        """ Free shared memory. Called by the creator once workers are done.
+
+        Memory-mapped files are left on disk (ChunkCheckpoint.clear() deletes them)
+        unless they were created in a temporary directory.
+        """
+        import shutil
+
+        for block in self._blocks.values():
+            if isinstance(block, np.memmap):
+                block.flush()
+            else:
+                block.close()
+                block.unlink()
+        self._blocks = {}
+        if self._tmp_directory is not None:
+            shutil.rmtree(self._tmp_directory, ignore_errors=True)
+            self._tmp_directory = None
+
+
+class ChunkCheckpoint:
+    """ Saves the results of each chunk processed by map_frames to a scratch directory.
+
+    If the job is interrupted (node preempted, populate killed, ...) running map_frames
+    again with the same directory reloads the results of the chunks already processed
+    and processes only the missing ones. The directory should be unique to the job, e.g.,
+    named after the table and the hash of the key (see get_checkpoint_dir). Results are
+    only reused if the inputs of the job did not change (same fingerprint); otherwise,
+    the checkpoint is discarded.
+
+    Checkpoints live in config['performance.scratch_dir'] which, by default, is in /tmp,
+    so interrupted jobs only resume if they run again in the same node. Set it to shared
+    storage to resume them in any node.
+
+    Files in the directory:
+        fingerprint.json: Hash of the inputs of the job (see input_fingerprint).
+        chunk_size.json: Frames per chunk used in the first run (reused when resuming).
+        {start}-{stop}_{i}.pkl: i-th result appended by f for chunk frames[start:stop].
+        {start}-{stop}.done: Marks the chunk as finished (all its results are saved).
+        {name}.dat: Outputs of map_frames (see SharedOutputs).
+
+    In-place outputs are recomputed for chunks that did not finish so they should be
+    written per frame (outputs['traces'][:, frames] = ...) rather than accumulated.
+
+    :param string directory: Directory where the results are saved. Created if needed.
+    :param string fingerprint: Hash of the inputs of the job. Optional.
+    """
+    def __init__(self, directory, fingerprint=None):
+        import os
+        import json
+
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+
+        # Discard checkpoints of jobs with other inputs
+        if fingerprint is not None:
+            filename = os.path.join(directory, 'fingerprint.json')
+            try:
+                with open(filename) as f:
+                    old_fingerprint = json.load(f)
+            except (OSError, ValueError):
+                old_fingerprint = None
+            if old_fingerprint != fingerprint:
+                if old_fingerprint is not None:
+                    print('Warning: Inputs changed since the checkpoint was saved. '
+                          'Discarding it.')
+                self.clear()
+                os.makedirs(directory, exist_ok=True)
+                with open(filename, 'w') as f:
+                    json.dump(fingerprint, f)
+
+    def _filename(self, label, suffix):
+        import os
+
+        return os.path.join(self.directory, '{}-{}{}'.format(label.start, label.stop,
+                                                            suffix))
+
+    def get_chunk_size(self, chunk_size):
+        """ Returns the chunk size of a previous run or saves (and returns) chunk_size."""
+        import os
+        import json
+
+        filename = os.path.join(self.directory, 'chunk_size.json')
+        if os.path.isfile(filename):
+            with open(filename) as f:
+                return json.load(f)
+        with open(filename, 'w') as f:
+            json.dump(chunk_size, f)
+        return chunk_size
+
+    def save_result(self, label, index, result):
+        """ Save the index-th result of the chunk with frames label."""
+        import os
+        import pickle
+
+        filename = self._filename(label, '_{}.pkl'.format(index))
+        with open(filename + '.tmp', 'wb') as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(filename + '.tmp', filename) # never leave half-written results
+
+    def mark_finished(self, label):
+        """ Mark the chunk with frames label as finished."""
+        open(self._filename(label, '.done'), 'w').close()
+
+    def finished(self):
+        """ Returns the frames (slices) of all finished chunks."""
+        import os
+
+        labels = []
+        for filename in os.listdir(self.directory):
+            if filename.endswith('.done'):
+                start, stop = filename[:-len('.done')].split('-')
+                labels.append(slice(int(start), int(stop)))
+        return labels
+
+    def load_results(self, label):
+        """ Returns the list of results saved for the chunk with frames label."""
+        import os
+        import pickle
+
+        results = []
+        while os.path.isfile(self._filename(label, '_{}.pkl'.format(len(results)))):
+            with open(self._filename(label, '_{}.pkl'.format(len(results))), 'rb') as f:
+                results.append(pickle.load(f))
+        return results
+
+    def clear(self):
+        """ Delete the checkpoint (once the job is done)."""
+        import shutil
+
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def input_fingerprint(*values):
+    """ Hash of the inputs of a job, e.g., input_fingerprint(f, kwargs, field_id).
+
+    Arrays are hashed by their contents, memory-mapped arrays by their filename,
+    functions by their name and everything else by its repr.
+    """
+    import hashlib
+
+    md5 = hashlib.md5()
+    def update(value):
+        if isinstance(value, np.memmap) and value.filename is not None:
+            md5.update(repr((value.filename, value.shape, value.dtype.str)).encode())
+        elif isinstance(value, np.ndarray) and value.dtype != object:
+            md5.update(repr((value.shape, value.dtype.str)).encode())
+            md5.update(np.ascontiguousarray(value).tobytes())
+        elif isinstance(value, (list, tuple, np.ndarray)):
+            md5.update(b'[')
+            for v in value:
+                update(v)
+            md5.update(b']')
+        elif isinstance(value, dict):
+            md5.update(b'{')
+            for k in sorted(value, key=str):
+                update(k)
+                update(value[k])
+            md5.update(b'}')
+        elif callable(value):
+            md5.update('{}.{}'.format(getattr(value, '__module__', ''),
+                                      getattr(value, '__qualname__', value)).encode())
+        else:
+            md5.update(repr(value).encode())
+    for value in values:
+        update(value)
+
+    return md5.hexdigest()
+
+
+def get_checkpoint_dir(*names):
+    """ Directory to checkpoint a job, e.g., get_checkpoint_dir('reso.MotionCorrection',
+    key_hash(key)). Lives in config['performance.scratch_dir']."""
+    import os
+    from .. import config
+
+    return os.path.join(config['performance.scratch_dir'], *names)
+
+
+class _TrackedChunks:
+    """ Wraps a chunk queue to record which chunks were finished by the workers.
+
+    A chunk is finished when the worker that got it asks for the next one (or for the
+    stop signal), i.e., once f is done with it. Chunks of workers that die are never
+    marked as finished, so they can be requeued.
+
+    Also times each chunk in the worker (see ChunkStats): time waiting for it
+    (dequeue_wait_s, includes reading it with transport='scanreader'), time spent in f
+    (compute_s) and time spent appending its results (result_transfer_s).
+
+    :param queue chunks: Queue with (label, chunk) tuples.
+    :param list finished: Shared list where (label, worker_stats) tuples of finished
+        chunks are appended.
+    :param ChunkCheckpoint checkpoint: Where to mark finished chunks. Optional.
+    """
+    def __init__(self, chunks, finished, checkpoint=None):
+        self.chunks = chunks
+        self.finished = finished
+        self.checkpoint = checkpoint
+        self.label = None # label of the chunk being processed (in the worker)
+        self.num_results = 0 # results appended for the current chunk
+        self.result_time = 0 # seconds spent appending results of the current chunk
+        self._stats = None # stats of the current chunk
+
+    def put(self, item, timeout=None):
+        self.chunks.put(item, timeout=timeout)
+
+    def qsize(self):
+        return self.chunks.qsize()
+
+    def release(self):
+        if hasattr(self.chunks, 'release'):
+            self.chunks.release()
+
+    def get(self):
+        import os
+
+        start_time = time.time()
+        if self.label is not None: # previous chunk is done
+            self._stats['compute_s'] = (start_time - self._stats.pop('start_time') -
+                                        self.result_time)
+            self._stats['result_transfer_s'] = self.result_time
+            if self.checkpoint is not None:
+                self.checkpoint.mark_finished(self.label)
+            self.finished.append((self.label, self._stats))
+            self.label = None
+
+        label, chunk = self.chunks.get()
+        if chunk is not None:
+            self.label, self.num_results, self.result_time = label, 0, 0
+            self._stats = {'pid': os.getpid(), 'bytes': int(chunk.nbytes),
+                           'dequeue_wait_s': time.time() - start_time,
+                           'start_time': time.time()}
+            if getattr(self.chunks, 'read_time', None) is not None: # read by the worker
+                self._stats['read_s'] = self.chunks.read_time
+        return label, chunk
+
+
+class _TrackedResults:
+    """ Results list that tags each result with the label of its chunk (and saves it in
+    the checkpoint if any) so results of chunks that did not finish can be dropped.
+
+    :param list results: Shared list where (label, result) tuples are appended.
+    :param _TrackedChunks chunks: Chunk queue the worker is consuming from.
+    """
+    def __init__(self, results, chunks):
+        self.results = results
+        self.chunks = chunks
+
+    def append(self, result):
+        start_time = time.time()
+        label = self.chunks.label
+        if self.chunks.checkpoint is not None:
+            self.chunks.checkpoint.save_result(label, self.chunks.num_results, result)
+        self.chunks.num_results += 1
+        self.results.append((label, result))
+        self.chunks.result_time += time.time() - start_time
+
+
+class ChunkStats:
+    """ Timing and throughput of the chunks processed by a map_frames/map_fields job.
+
+    Each chunk gets a record with:
+        read_s: Time reading the chunk from the scan (in the producer or, if
+            transport='scanreader', in the worker).
+        enqueue_wait_s: Time the producer waited to put the chunk in the queue (high
+            when workers are the bottleneck).
+        queue_depth: Number of chunks waiting in the queue when it was put (close to
+            zero when reading is the bottleneck).
+        dequeue_wait_s: Time the worker waited to get the chunk.
+        compute_s: Time spent in f.
+        result_transfer_s: Time spent sending results to the parent (results.append).
+        bytes: Size of the chunk.
+        pid: Worker that processed it.
+
+    report() prints a summary (frames/s, MB/s and mean times per chunk) and, if
+    config['performance.stats_log'] is set, appends the records and the summary to that
+    file as JSON lines so jobs can be compared (e.g., to tune chunking for each rig).
+
+    :param string name: Name of the job, e.g., 'map_frames(parallel_motion_shifts)'.
+    :param dict params: Other info saved in the summary (chunk_size, transport, ...).
+    """
+    TIMES = ['read_s', 'enqueue_wait_s', 'dequeue_wait_s', 'compute_s',
+             'result_transfer_s']
+
+    def __init__(self, name, **params):
+        self.name = name
+        self.params = params
+        self.records = {} # label: record
+        self.start_time = time.time()
+
+    @staticmethod
+    def _key(label):
+        return (label.start, label.stop) if isinstance(label, slice) else label
+
+    def add_producer_stats(self, stats):
+        """ Add stats returned by _produce_frames (dictionary with label: stats)."""
+        for label, chunk_stats in stats.items():
+            self.records.setdefault(self._key(label), {}).update(chunk_stats)
+
+    def add_worker_stats(self, finished):
+        """ Add stats recorded by _TrackedChunks (list of (label, stats) tuples)."""
+        for label, chunk_stats in finished:
+            self.records.setdefault(self._key(label), {}).update(chunk_stats)
+
+    def summary(self):
+        """ Returns a dictionary with totals, means per chunk and throughput."""
+        elapsed = time.time() - self.start_time
+        records = list(self.records.values())
+        num_frames = sum(key[1] - key[0] for key in self.records if isinstance(key,
+                                                                                tuple))
+        num_bytes = sum(record.get('bytes', 0) for record in records)
+
+        summary = {'job': self.name, 'time': time.ctime(), 'elapsed_s': elapsed,
+                   'num_chunks': len(records), 'num_frames': num_frames,
+                   'chunks_per_s': len(records) / elapsed,
+                   'frames_per_s': num_frames / elapsed, 'MB_per_s': num_bytes / 1024**2
+                   / elapsed, **self.params}
+        for name in self.TIMES + ['queue_depth']:
+            values = [record[name] for record in records if name in record]
+            summary['mean_' + name] = float(np.mean(values)) if values else None
+        return summary
+
+    def report(self):
+        """ Print summary and save records to config['performance.stats_log']."""
+        import json
+        from .. import config
+
+        summary = self.summary()
+        rate = ('{frames_per_s:.1f} frames/s' if summary['num_frames'] else
+                '{chunks_per_s:.2f} chunks/s')
+        print(('{job}: {num_chunks} chunks in {elapsed_s:.1f} s (' + rate +
+               ', {MB_per_s:.1f} MB/s)').format(**summary))
+        print('Mean per chunk:', ', '.join('{} {:.3f}'.format(name, summary['mean_' + name])
+              for name in self.TIMES + ['queue_depth']
+              if summary['mean_' + name] is not None))
+
+        filename = config.get('performance.stats_log')
+        if filename:
+            with open(filename, 'a') as f:
+                for key, record in sorted(self.records.items()):
+                    label = ({'frames': list(key)} if isinstance(key, tuple) else
+                             {'field': key})
+                    f.write(json.dumps({'job': self.name, **label, **record}) + '\n')
+                f.write(json.dumps({**summary, 'summary': True}) + '\n')
+
+        return summary
+
+
+def _compute_bytes_per_frame(scan, field_id, y, x, channel):
+    """ Size in bytes of one frame of the scan (as float32)."""
+    one_frame = scan[field_id, y, x, channel, 0]
+    bytes_per_frame = np.prod(one_frame.shape) * 4 # 4 bytes per pixel
+
+    return bytes_per_frame
+
+
+def _compute_chunk_size(scan, field_id, y, x, channel, chunk_size_in_GB):
+    """ Number of frames per chunk so each chunk takes around chunk_size_in_GB."""
+    bytes_per_frame = _compute_bytes_per_frame(scan, field_id, y, x, channel)
+    chunk_size = int(round((chunk_size_in_GB * 1024**3) / bytes_per_frame))
+
+    return max(chunk_size, 1)
+
+
+def _tune_map_params(scan, field_id, y, x, channel, chunk_size_in_GB, num_processes,
+                     queue_size, pool):
+    """ Fill in map params not given by the user. See autotune.
+
+    num_processes is the number of workers used for this job; at most the size of the
+    pool.
+    """
+    max_processes = min(num_processes or pool.num_processes, pool.num_processes)
+    if None in [chunk_size_in_GB, num_processes, queue_size]:
+        bytes_per_frame = _compute_bytes_per_frame(scan, field_id, y, x, channel)
+        tuned = autotune(bytes_per_frame, scan.num_frames, max_processes=max_processes)
+        chunk_size_in_GB = chunk_size_in_GB or tuned[0]
+        num_processes = num_processes or tuned[1]
+        queue_size = queue_size or tuned[2]
+    num_processes = max(min(num_processes, max_processes), 1)
+
+    return chunk_size_in_GB, num_processes, queue_size
+
+
+def _tune_field_params(scan, field_ids, y, x, channel, frames, num_processes, queue_size,
+                       pool):
+    """ Fill in map_fields params not given by the user. See autotune_fields."""
+    max_processes = min(num_processes or pool.num_processes, pool.num_processes)
+    if (num_processes is None or queue_size is None) and len(field_ids) > 0:
+        num_frames = len(range(*frames.indices(scan.num_frames)))
+        bytes_per_field = (_compute_bytes_per_frame(scan, field_ids[0], y, x, channel) *
+                           num_frames)
+        tuned = autotune_fields(bytes_per_field, len(field_ids),
+                                max_processes=max_processes)
+        num_processes = num_processes or tuned[0]
+        queue_size = queue_size or tuned[1]
+    num_processes = max(min(num_processes or 1, max_processes), 1)
+
+    return num_processes, queue_size or 2
+
+
+def _split_frames(num_frames, chunk_size):
+    """ Frames (slices) of each chunk."""
+    return [slice(i, min(i + chunk_size, num_frames)) for i in range(0, num_frames,
+                                                                     chunk_size)]
+
+
+def _produce_frames(chunks, scan, field_id, y, x, channel, all_frames, transport,
+                    num_processes, check=None):
+    """ Put the given chunks of the scan in the queue and one stop signal per worker.
+
+    If given, check() is called before reading each chunk and while waiting to put it
+    (see _put_checked); it should raise to stop producing.
+
+    :returns: Dictionary with (start, stop): producer_stats pairs (see ChunkStats).
+    """
+    stats = {}
+    for frames in all_frames:
+        if check is not None:
+            check()
+        scan_slices = (field_id, y, x, channel, frames)
+        stats[(frames.start, frames.stop)] = _put_chunk(chunks, frames, scan, scan_slices,
+                                                        transport, check)
+
+    # Queue STOP signal
+    for i in range(num_processes):
+        _put_checked(chunks, (None, None), check)
+
+    return stats
+
+
+def _put_checked(chunks, item, check=None, interval=1):
+    """ Put item in the queue calling check() every interval seconds while it waits.
+
+    If workers raise, nobody consumes the queue and a plain put() would block forever;
+    check should raise in that case, e.g., functools.partial(pool.check, job_id).
+    """
+    import queue
+
+    if check is None:
+        chunks.put(item)
+        return
+
+    while True:
+        try:
+            chunks.put(item, timeout=interval)
+            return
+        except queue.Full:
+            check() # raises if workers failed
+
+
+def _put_chunk(chunks, label, scan, scan_slices, transport, check=None):
+    """ Read the chunk (unless workers read it) and put it in the queue.
+
+    :returns: Dictionary with the time spent reading the chunk (read_s), waiting to put
+        it in the queue (enqueue_wait_s) and the number of chunks in the queue before
+        putting it (queue_depth).
+    """
+    stats = {}
+    start_time = time.time()
+    if transport == 'scanreader':
+        item = (label, scan_slices) # label, scan_slices tuples
+    else:
+        item = (label, scan[scan_slices]) # label, chunk tuples
+        stats['read_s'] = time.time() - start_time
+    try:
+        stats['queue_depth'] = chunks.qsize()
+    except (AttributeError, NotImplementedError): # qsize() not available in macOS
+        pass
+
+    start_time = time.time()
+    _put_checked(chunks, item, check)
+    stats['enqueue_wait_s'] = time.time() - start_time
+
+    return stats
+
+
+CGROUP_DIR = '/sys/fs/cgroup' # where cgroup (v1 or v2) limits are read from
+
+
+def get_cpu_limit():
+    """ Number of CPUs this process can use.
+
+    Takes into account CPU affinity and cgroup CPU quotas (e.g., limits of a kubernetes
+    pod), which mp.cpu_count() ignores.
+    """
+    import os
+
+    if hasattr(os, 'sched_getaffinity'):
+        num_cpus = len(os.sched_getaffinity(0))
+    else:
+        num_cpus = mp.cpu_count()
+
+    # Read cgroup quota
+    quota, period = None, None
+    try: # cgroup v2
+        with open(os.path.join(CGROUP_DIR, 'cpu.max')) as f:
+            quota, period = f.read().split()
+    except (OSError, ValueError):
+        try: # cgroup v1
+            with open(os.path.join(CGROUP_DIR, 'cpu', 'cpu.cfs_quota_us')) as f:
+                quota = f.read().strip()
+            with open(os.path.join(CGROUP_DIR, 'cpu', 'cpu.cfs_period_us')) as f:
+                period = f.read().strip()
+        except OSError:
+            pass
+    if quota is not None and quota not in ['max', '-1']:
+        num_cpus = min(num_cpus, max(int(np.ceil(int(quota) / int(period))), 1))
+
+    return num_cpus
+
+
+def get_memory_limit():
+    """ Memory (in bytes) available to this process: cgroup limit or physical memory."""
+    import os
+
+    memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+    # Read cgroup limit
+    for filename in [os.path.join(CGROUP_DIR, 'memory.max'), # cgroup v2
+                     os.path.join(CGROUP_DIR, 'memory', 'memory.limit_in_bytes')]: # v1
+        try:
+            with open(filename) as f:
+                limit = f.read().strip()
+        except OSError:
+            continue
+        if limit != 'max': # v1 uses a huge number for no limit, min() takes care of it
+            memory = min(memory, int(limit))
+        break
+
+    return memory
+
+
+WORKER_MEMORY_FACTOR = 4 # peak memory of a worker as a multiple of its chunk size
+
+
+def autotune(bytes_per_frame, num_frames, max_chunk_size_in_GB=0.5, max_processes=10,
+             max_queue_size=10):
+    """ Choose chunk size, number of processes and queue size to fit in memory.
+
+    Memory used by map_frames is roughly one chunk per queued chunk plus
+    WORKER_MEMORY_FACTOR chunks per worker (the chunk plus its temporaries). We use as
+    many workers as there are CPUs available (minus one for the producer) and the
+    largest chunks that keep memory within the budget.
+
+    The memory budget can be set (in GB) in config['performance.memory_budget_in_GB'];
+    if not set, we use 80% of the memory limit of this process (cgroup limit or
+    physical memory).
+
+    :param int bytes_per_frame: Size of one frame (as float32) in bytes.
+    :param int num_frames: Number of frames in the scan.
+    :param float max_chunk_size_in_GB: Maximum size of each chunk.
+    :param int max_processes: Maximum number of processes to use.
+    :param int max_queue_size: Maximum number of chunks waiting in the queue.
+
+    :returns: (chunk_size_in_GB, num_processes, queue_size) tuple.
+    """
+    budget_in_GB = _get_memory_budget_in_GB()
+
+    # Use as many processes as possible (no point in chunks smaller than the scan/worker)
+    num_processes = max(min(max_processes, get_cpu_limit() - 1), 1)
+    queue_size = max(min(max_queue_size, num_processes), 2)
+    scan_size_in_GB = bytes_per_frame * num_frames / 1024**3
+    min_chunk_size_in_GB = min(100 * bytes_per_frame / 1024**3, scan_size_in_GB) # ~100 frames
+    while True:
+        num_chunks_in_memory = queue_size + WORKER_MEMORY_FACTOR * num_processes
+        chunk_size_in_GB = min(budget_in_GB / num_chunks_in_memory, max_chunk_size_in_GB,
+                               scan_size_in_GB / num_processes)
+        if chunk_size_in_GB >= min_chunk_size_in_GB or num_processes == 1:
+            break
+        num_processes -= 1 # chunks too small, use less processes
+        queue_size = max(min(max_queue_size, num_processes), 2)
+    chunk_size_in_GB = max(chunk_size_in_GB, bytes_per_frame / 1024**3) # at least 1 frame
+
+    return chunk_size_in_GB, num_processes, queue_size
+
+
+def autotune_fields(bytes_per_field, num_fields, max_processes=10, max_queue_size=10):
+    """ Choose number of processes and queue size for map_fields to fit in memory.
+
+    As autotune but chunks are whole fields, so their size is fixed: we use as many
+    workers as there are CPUs available (minus one for the producer) and fields to
+    process and drop workers until the fields in memory fit within the budget.
+
+    :param int bytes_per_field: Size of one field (all frames, as float32) in bytes.
+    :param int num_fields: Number of fields to process.
+    :param int max_processes: Maximum number of processes to use.
+    :param int max_queue_size: Maximum number of fields waiting in the queue.
+
+    :returns: (num_processes, queue_size) tuple.
+    """
+    budget_in_GB = _get_memory_budget_in_GB()
+    field_size_in_GB = bytes_per_field / 1024**3
+
+    num_processes = max(min(max_processes, get_cpu_limit() - 1, num_fields), 1)
+    while True:
+        queue_size = max(min(max_queue_size, num_processes), 2)
+        num_fields_in_memory = queue_size + WORKER_MEMORY_FACTOR * num_processes
+        if num_fields_in_memory * field_size_in_GB <= budget_in_GB or num_processes == 1:
+            break
+        num_processes -= 1 # fields do not fit, use less processes
+
+    return num_processes, queue_size
+
+
+def _get_memory_budget_in_GB():
+    """ Memory budget for map_frames/map_fields. See autotune."""
+    from .. import config
+
+    budget_in_GB = config['performance.memory_budget_in_GB']
+    if budget_in_GB is None:
+        budget_in_GB = 0.8 * get_memory_limit() / 1024**3
+
+    return budget_in_GB
 
 
 def map_frames(f, scan, field_id, channel, y=slice(None), x=slice(None), kwargs={},
-               chunk_size_in_GB=0.5, num_processes=10, queue_size=10):
+               chunk_size_in_GB=None, num_processes=None, queue_size=None,
+               transport='queue', pool=None, outputs=None, checkpoint_dir=None,
+               max_retries=2):
     """ Apply function f to chunks of the scan (divided in the temporal axis).
 
     :param function f: Function that receives two positional arguments:
@@ -19,55 +1283,430 @@ def map_frames(f, scan, field_id, channel, y=slice(None), x=slice(None), kwargs=
     :param slice x: How to slice the scan in x.
     :param dict kwargs: Dictionary with optional kwargs passed to f.
     :param int chunk_size_in_GB: Desired size of each chunk.
-    :param int num_processes: Number of processes to use for mapping.
+    :param int num_processes: Number of processes to use for mapping (at most the size
+        of the pool).
     :param int queue_size: Maximum size of the queue used to store chunks.
+        chunk_size_in_GB, num_processes and queue_size are chosen by autotune() (to fit
+        in CPU and memory limits) unless given.
+    :param string transport: How chunks are sent to the workers. 'queue' (pickle them
+        through the manager process), 'shared_memory' (copy them to a ring buffer of
+        shared memory blocks; needs python 3.8+ and a /dev/shm big enough for
+        queue_size + num_processes chunks, e.g., shm_size in docker) or 'scanreader'
+        (send only the slices to read and let each worker read its chunks from the scan
+        files).
+    :param WorkerPool pool: Pool of processes used for mapping. Defaults to the pool
+        shared by all calls in this process (see get_worker_pool).
+    :param dict outputs: Dictionary with name: (shape, dtype) pairs. If given, these
+        arrays are preallocated in shared memory and passed to f as a SharedOutputs
+        object in kwarg 'outputs' so workers write their results directly to them.
+    :param string checkpoint_dir: Directory (unique to this job) where results of each
+        chunk are saved. If the job is interrupted, calling map_frames again with the
+        same directory (and the same f, kwargs, outputs and slices) only processes the
+        missing chunks. Deleted once the job is done. See ChunkCheckpoint.
+    :param int max_retries: How many times to requeue chunks lost because the worker
+        processing them died.
 
     :returns list results: List with results per chunk of scan. Order is not guaranteed.
+    :returns dict outputs: Dictionary with name: array pairs. Only if outputs was given.
     """
+    # Set chunk size, number of processes and queue size
+    pool = pool or get_worker_pool()
+    chunk_size_in_GB, num_processes, queue_size = _tune_map_params(scan, field_id, y, x,
+        channel, chunk_size_in_GB, num_processes, queue_size, pool)
+
     # Basic checks
-    if chunk_size_in_GB > 2:
+    if transport == 'queue' and chunk_size_in_GB > 2:
         print('Warning: Processing chunks of data bigger than 2 GB could cause timeout '
               'errors when sending data from the master to the working processes.')
-    num_processes = min(num_processes, mp.cpu_count() - 1)
     print('Using', num_processes, 'processes')
 
     # Calculate the number of frames per chunk
-    one_frame = scan[field_id, y, x, channel, 0]
-    bytes_per_frame = np.prod(one_frame.shape) * 4 # 4 bytes per pixel
-    chunk_size = int(round((chunk_size_in_GB * 1024**3) / bytes_per_frame))
+    chunk_size = _compute_chunk_size(scan, field_id, y, x, channel, chunk_size_in_GB)
+
+    # Restore chunks processed in a previous run (with the same inputs)
+    checkpoint = None
+    if checkpoint_dir is not None:
+        fingerprint = input_fingerprint(f, kwargs, outputs, field_id, channel, y, x,
+                                        scan.num_frames)
+        checkpoint = ChunkCheckpoint(checkpoint_dir, fingerprint)
+    finished, results = set(), []
+    if checkpoint is not None:
+        chunk_size = checkpoint.get_chunk_size(chunk_size) # chunks should match
+        for frames in checkpoint.finished():
+            finished.add((frames.start, frames.stop))
+            results.extend(checkpoint.load_results(frames))
+        if len(finished) > 0:
+            print('Resuming from checkpoint:', len(finished), 'chunks already processed')
+    all_frames = _split_frames(scan.num_frames, chunk_size)
+
+    # Create output arrays
+    if outputs is not None:
+        shared_outputs = SharedOutputs(pool.manager, outputs, directory=None if
+                                       checkpoint is None else checkpoint.directory)
+        kwargs = {**kwargs, 'outputs': shared_outputs}
+
+    stats = ChunkStats('map_frames({})'.format(getattr(f, '__name__', f)),
+                       chunk_size=chunk_size, num_processes=num_processes,
+                       queue_size=queue_size, transport=transport)
+
+    try:
+        for i in range(max_retries + 1):
+            missing = [frames for frames in all_frames if (frames.start, frames.stop)
+                       not in finished]
+            if len(missing) == 0:
+                break
+            if i > 0:
+                print('Warning: Requeuing', len(missing), 'chunks lost by dead workers')
+
+            # Create a Queue to put in new chunks and a list for results
+            chunks = _make_chunk_queue(pool.manager, transport, queue_size,
+                                       num_processes, scan, chunk_size_in_GB)
+            tracked_chunks = _TrackedChunks(chunks, pool.manager.list(), checkpoint)
+            tracked_results = _TrackedResults(pool.manager.list(), tracked_chunks)
+
+            # Start workers (will lock until data appears in chunks)
+            job_id = pool.submit(f, tracked_chunks, tracked_results, kwargs,
+                                 num_processes)
+
+            try:
+                # Produce data
+                stats.add_producer_stats(_produce_frames(tracked_chunks, scan, field_id,
+                    y, x, channel, missing, transport, num_processes,
+                    functools.partial(pool.check, job_id)))
+
+                # Wait for processes to finish
+                pool.wait(job_id)
+            except BaseException:
+                pool.cancel(job_id, tracked_chunks) # stop only this job, the pool is shared
+                raise
+            finally:
+                _close_chunk_queue(chunks)
+            stats.add_worker_stats(tracked_chunks.finished)
+
+            # Keep results of finished chunks (dead workers may leave partial results)
+            new_finished = {(frames.start, frames.stop) for frames, _ in
+                            tracked_chunks.finished}
+            results.extend(result for frames, result in tracked_results.results if
+                           (frames.start, frames.stop) in new_finished)
+            finished.update(new_finished)
+        else:
+            if len(finished) < len(all_frames):
+                msg = '{} chunks could not be processed after {} retries.'
+                raise PipelineException(msg.format(len(all_frames) - len(finished),
+                                                   max_retries))
+
+        if outputs is not None:
+            outputs = shared_outputs.copy()
+    finally:
+        if outputs is not None:
+            shared_outputs.close()
+
+    if checkpoint is not None:
+        checkpoint.clear()
+    stats.report()
+
+    return results if outputs is None else (results, outputs)
+
+
+def imap_frames(f, scan, field_id, channel, y=slice(None), x=slice(None), kwargs={},
+                chunk_size_in_GB=None, num_processes=None, queue_size=None,
+                transport='queue', pool=None):
+    """ Apply function f to chunks of the scan and yield results in frame order.
+
+    Same as map_frames but results are yielded as soon as all chunks before them have
+    been processed, so callers can reduce them (or write them to disk) incrementally
+    rather than holding the results for the entire scan in memory.
+
+    f should append one result per chunk and each result should start with the frames
+    slice of the chunk, e.g., (frames, y_shifts, x_shifts); all parallel_* functions
+    that return frames do. See map_frames for an explanation of the arguments.
+
+    :returns: Generator of results ordered by frames.
+    """
+    import threading
+    import queue
 
-#    # Sequential (returns a generator)
-#    for i in range(0, num_frames, chunk_size):
-#        yield f(scan[field_id, y, x, channel, i: i + chunk_size])
+    # Set chunk size, number of processes and queue size
+    pool = pool or get_worker_pool()
+    chunk_size_in_GB, num_processes, queue_size = _tune_map_params(scan, field_id, y, x,
+        channel, chunk_size_in_GB, num_processes, queue_size, pool)
+    print('Using', num_processes, 'processes')
 
-    # Create a Queue to put in new chunks and a list for results
-    manager = mp.Manager()
-    chunks = manager.Queue(maxsize=queue_size)
-    results = manager.list()
+    # Calculate the number of frames per chunk
+    chunk_size = _compute_chunk_size(scan, field_id, y, x, channel, chunk_size_in_GB)
+    all_frames = _split_frames(scan.num_frames, chunk_size)
 
-    # Start workers (will lock until data appears in chunks)
-    pool = []
-    for i in range(num_processes):
-        p = mp.Process(target=f, args=(chunks, results), kwargs=kwargs)
-        p.start()
-        pool.append(p)
+    # Create a Queue to put in new chunks and another one for results
+    chunks = _make_chunk_queue(pool.manager, transport, queue_size, num_processes, scan,
+                               chunk_size_in_GB)
+    results = ResultsQueue(pool.manager)
 
-    # Produce data
-    num_frames = scan.num_frames
-    for i in range(0, num_frames, chunk_size):
-        frames = slice(i, min(i + chunk_size, num_frames))
-        chunks.put((frames, scan[field_id, y, x, channel, frames])) # frames, chunk tuples
-        # chunks.put(((field_id, y, x, channel, frames), scan.filenames)) # scan_slices, filenames tuples
+    # Start workers (will lock until data appears in chunks)
+    job_id = pool.submit(f, chunks, results, kwargs, num_processes)
+
+    # Produce data in a separate thread (so we can consume results meanwhile)
+    cancelled = threading.Event()
+    producer_errors = [] # exception raised in the producer (e.g., reading the scan)
+    def check_cancelled():
+        if cancelled.is_set():
+            raise PipelineException('imap_frames was cancelled.')
+    def produce():
+        try:
+            _produce_frames(chunks, scan, field_id, y, x, channel, all_frames, transport,
+                            num_processes, check_cancelled)
+        except BaseException as e:
+            if not cancelled.is_set():
+                producer_errors.append(e)
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+
+    try:
+        # Yield results in order (as soon as all previous chunks are done)
+        pending = {} # frames.start: result, for results that arrived out of order
+        next_frame = 0
+        num_deaths = pool.num_deaths
+        for i in range(len(all_frames)):
+            while next_frame not in pending:
+                try:
+                    result = results.get(timeout=1)
+                    pending[result[0].start] = result
+                except queue.Empty:
+                    if producer_errors: # workers are waiting for chunks that won't come
+                        raise producer_errors[0]
+                    pool.check(job_id) # raises if workers failed
+                    if pool.num_deaths > num_deaths: # chunks are not requeued here
+                        raise PipelineException('A worker process died; results of its '
+                                                'chunk were lost.')
+            result = pending.pop(next_frame)
+            next_frame = result[0].stop
+            yield result
+
+        # Wait for processes to finish
+        producer.join()
+        pool.wait(job_id)
+    except BaseException: # includes GeneratorExit if caller stops early
+        cancelled.set()
+        producer.join() # stops before its next chunk
+        pool.cancel(job_id, chunks) # stop only this job, the pool is shared
+        raise
+    finally:
+        _close_chunk_queue(chunks)
+
+
+def fuse_frames(kernels, scan, field_id, channel, y=slice(None), x=slice(None),
+                **map_kwargs):
+    """ Apply several functions to each chunk of the scan reading the scan only once.
+
+    Each kernel is one of the parallel_* functions (or any function with the same
+    signature) plus its kwargs and, optionally, its output arrays, so outputs that
+    would need separate passes over the same field (e.g., summary images and
+    fluorescence traces) are computed in a single pass. In each worker, kernels run in
+    their own threads and get their own copy of every chunk (most of them correct it in
+    place).
+
+    :param dict kernels: Dictionary with name: kernel pairs. Each kernel is a dictionary
+        with keys:
+            f: Function to apply (as in map_frames).
+            kwargs: Optional dictionary with kwargs passed to f.
+            outputs: Optional dictionary with name: (shape, dtype) pairs. Passed to f
+                (as in map_frames).
+    :param Scan scan: An scan object as returned by scanreader.
+    :param int field_id: Which field to use: 0-based.
+    :param int channel: Which channel to read. 0-based.
+    :param slice y: How to slice the scan in y.
+    :param slice x: How to slice the scan in x.
+    :param dict map_kwargs: Other arguments passed to map_frames (chunk_size_in_GB, ...).
 
-    # Queue STOP signal
-    for i in range(num_processes):
-        chunks.put((None, None))
+    :returns: Dictionary with name: output pairs. Output is what map_frames would return
+        for that kernel: a list of results or, if the kernel has outputs, a (results,
+        outputs) tuple.
+    """
+    # Send only what workers need
+    worker_kernels = {name: {'f': kernel['f'], 'kwargs': kernel.get('kwargs', {}),
+                             'has_outputs': 'outputs' in kernel}
+                      for name, kernel in kernels.items()}
+    outputs = {name + '/' + k: spec for name, kernel in kernels.items() for k, spec in
+               kernel.get('outputs', {}).items()} # one set of arrays per kernel
+
+    # Map
+    results = map_frames(parallel_fused, scan, field_id=field_id, channel=channel, y=y,
+                         x=x, kwargs={'kernels': worker_kernels},
+                         outputs=outputs if outputs else None, **map_kwargs)
+    results, outputs = results if outputs else (results, {})
+
+    # Split results (and outputs) per kernel
+    fused = {}
+    for name, kernel in kernels.items():
+        kernel_results = [result for name_, result in results if name_ == name]
+        if 'outputs' in kernel:
+            prefix = name + '/'
+            kernel_outputs = {k[len(prefix):]: v for k, v in outputs.items() if
+                              k.startswith(prefix)}
+            fused[name] = (kernel_results, kernel_outputs)
+        else:
+            fused[name] = kernel_results
+
+    return fused
+
+
+class _KernelQueue:
+    """ Hands the chunks read by parallel_fused to one kernel (running in a thread).
+
+    put() waits until the kernel is done with the previous chunk, i.e., until it asks
+    for the next one (or returns).
+    """
+    def __init__(self):
+        import threading
+
+        self._condition = threading.Condition()
+        self._item = None # next (label, chunk) tuple
+        self._busy = False # whether the kernel is working on a chunk
+        self.finished = False # whether the kernel returned (or raised)
+
+    def _is_idle(self):
+        return (self._item is None and not self._busy) or self.finished
+
+    def put(self, item):
+        with self._condition:
+            self._condition.wait_for(self._is_idle)
+            if not self.finished:
+                self._item = item
+                self._condition.notify_all()
+
+    def get(self):
+        with self._condition:
+            self._busy = False # done with the previous chunk
+            self._condition.notify_all()
+            self._condition.wait_for(lambda: self._item is not None)
+            item, self._item = self._item, None
+            self._busy = True
+            return item
+
+    def wait(self):
+        """ Wait until the kernel is done with the last chunk put."""
+        with self._condition:
+            self._condition.wait_for(self._is_idle)
+
+    def finish(self):
+        with self._condition:
+            self.finished = True
+            self._condition.notify_all()
+
+
+class _KernelResults:
+    """ Appends (name, result) tuples of one kernel to the shared results list."""
+    def __init__(self, results, name, lock):
+        self.results = results
+        self.name = name
+        self.lock = lock # results of all kernels are appended from different threads
+
+    def append(self, result):
+        with self.lock:
+            self.results.append((self.name, result))
+
+
+class _KernelOutputs:
+    """ View of the SharedOutputs of one kernel in parallel_fused (names without prefix)."""
+    def __init__(self, outputs, prefix):
+        self.outputs = outputs
+        self.prefix = prefix
+        self.lock = outputs.lock
+
+    def __getitem__(self, name):
+        return self.outputs[self.prefix + name]
+
+
+def _run_kernel(f, chunks, results, kwargs, errors):
+    """ Run one kernel of parallel_fused (in its own thread)."""
+    try:
+        f(chunks, results, **kwargs)
+    except BaseException as e:
+        errors.append(e)
+    finally:
+        chunks.finish()
+
+
+def parallel_fused(chunks, results, kernels, outputs=None):
+    """ Apply several parallel_* functions to each chunk. Used by fuse_frames.
 
-    # Wait for processes to finish
-    for p in pool:
-        p.join()
+    :param queue chunks: Queue with inputs to consume.
+    :param list results: Where to put results.
+    :param dict kernels: Dictionary with name: {'f', 'kwargs', 'has_outputs'} pairs. See
+        fuse_frames.
+    :param SharedOutputs outputs: Outputs of all kernels (named kernel_name/output_name).
 
-    return list(results)
+    :returns: (name, result) tuples. One per result of each kernel.
+    """
+    import threading
+
+    # Start kernels (they lock until we give them a chunk)
+    lock = threading.Lock()
+    queues, threads, errors = [], [], []
+    for name, kernel in kernels.items():
+        kwargs = dict(kernel['kwargs'])
+        if kernel['has_outputs']:
+            kwargs['outputs'] = _KernelOutputs(outputs, name + '/')
+        queue = _KernelQueue()
+        thread = threading.Thread(target=_run_kernel, args=(kernel['f'], queue,
+            _KernelResults(results, name, lock), kwargs, errors), daemon=True)
+        thread.start()
+        queues.append(queue)
+        threads.append(thread)
+
+    try:
+        while True:
+            # Read next chunk (process locks until something can be read)
+            frames, chunk = chunks.get()
+
+            # Give each kernel its own copy and wait for all of them to be done with it
+            for i, queue in enumerate(queues):
+                is_last = chunk is None or i == len(queues) - 1
+                queue.put((frames, chunk if is_last else chunk.copy()))
+            for queue in queues:
+                queue.wait()
+            if errors:
+                raise errors[0]
+
+            if chunk is None:  # stop signal when all chunks have been processed
+                return
+    finally:
+        for queue in queues: # stop kernels that are still running (if one raised)
+            queue.put((None, None))
+        for thread in threads:
+            thread.join()
+
+
+class _WorkBuffers:
+    """ Float32 working arrays reused across the chunks processed by one worker.
+
+    Avoids allocating (and promoting to float64) new full-size temporaries for every
+    chunk, so the memory used by a worker stays close to the size of its chunk.
+
+    :param np.dtype dtype: Data type of the buffers returned by get().
+    """
+    def __init__(self, dtype=np.float32):
+        self.buffers = {} # name: flat array
+        self.dtype = dtype
+
+    def get(self, name, shape):
+        """ Returns an array (of self.dtype) with this shape (contents are undefined)."""
+        size = int(np.prod(shape))
+        if name not in self.buffers or self.buffers[name].size < size:
+            self.buffers.pop(name, None) # free old buffer before allocating a new one
+            self.buffers[name] = np.empty(size, dtype=self.dtype)
+        return self.buffers[name][:size].reshape(shape)
+
+    def as_float32(self, chunk):
+        """ Chunk as a float32 array that can be modified in place.
+
+        Writable float32 chunks are returned as is (workers own their chunk until the
+        next chunks.get()); anything else is copied into a reused buffer.
+        """
+        if chunk.dtype == np.float32 and chunk.flags.writeable:
+            return chunk
+        buffer = self.get('chunk', chunk.shape)
+        np.copyto(buffer, chunk, casting='unsafe')
+        return buffer
 
 
 def parallel_quality_metrics(chunks, results):
@@ -101,7 +1740,29 @@ def parallel_quality_metrics(chunks, results):
         results.append((frames, mean_intensity, contrast, mean_frame))
 
 
-def parallel_motion_shifts(chunks, results, raster_phase, fill_fraction, template):
+def reduce_quality_metrics(results, num_frames):
+    """ Reduce results of parallel_quality_metrics.
+
+    :param list results: Results of parallel_quality_metrics.
+    :param int num_frames: Number of frames in the scan.
+
+    :returns: Mean intensity per frame, contrast per frame and summary frames (h x w x
+        16), i.e., mean frame of 16 blocks of the scan.
+    """
+    mean_intensities = np.zeros(num_frames)
+    contrasts = np.zeros(num_frames)
+    for frames, chunk_mis, chunk_contrasts, _ in results:
+        mean_intensities[frames] = chunk_mis
+        contrasts[frames] = chunk_contrasts
+    sorted_results = sorted(results, key=lambda res: res[0].start)
+    mean_groups = np.array_split([r[3] for r in sorted_results], 16) # 16 groups
+    summary_frames = np.stack([np.mean(g, axis=0) for g in mean_groups if g.any()], axis=-1)
+
+    return mean_intensities, contrasts, summary_frames
+
+
+def parallel_motion_shifts(chunks, results, raster_phase, fill_fraction, template,
+                           max_y_shift=None, max_x_shift=None, outputs=None):
     """ Compute motion correction shifts to chunks of scan.
 
     Function to run in each process. Consumes input from chunks and writes results to
@@ -112,9 +1773,13 @@ def parallel_motion_shifts(chunks, results, raster_phase, fill_fraction, templat
     :param float raster_phase: Raster phase used for raster correction.
     :param float fill_fraction: Fill fraction used for raster correction.
     :param np.array template: Template used to compute motion shifts.
+    :param float max_y_shift/max_x_shift: Maximum shifts (in pixels) expected.
+    :param SharedOutputs outputs: If given, shifts are written to outputs['y_shifts']
+        and outputs['x_shifts'] (num_frames arrays) rather than added to results.
 
     :returns: (frames, y_shifts, x_shifts) tuples.
     """
+    buffers = _WorkBuffers()
     while True:
         # Read next chunk (process locks until something can be read)
         frames, chunk = chunks.get()
@@ -124,31 +1789,62 @@ def parallel_motion_shifts(chunks, results, raster_phase, fill_fraction, templat
         print(time.ctime(), 'Processing frames:', frames)
 
         # Correct raster
-        chunk = chunk.astype(np.float32, copy=False)
+        chunk = buffers.as_float32(chunk)
         if abs(raster_phase) > 1e-7:
             chunk = galvo_corrections.correct_raster(chunk, raster_phase, fill_fraction)
 
         # Compute shifts
-        y_shifts, x_shifts = galvo_corrections.compute_motion_shifts(chunk, template,
-                                                                     num_threads=1)
+        y_shifts, x_shifts = galvo_corrections.compute_motion_shifts_pyramid(
+            chunk, template, max_y_shift, max_x_shift, num_threads=1)
 
         # Add to results
-        results.append((frames, y_shifts, x_shifts))
+        if outputs is None:
+            results.append((frames, y_shifts, x_shifts))
+        else:
+            outputs['y_shifts'][frames] = y_shifts
+            outputs['x_shifts'][frames] = x_shifts
+
+
+def reduce_motion_shifts(results, num_frames):
+    """ Reduce results of parallel_motion_shifts.
+
+    :returns: (y_shifts, x_shifts) Two arrays (num_frames) with the y, x motion shifts.
+    """
+    y_shifts = np.zeros(num_frames)
+    x_shifts = np.zeros(num_frames)
+    for frames, chunk_y_shifts, chunk_x_shifts in results:
+        y_shifts[frames] = chunk_y_shifts
+        x_shifts[frames] = chunk_x_shifts
+
+    return y_shifts, x_shifts
+
+
+DEFAULT_SUMMARY_STATISTICS = ['mean', 'l6norm', 'correlation']
 
 
 def parallel_summary_images(chunks, results, raster_phase, fill_fraction, y_shifts,
-                            x_shifts):
-    """ Compute statistics used to compute correlation image and l-6 norm image.
+                            x_shifts, outputs=None, proxy_bin_size=None, proxy_factor=4,
+                            statistics=DEFAULT_SUMMARY_STATISTICS):
+    """ Compute summary statistics (e.g., average, correlation and l-6 norm images).
+
+    All statistics are computed in a single read of the scan.
 
     :param queue chunks: Queue with inputs to consume.
     :param list results: Where to put results.
     :param float raster_phase: Raster phase used for raster correction.
     :param float fill_fraction: Fill fraction used for raster correction.
     :param np.array y_shifts, x_shifts: Motion shifts to correct scan.
-
-    :returns: Sum per pixel, Sum of squared values per pixel, sum of the product of each
-        pixel with its 8 neighbors and sum of values of each pixel to the 6th power.
+    :param SharedOutputs outputs: If given, statistics are accumulated in outputs
+        (see summary_outputs) rather than added to results.
+    :param int proxy_bin_size: If given, the corrected frames are also summed in bins of
+        proxy_bin_size frames and proxy_factor x proxy_factor pixels in outputs['proxy']
+        (see summary_outputs and reduce_proxy_movie). Requires outputs.
+    :param int proxy_factor: Spatial downsampling factor of the proxy movie.
+    :param list statistics: Names of the statistics to compute (see SUMMARY_STATISTICS).
+
+    :returns: Dictionary with name: SummaryStatistic of each chunk (added to results).
     """
+    buffers = _WorkBuffers()
     while True:
         # Read next chunk (process locks until something can be read)
         frames, chunk = chunks.get()
@@ -159,36 +1855,396 @@ def parallel_summary_images(chunks, results, raster_phase, fill_fraction, y_shif
 
         # Correct field
         chunk = _correct_field(chunk, raster_phase, fill_fraction, x_shifts[frames],
-                               y_shifts[frames])
+                               y_shifts[frames], buffers=buffers)
 
-        # Compute sum and l6-norm
-        chunk_sum = np.sum(chunk, axis=-1, dtype=float)
-        chunk -= chunk.min()
-        chunk_l6norm = np.sum(chunk**6, axis=-1, dtype=float)
+        # Add frames to the proxy movie (before chunk is modified in place)
+        if proxy_bin_size is not None:
+            bins = np.arange(len(y_shifts))[frames] // proxy_bin_size
+            proxy_sums = _sum_proxy_bins(chunk, bins, proxy_factor)
+            with outputs.lock:
+                outputs['proxy'][..., np.unique(bins)] += proxy_sums
 
-        # Subtract overall brightness per frame
-        chunk -= chunk.mean(axis=(0, 1))
+        # Compute statistics
+        chunk_statistics = {}
+        for name in statistics:
+            statistic = get_summary_statistic(name)(*chunk.shape[:2])
+            chunk_statistics[name] = statistic.update(chunk, buffers=buffers)
 
-        # Compute sum_x and sum_x^2
-        chunk_sum2 = np.sum(chunk, axis=-1, dtype=float)
-        chunk_sqsum = np.sum(chunk**2, axis=-1, dtype=float)
+        # Save results
+        if outputs is None:
+            results.append(chunk_statistics)
+        else:
+            with outputs.lock:
+                for name, statistic in chunk_statistics.items():
+                    statistic.add_to(outputs, prefix=name + '.')
+
+
+def summary_outputs(image_height, image_width, num_proxy_frames=None, proxy_factor=4,
+                    statistics=DEFAULT_SUMMARY_STATISTICS):
+    """ Output specs for parallel_summary_images (to use in map_frames).
+
+    :param int num_proxy_frames: If given, also add the output for the proxy movie
+        (sums of each bin of frames, see parallel_summary_images).
+    :param int proxy_factor: Spatial downsampling factor of the proxy movie.
+    :param list statistics: Names of the statistics computed (see SUMMARY_STATISTICS).
+        Arrays of each statistic are named statistic.array, e.g., mean.sum.
+    """
+    specs = {}
+    for name in statistics:
+        statistic_specs = get_summary_statistic(name).specs(image_height, image_width)
+        specs.update({name + '.' + k: v for k, v in statistic_specs.items()})
+    if num_proxy_frames is not None:
+        proxy_shape = (image_height // proxy_factor, image_width // proxy_factor,
+                       num_proxy_frames)
+        specs['proxy'] = (proxy_shape, float)
+    return specs
+
+
+def _sum_proxy_bins(chunk, bins, factor):
+    """ Average chunk in blocks of factor x factor pixels and sum frames in each bin.
+
+    :param np.array chunk: (height x width x num_frames) chunk.
+    :param np.array bins: Bin of each frame (non-decreasing).
+    :param int factor: Spatial downsampling factor. Border pixels that do not fill a
+        block are dropped.
+
+    :returns: (height // factor x width // factor x num_bins) sums, one per unique bin.
+    """
+    height, width = chunk.shape[0] // factor, chunk.shape[1] // factor
+    blocks = chunk[:height * factor, :width * factor].reshape(height, factor, width,
+                                                               factor, -1)
+    small_chunk = blocks.mean(axis=(1, 3), dtype=float)
+    bin_starts = np.flatnonzero(np.diff(bins, prepend=-1))
+    return np.add.reduceat(small_chunk, bin_starts, axis=-1)
 
-        # Compute sum_xy: Multiply each pixel by its eight neighbors
-        chunk_xysum = np.zeros((chunk.shape[0], chunk.shape[1], 8))
-        for k in [0, 1, 2, 3]: # amount of 90 degree rotations
-            rotated_chunk = np.rot90(chunk, k=k)
-            rotated_xysum = np.rot90(chunk_xysum, k=k)
 
-            # Multiply each pixel by one above and by one above to the left
-            rotated_xysum[1:, :, k] = np.sum(rotated_chunk[1:] * rotated_chunk[:-1], axis=-1, dtype=float)
-            rotated_xysum[1:, 1:, 4 + k] = np.sum(rotated_chunk[1:, 1:] * rotated_chunk[:-1, :-1], axis=-1, dtype=float)
+def reduce_proxy_movie(proxy_sums, num_frames, bin_size):
+    """ Average the bins of the proxy movie computed by parallel_summary_images.
 
-            # Return back to original orientation
-            chunk = np.rot90(rotated_chunk, k=4 - k)
-            chunk_xysum = np.rot90(rotated_xysum, k=4 - k)
+    :param np.array proxy_sums: outputs['proxy'] of parallel_summary_images.
+    :param int num_frames: Number of frames in the scan.
+    :param int bin_size: Number of frames per bin (proxy_bin_size).
+
+    :returns: (height x width x num_bins) float32 proxy movie.
+    """
+    counts = np.minimum(bin_size, num_frames - np.arange(proxy_sums.shape[-1]) * bin_size)
+    return (proxy_sums / counts).astype(np.float32)
+
+
+def reduce_summary_images(results, statistics=DEFAULT_SUMMARY_STATISTICS):
+    """ Reduce results of parallel_summary_images.
+
+    :param list results: Results of parallel_summary_images or a dictionary with the
+        accumulated outputs (if run with outputs).
+    :param list statistics: Names of the statistics computed (see SUMMARY_STATISTICS).
+
+    :returns: Dictionary with the image of each statistic, e.g., mean (average image),
+        l6norm (l6-norm image) and correlation (average temporal correlation of each pixel
+        with its eight neighbors).
+    """
+    images = {}
+    for name in statistics:
+        if isinstance(results, dict):
+            prefix = name + '.'
+            arrays = {k[len(prefix):]: v for k, v in results.items() if k.startswith(prefix)}
+            statistic = get_summary_statistic(name).from_arrays(arrays)
+        else:
+            statistic = functools.reduce(SummaryStatistic.merge, [r[name] for r in results])
+        images[name] = statistic.image()
+
+    return images
 
-        # Save results
-        results.append((chunk_sum, chunk_l6norm, chunk_sum2, chunk_sqsum, chunk_xysum))
+
+SUMMARY_STATISTICS = {} # name: SummaryStatistic subclass
+
+
+def summary_statistic(name):
+    """ Class decorator that registers a SummaryStatistic in SUMMARY_STATISTICS.
+
+    Registered statistics can be computed by parallel_summary_images (and SummaryImages,
+    see config['performance.summary_statistics']) without a new worker function.
+    """
+    def register(cls):
+        SUMMARY_STATISTICS[name] = cls
+        return cls
+    return register
+
+
+def get_summary_statistic(name):
+    """ SummaryStatistic registered with this name."""
+    if name not in SUMMARY_STATISTICS:
+        raise PipelineException('Unknown summary statistic {}. Available: {}'.format(
+            name, ', '.join(SUMMARY_STATISTICS)))
+    return SUMMARY_STATISTICS[name]
+
+
+class SummaryStatistic:
+    """ Streaming statistic of each pixel over time.
+
+    A statistic accumulates some named float64 arrays (see specs) that always include the
+    number of frames (num_frames). chunk_arrays() computes the arrays of one chunk of
+    frames, merge_arrays() combines the arrays of different frames (in place, so it also
+    works on SharedOutputs) and image() computes the final image. By default, arrays are
+    added when merged (or their maximum taken if listed in MAXIMA); subclasses override
+    merge_arrays for other reductions.
+
+    :param int image_height, image_width: Image dimensions.
+    """
+    ARRAYS = [] # names of the (height x width) arrays accumulated
+    MAXIMA = [] # arrays merged with their maximum rather than their sum
+
+    def __init__(self, image_height, image_width):
+        self.arrays = {name: np.zeros(shape, dtype=dtype) for name, (shape, dtype) in
+                       self.specs(image_height, image_width).items()}
+
+    @classmethod
+    def specs(cls, image_height, image_width):
+        """ Arrays accumulated by the statistic (name: (shape, dtype))."""
+        specs = {'num_frames': (1, float)}
+        specs.update({name: ((image_height, image_width), float) for name in cls.ARRAYS})
+        return specs
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """ Statistic with these accumulated arrays (e.g., outputs of map_frames)."""
+        statistic = cls(*np.shape(arrays[cls.ARRAYS[0]])[-2:])
+        for name in statistic.arrays:
+            statistic.arrays[name] = np.array(arrays[name], dtype=float)
+        return statistic
+
+    @property
+    def num_frames(self):
+        return int(self.arrays['num_frames'][0])
+
+    def chunk_arrays(self, chunk, buffers):
+        """ Arrays of a (height x width x num_frames) chunk. Should not modify chunk.
+
+        :param np.array chunk: Chunk of frames.
+        :param _WorkBuffers buffers: Float32 working arrays that can be reused.
+        """
+        raise NotImplementedError('Summary statistics should define chunk_arrays')
+
+    def image(self):
+        """ Final image (height x width)."""
+        raise NotImplementedError('Summary statistics should define image')
+
+    @classmethod
+    def merge_arrays(cls, into, arrays):
+        """ Merge arrays (of other frames) into the arrays in into (in place)."""
+        is_empty = into['num_frames'][0] == 0
+        for name, array in arrays.items():
+            if name in cls.MAXIMA:
+                into[name][...] = array if is_empty else np.maximum(into[name], array)
+            else:
+                into[name][...] += array
+
+    def update(self, chunk, buffers=None):
+        """ Add a chunk of frames (height x width x num_frames). Returns self."""
+        buffers = _WorkBuffers() if buffers is None else buffers
+        arrays = self.chunk_arrays(chunk, buffers)
+        self.merge_arrays(self.arrays, {'num_frames': chunk.shape[-1], **arrays})
+        return self
+
+    def merge(self, other):
+        """ Add the frames accumulated in other (in place). Returns self."""
+        self.merge_arrays(self.arrays, other.arrays)
+        return self
+
+    def add_to(self, outputs, prefix=''):
+        """ Merge into the arrays in outputs (see summary_outputs). Use outputs.lock."""
+        self.merge_arrays({name: outputs[prefix + name] for name in self.arrays},
+                          self.arrays)
+
+
+@summary_statistic('mean')
+class Mean(SummaryStatistic):
+    """ Average of each pixel."""
+    ARRAYS = ['sum']
+
+    def chunk_arrays(self, chunk, buffers):
+        return {'sum': np.sum(chunk, axis=-1, dtype=float)}
+
+    def image(self):
+        return self.arrays['sum'] / self.num_frames
+
+
+@summary_statistic('max')
+class Max(SummaryStatistic):
+    """ Maximum projection."""
+    ARRAYS = ['max']
+    MAXIMA = ['max']
+
+    def chunk_arrays(self, chunk, buffers):
+        return {'max': chunk.max(axis=-1)}
+
+    def image(self):
+        return self.arrays['max']
+
+
+@summary_statistic('l6norm')
+class L6Norm(SummaryStatistic):
+    """ l6-norm of each pixel (after subtracting the minimum of each chunk)."""
+    ARRAYS = ['l6sum']
+
+    def chunk_arrays(self, chunk, buffers):
+        tmp = buffers.get('tmp', chunk.shape)
+        np.subtract(chunk, chunk.min(), out=tmp, casting='unsafe')
+        np.power(np.square(tmp, out=tmp), 3, out=tmp)
+        return {'l6sum': np.sum(tmp, axis=-1, dtype=float)}
+
+    def image(self):
+        return self.arrays['l6sum'] ** (1 / 6)
+
+
+class _CentralMoments(SummaryStatistic):
+    """ Mean and second and third central moments (sums of powers of the deviations from
+    the mean) of each pixel. Chunks are merged with the pairwise update of Chan et al.
+    (more stable than accumulating raw powers)."""
+    ARRAYS = ['mean', 'm2', 'm3']
+
+    def chunk_arrays(self, chunk, buffers):
+        mean = np.mean(chunk, axis=-1, dtype=float)
+        deviations = buffers.get('centered', chunk.shape)
+        np.subtract(chunk, mean[..., None], out=deviations, casting='unsafe')
+        tmp = np.square(deviations, out=buffers.get('tmp', chunk.shape))
+        m2 = np.sum(tmp, axis=-1, dtype=float)
+        m3 = np.sum(np.multiply(tmp, deviations, out=tmp), axis=-1, dtype=float)
+        return {'mean': mean, 'm2': m2, 'm3': m3}
+
+    @classmethod
+    def merge_arrays(cls, into, arrays):
+        n1, n2 = into['num_frames'][0], np.squeeze(arrays['num_frames'])
+        n = max(n1 + n2, 1)
+        delta = arrays['mean'] - into['mean']
+        into['m3'][...] += (arrays['m3'] + delta ** 3 * n1 * n2 * (n1 - n2) / n ** 2 +
+                            3 * delta * (n1 * arrays['m2'] - n2 * into['m2']) / n)
+        into['m2'][...] += arrays['m2'] + delta ** 2 * n1 * n2 / n
+        into['mean'][...] += delta * n2 / n
+        into['num_frames'][...] += n2
+
+
+@summary_statistic('std')
+class Std(_CentralMoments):
+    """ Standard deviation of each pixel."""
+    def image(self):
+        return np.sqrt(self.arrays['m2'] / self.num_frames)
+
+
+@summary_statistic('skewness')
+class Skewness(_CentralMoments):
+    """ Skewness of each pixel (high for pixels with sparse transients)."""
+    def image(self):
+        m2, m3 = self.arrays['m2'], self.arrays['m3']
+        return np.sqrt(self.num_frames) * m3 / m2 ** 1.5
+
+
+@summary_statistic('pnr')
+class PeakToNoise(SummaryStatistic):
+    """ Peak-to-noise ratio: (max - mean) / noise of each pixel. Noise is the standard
+    deviation of the differences between consecutive frames (divided by sqrt(2)); the
+    differences across chunks are not used."""
+    ARRAYS = ['max', 'sum', 'sum_sqdiff']
+    MAXIMA = ['max']
+
+    @classmethod
+    def specs(cls, image_height, image_width):
+        return {**super().specs(image_height, image_width), 'num_diffs': (1, float)}
+
+    def chunk_arrays(self, chunk, buffers):
+        diffs = np.subtract(chunk[..., 1:], chunk[..., :-1],
+                            out=buffers.get('tmp', chunk[..., 1:].shape), casting='unsafe')
+        return {'max': chunk.max(axis=-1), 'sum': np.sum(chunk, axis=-1, dtype=float),
+                'sum_sqdiff': np.sum(np.square(diffs, out=diffs), axis=-1, dtype=float),
+                'num_diffs': chunk.shape[-1] - 1}
+
+    def image(self):
+        noise = np.sqrt(self.arrays['sum_sqdiff'] / (2 * self.arrays['num_diffs'][0]))
+        return (self.arrays['max'] - self.arrays['sum'] / self.num_frames) / noise
+
+
+@summary_statistic('correlation')
+class LocalCorrelation(SummaryStatistic):
+    """ Average temporal correlation of each pixel with its (up to) eight neighbors.
+
+    Accumulates, after subtracting the mean of each frame (if center_frames), the sum
+    (sum_x), sum of squares (sum_sqx) and sum of products with the neighbors below, to
+    the right, below to the right and below to the left (sum_xy, 4 x height x width; each
+    pair of neighbors is stored once, at the position of the upper/left pixel).
+
+    :param bool center_frames: Whether to subtract the mean of each frame (overall
+        brightness) before computing the moments.
+    :param np.dtype dtype: Data type of the centered chunk and products summed in each
+        chunk. float32 (the default) halves the memory used by workers; use float64 for
+        exact results (e.g., enhancement.create_correlation_image).
+    """
+    ARRAYS = ['sum_x', 'sum_sqx']
+    NEIGHBORS = [(1, 0), (0, 1), (1, 1), (1, -1)] # (dy, dx) of each neighbor in sum_xy
+
+    def __init__(self, image_height, image_width, center_frames=True, dtype=np.float32):
+        super().__init__(image_height, image_width)
+        self.center_frames = center_frames
+        self._buffers = None if dtype == np.float32 else _WorkBuffers(dtype)
+
+    @classmethod
+    def specs(cls, image_height, image_width):
+        return {**super().specs(image_height, image_width),
+                'sum_xy': ((len(cls.NEIGHBORS), image_height, image_width), float)}
+
+    @staticmethod
+    def _pair_slices(offset, length):
+        """ Slices of pixels and their neighbors (offset positions away) in one axis."""
+        if offset >= 0:
+            return slice(0, length - offset), slice(offset, length)
+        else:
+            return slice(-offset, length), slice(0, length + offset)
+
+    def chunk_arrays(self, chunk, buffers):
+        buffers = self._buffers or buffers # own buffers if not float32
+
+        # Subtract overall brightness per frame
+        centered = buffers.get('centered', chunk.shape)
+        if self.center_frames:
+            np.subtract(chunk, chunk.mean(axis=(0, 1)), out=centered, casting='unsafe')
+        else:
+            np.copyto(centered, chunk, casting='unsafe')
+
+        # Compute sum_x and sum_x^2
+        sum_x = np.sum(centered, axis=-1, dtype=float)
+        sum_sqx = np.sum(np.square(centered, out=buffers.get('tmp', chunk.shape)),
+                         axis=-1, dtype=float)
+
+        # Compute sum_xy: Multiply each pixel by its neighbors (below and to the right)
+        height, width = chunk.shape[:2]
+        sum_xy = np.zeros((len(self.NEIGHBORS), height, width))
+        for neighbor_sum_xy, (dy, dx) in zip(sum_xy, self.NEIGHBORS):
+            (ys, neighbor_ys), (xs, neighbor_xs) = (self._pair_slices(dy, height),
+                                                    self._pair_slices(dx, width))
+            products = np.multiply(centered[ys, xs], centered[neighbor_ys, neighbor_xs],
+                                   out=buffers.get('tmp', centered[ys, xs].shape))
+            neighbor_sum_xy[ys, xs] = np.sum(products, axis=-1, dtype=float)
+
+        return {'sum_x': sum_x, 'sum_sqx': sum_sqx, 'sum_xy': sum_xy}
+
+    def image(self):
+        n, sum_x = self.num_frames, self.arrays['sum_x']
+        height, width = sum_x.shape
+        denom_factor = np.sqrt(n * self.arrays['sum_sqx'] - sum_x ** 2)
+
+        sum_corrs = np.zeros((height, width))
+        num_neighbors = np.zeros((height, width))
+        for sum_xy, (dy, dx) in zip(self.arrays['sum_xy'], self.NEIGHBORS):
+            (ys, neighbor_ys), (xs, neighbor_xs) = (self._pair_slices(dy, height),
+                                                    self._pair_slices(dx, width))
+            corrs = ((n * sum_xy[ys, xs] - sum_x[ys, xs] * sum_x[neighbor_ys, neighbor_xs]) /
+                     (denom_factor[ys, xs] * denom_factor[neighbor_ys, neighbor_xs]))
+
+            # Each correlation counts for both pixels
+            sum_corrs[ys, xs] += corrs
+            sum_corrs[neighbor_ys, neighbor_xs] += corrs
+            num_neighbors[ys, xs] += 1
+            num_neighbors[neighbor_ys, neighbor_xs] += 1
+
+        return sum_corrs / num_neighbors
 
 
 def parallel_save_memmap(chunks, results, raster_phase, fill_fraction, y_shifts,
@@ -204,6 +2260,7 @@ def parallel_save_memmap(chunks, results, raster_phase, fill_fraction, y_shifts,
 
     :returns: Minimum value in chunk. As a side-effect it saves the memory mapped file.
     """
+    buffers = _WorkBuffers()
     while True:
         # Read next chunk (process locks until something can be read)
         frames, chunk = chunks.get()
@@ -214,7 +2271,7 @@ def parallel_save_memmap(chunks, results, raster_phase, fill_fraction, y_shifts,
 
         # Correct field
         chunk = _correct_field(chunk, raster_phase, fill_fraction, x_shifts[frames],
-                               y_shifts[frames])
+                               y_shifts[frames], buffers=buffers)
 
         # Save in mmap scan
         num_frames = chunk.shape[-1]
@@ -225,8 +2282,40 @@ def parallel_save_memmap(chunks, results, raster_phase, fill_fraction, y_shifts,
         results.append(chunk.min())
 
 
+def parallel_cache_field(chunks, results, raster_phase, fill_fraction, y_shifts,
+                         x_shifts, cached_field):
+    """ Correct scan and save it in the cache of corrected fields (see utils.caching).
+
+    :param queue chunks: Queue with inputs to consume.
+    :param list results: Where to put results.
+    :param float raster_phase: Raster phase used for raster correction.
+    :param float fill_fraction: Fill fraction used for raster correction.
+    :param np.array y_shifts, x_shifts: Motion shifts to correct scan.
+    :param np.array cached_field: Memory mapped file (num_frames x height x width) where
+        to write results.
+
+    :returns: Nothing. As a side-effect it saves the memory mapped file.
+    """
+    buffers = _WorkBuffers()
+    while True:
+        # Read next chunk (process locks until something can be read)
+        frames, chunk = chunks.get()
+        if chunk is None:  # stop signal when all chunks have been processed
+            return
+
+        print(time.ctime(), 'Processing frames:', frames)
+
+        # Correct field
+        chunk = _correct_field(chunk, raster_phase, fill_fraction, x_shifts[frames],
+                               y_shifts[frames], buffers=buffers)
+
+        # Save in cache (frames first)
+        cached_field[frames] = np.moveaxis(chunk, -1, 0)
+        cached_field.flush()
+
+
 def parallel_fluorescence(chunks, results, raster_phase, fill_fraction, y_shifts,
-                         x_shifts, mask_pixels, mask_weights):
+                         x_shifts, mask_pixels, mask_weights, outputs=None):
     """ Correct scan and compute fluorescence traces for the given masks.
 
     :param queue chunks: Queue with inputs to consume.
@@ -238,9 +2327,13 @@ def parallel_fluorescence(chunks, results, raster_phase, fill_fraction, y_shifts
         is defined. Indices start at 1 and mask has been flattened using F order (Matlab).
     :param list of np.array mask_weights. Each array is the corresponding weights for the
         indices passed in mask_pixels.
+    :param SharedOutputs outputs: If given, traces are written to outputs['traces']
+        (num_masks x num_frames) rather than added to results.
 
     :returns: (traces x num_frames) array. Traces for each mask in this chunk.
     """
+    buffers = _WorkBuffers()
+    masks = None # (pixel indices, normalized weights) per mask, created with first chunk
     while True:
         # Read next chunk (process locks until something can be read)
         frames, chunk = chunks.get()
@@ -251,23 +2344,46 @@ def parallel_fluorescence(chunks, results, raster_phase, fill_fraction, y_shifts
 
         # Correct field
         chunk = _correct_field(chunk, raster_phase, fill_fraction, x_shifts[frames],
-                               y_shifts[frames])
+                               y_shifts[frames], buffers=buffers)
 
         # Prepare some params
         image_height, image_width, num_frames = chunk.shape
         flat_chunk = chunk.reshape(-1, num_frames)
         num_masks = len(mask_pixels)
 
-        # Extract signal per mask
+        # Get pixels and weights of each mask (as C-ordered indices into flat_chunk)
+        if masks is None:
+            masks = []
+            for mp_, mw in zip(mask_pixels, mask_weights):
+                mask_as_vector = np.zeros(image_height * image_width, dtype=np.float32)
+                mask_as_vector[np.squeeze(mp_ - 1).astype(int)] = np.squeeze(mw)
+                mask = mask_as_vector.reshape(image_height, image_width, order='F')
+                indices = np.flatnonzero(mask)
+                weights = mask.ravel()[indices]
+                masks.append((indices, weights / weights.sum()))
+
+        # Extract signal per mask (weighted average of its pixels)
         traces = np.zeros([num_masks, num_frames], dtype=np.float32)
-        for i, (mp_, mw) in enumerate(zip(mask_pixels, mask_weights)):
-            mask_as_vector = np.zeros(image_height * image_width, dtype=np.float32)
-            mask_as_vector[np.squeeze(mp_ - 1).astype(int)] = np.squeeze(mw)
-            mask = mask_as_vector.reshape(image_height, image_width, order='F')
-            traces[i] = np.average(flat_chunk, weights=mask.ravel(), axis=0)
+        for i, (indices, weights) in enumerate(masks):
+            traces[i] = np.dot(weights, flat_chunk[indices])
 
         # Save results
-        results.append((frames, traces))
+        if outputs is None:
+            results.append((frames, traces))
+        else:
+            outputs['traces'][:, frames] = traces
+
+
+def reduce_fluorescence(results, num_masks, num_frames):
+    """ Reduce results of parallel_fluorescence.
+
+    :returns: (num_masks x num_frames) array with the fluorescence traces.
+    """
+    traces = np.zeros((num_masks, num_frames), dtype=np.float32)
+    for frames, chunk_traces in results:
+        traces[:, frames] = chunk_traces
+
+    return traces
 
 
 def parallel_correct_scan(chunks, results, raster_phase, fill_fraction, y_shifts,
@@ -298,12 +2414,32 @@ def parallel_correct_scan(chunks, results, raster_phase, fill_fraction, y_shifts
         results.append((frames, chunk))
 
 
-def _correct_field(field, raster_phase, fill_fraction, x_shifts, y_shifts):
-    """ Correct a single field. Utility function used in some other functions above."""
-    field = field.astype(np.float32, copy=False)
+def _correct_field(field, raster_phase, fill_fraction, x_shifts, y_shifts,
+                   motion_method='bilinear', buffers=None):
+    """ Correct a single field. Utility function used in some other functions above.
+
+    Corrections are done in place in float32. If buffers (_WorkBuffers) is given, fields
+    that are not float32 (or are read-only) are converted in a reused buffer; the
+    returned field may be that buffer, so it is only valid until the next call.
+    """
+    if buffers is None:
+        field = field.astype(np.float32, copy=False)
+    else:
+        field = buffers.as_float32(field)
     if abs(raster_phase) > 1e-7:
         field = galvo_corrections.correct_raster(field, raster_phase, fill_fraction) # raster
-    field  = galvo_corrections.correct_motion(field, x_shifts, y_shifts) # motion
+    if np.any(x_shifts) or np.any(y_shifts): # skipped for fields read from the cache
+        field = galvo_corrections.correct_motion(field, x_shifts, y_shifts,
+                                                 method=motion_method) # motion
+
+    return field
+
+
+def _anscombe(field):
+    """ Anscombe transform (2 * sqrt(x - min + 3/8)) of a float array, in place."""
+    field -= field.min() - 3 / 8
+    np.sqrt(field, out=field)
+    field *= 2
 
     return field
 
@@ -312,7 +2448,8 @@ def _correct_field(field, raster_phase, fill_fraction, x_shifts, y_shifts):
 ################################## Stacks ##############################################
 
 def map_fields(f, scan, field_ids, channel, y=slice(None), x=slice(None),
-               frames=slice(None), kwargs={}, num_processes=10, queue_size=10):
+               frames=slice(None), kwargs={}, num_processes=None, queue_size=None,
+               transport='queue', pool=None):
     """ Apply function f to each field in scan
 
     :param function f: Function that receives two positional arguments:
@@ -326,40 +2463,62 @@ def map_fields(f, scan, field_ids, channel, y=slice(None), x=slice(None),
     :param int channel: Which channel to read.
     :param slice frames: Frames to pass to f.
     :param dict kwargs: Dictionary with optional kwargs passed to f.
-    :param int num_processes: Number of processes to use for mapping.
+    :param int num_processes: Number of processes to use for mapping (at most the size
+        of the pool).
     :param int queue_size: Maximum size of the queue used to store chunks.
+        num_processes and queue_size are chosen by autotune_fields() (to fit in CPU and
+        memory limits) unless given.
+    :param string transport: How fields are sent to the workers. See map_frames.
+    :param WorkerPool pool: Pool of processes used for mapping. See map_frames.
 
     :returns list results: List with results per field. Order is not guaranteed.
     """
     # Basic checks
-    num_processes = min(num_processes, mp.cpu_count() - 1)
+    pool = pool or get_worker_pool()
+    num_processes, queue_size = _tune_field_params(scan, field_ids, y, x, channel, frames,
+                                                   num_processes, queue_size, pool)
     print('Using', num_processes, 'processes')
 
     # Create a Queue to put in new chunks and a list for results
-    manager = mp.Manager()
-    chunks = manager.Queue(maxsize=queue_size)
-    results = manager.list()
+    field_size_in_GB = 0
+    if transport == 'shared_memory' and len(field_ids) > 0: # to check /dev/shm size
+        num_frames = len(range(*frames.indices(scan.num_frames)))
+        field_size_in_GB = (_compute_bytes_per_frame(scan, field_ids[0], y, x, channel) *
+                            num_frames / 1024**3)
+    chunks = _make_chunk_queue(pool.manager, transport, queue_size, num_processes, scan,
+                               field_size_in_GB)
+    tracked_chunks = _TrackedChunks(chunks, pool.manager.list())
+    results = _TrackedResults(pool.manager.list(), tracked_chunks)
+    stats = ChunkStats('map_fields({})'.format(getattr(f, '__name__', f)),
+                       num_processes=num_processes, queue_size=queue_size,
+                       transport=transport)
 
     # Start workers (will lock until data appears in chunks)
-    pool = []
-    for i in range(num_processes):
-        p = mp.Process(target=f, args=(chunks, results), kwargs=kwargs)
-        p.start()
-        pool.append(p)
+    job_id = pool.submit(f, tracked_chunks, results, kwargs, num_processes)
+    check = functools.partial(pool.check, job_id)
 
-    # Produce data
-    for i, field_id in enumerate(field_ids):
-        chunks.put((i, scan[field_id, y, x, channel, frames])) # field_idx, field tuples
+    try:
+        # Produce data
+        for i, field_id in enumerate(field_ids): # field_idx, field tuples
+            scan_slices = (field_id, y, x, channel, frames)
+            stats.add_producer_stats({i: _put_chunk(tracked_chunks, i, scan, scan_slices,
+                                                    transport, check)})
 
-    # Queue STOP signal
-    for i in range(num_processes):
-        chunks.put((None, None))
+        # Queue STOP signal
+        for i in range(num_processes):
+            _put_checked(chunks, (None, None), check)
 
-    # Wait for processes to finish
-    for p in pool:
-        p.join()
+        # Wait for processes to finish
+        pool.wait(job_id)
+    except BaseException:
+        pool.cancel(job_id, tracked_chunks) # stop only this job, the pool is shared
+        raise
+    finally:
+        _close_chunk_queue(chunks)
+    stats.add_worker_stats(tracked_chunks.finished)
+    stats.report()
 
-    return list(results)
+    return [result for _, result in results.results]
 
 
 def parallel_quality_stack(chunks, results):
@@ -412,6 +2571,7 @@ def parallel_motion_stack(chunks, results, raster_phase, fill_fraction, skip_row
     """
     from scipy import ndimage
 
+    buffers = _WorkBuffers()
     while True:
         # Read next chunk (process locks until something can be read)
         field_idx, field = chunks.get()
@@ -421,12 +2581,12 @@ def parallel_motion_stack(chunks, results, raster_phase, fill_fraction, skip_row
         print(time.ctime(), 'Processing field:', field_idx)
 
         # Correct raster
-        field = field.astype(np.float32, copy=False)
+        field = buffers.as_float32(field)
         if abs(raster_phase) > 1e-7:
             field = galvo_corrections.correct_raster(field, raster_phase, fill_fraction)
 
-        # Apply anscombe transform
-        field = 2 * np.sqrt(field - field.min() + 3 / 8)
+        # Apply anscombe transform (in place)
+        _anscombe(field)
 
         # Compute correlation matrix between frames (ignoring edges)
         frames = np.reshape(field[skip_rows:-skip_rows, skip_cols:-skip_cols],
@@ -467,7 +2627,7 @@ def parallel_motion_stack(chunks, results, raster_phase, fill_fraction, skip_row
 
 
 def parallel_correct_stack(chunks, results, raster_phase, fill_fraction, y_shifts,
-                           x_shifts, apply_anscombe=False):
+                           x_shifts, apply_anscombe=False, motion_method='bilinear'):
     """ Apply corrections in parallel and return mean of corrected field over time.
 
     :param queue chunks: Queue with inputs to consume.
@@ -477,9 +2637,12 @@ def parallel_correct_stack(chunks, results, raster_phase, fill_fraction, y_shift
     :param np.array y_shifts: Array with shifts in y for all fields.
     :param np.array x_shifts: Array with shifts in x for all fields
     :param bool apply_anscombe: Whether to apply anscombe transform to the input.
+    :param string motion_method: 'bilinear' or 'fourier'. See
+        galvo_corrections.correct_motion.
 
     :returns: (field_id, corrected_field) tuples.
     """
+    buffers = _WorkBuffers()
     while True:
         # Read next chunk (process locks until something can be read)
         field_idx, field = chunks.get()
@@ -490,11 +2653,11 @@ def parallel_correct_stack(chunks, results, raster_phase, fill_fraction, y_shift
 
         # Correct field
         corrected = _correct_field(field, raster_phase, fill_fraction, x_shifts[field_idx],
-                                   y_shifts[field_idx])
+                                   y_shifts[field_idx], motion_method, buffers=buffers)
 
         # Apply anscombe transform
         if apply_anscombe:
-             corrected = 2 * np.sqrt(corrected - corrected.min() + 3 / 8)
+             _anscombe(corrected)
 
         # Average across time
         averaged = np.mean(corrected, axis=-1) if corrected.ndim > 2 else corrected
@@ -0,0 +1,256 @@
+""" Index of the pages in the tiff files of a scan.
+
+scanreader parses the ScanImage header and walks the chain of tiff pages (IFDs) in all
+files every time a scan is opened. read_scan() does this once per scan: it saves a
+snapshot of the header attributes and the offset of every page in
+config['cache.scan_index_dir'] and later returns an IndexedScan that reads pixels
+directly from those offsets (with np.memmap). The scan is only opened with scanreader if
+an attribute not in the snapshot is needed.
+
+The index is keyed by the name, size and modification time of the files, so it is built
+again if the files change. When it is built, the first and last frame of every field and
+channel are compared with those read by scanreader; if any differs, all pages are read
+with scanreader.
+"""
+import numpy as np
+import os
+import glob
+import pickle
+import hashlib
+import uuid
+
+HEADER_ATTRIBUTES = ['version', 'is_multiROI', 'num_channels', 'num_fields', 'num_frames',
+                     'num_requested_frames', 'num_scanning_depths', 'scanning_depths',
+                     'field_depths', 'field_heights', 'field_widths', 'field_slices',
+                     'field_rois', 'field_offsets', 'field_heights_in_microns',
+                     'field_widths_in_microns', 'image_height', 'image_width',
+                     'image_height_in_microns', 'image_width_in_microns', 'fps',
+                     'is_bidirectional', 'scanner_frequency', 'seconds_per_line',
+                     'temporal_fill_fraction', 'spatial_fill_fraction', 'zoom',
+                     'is_slow_stack', 'is_slow_stack_with_fastZ', 'num_rois', 'header',
+                     'fields', 'motor_position_at_zero', 'initial_secondary_z',
+                     '_x_angle_scale_factor', '_y_angle_scale_factor',
+                     '_num_fly_back_frames', '_num_averaged_frames']
+
+
+def index_pages(filenames):
+    """ Offsets of the pixel data of every page in the tiff files.
+
+    :param list filenames: Tiff files (in order).
+
+    :returns: Dictionary with file_ids, offsets (num_pages arrays), shapes (list of page
+        shapes, one per file) and dtypes (one per file). Offsets are -1 for pages whose
+        pixels are not stored uncompressed and contiguously.
+    """
+    import tifffile
+
+    file_ids, offsets, shapes, dtypes = [], [], [], []
+    for file_id, filename in enumerate(filenames):
+        with tifffile.TiffFile(filename) as tif:
+            first_page = tif.pages[0]
+            dtype = np.dtype(first_page.dtype).newbyteorder(tif.byteorder)
+            num_bytes = int(np.prod(first_page.shape)) * dtype.itemsize
+            for page in tif.pages:
+                page_offsets, bytecounts = page.dataoffsets, page.databytecounts
+                is_contiguous = (page.compression == 1 and page.shape == first_page.shape
+                                 and sum(bytecounts) == num_bytes and
+                                 all(o1 + b == o2 for o1, b, o2 in
+                                     zip(page_offsets, bytecounts, page_offsets[1:])))
+                file_ids.append(file_id)
+                offsets.append(page_offsets[0] if is_contiguous else -1)
+            shapes.append(first_page.shape)
+            dtypes.append(dtype.str)
+
+    return {'file_ids': np.array(file_ids, dtype=np.int32),
+            'offsets': np.array(offsets, dtype=np.int64), 'shapes': shapes,
+            'dtypes': dtypes}
+
+
+class IndexedScan:
+    """ Scan that reads pages directly from the offsets in the index.
+
+    Indexing follows scanreader (scan[field_id, y, x, channel, frames]) for integer
+    field_id and channel; other requests (or scans with compressed pages) are passed to
+    the scan opened with scanreader. Header attributes are taken from the snapshot in
+    the index.
+
+    :param list filenames: Tiff files of the scan.
+    :param np.dtype dtype: Data type of returned arrays (as in scanreader.read_scan).
+    :param dict header: Header attributes (HEADER_ATTRIBUTES) of the scan.
+    :param dict pages: Index of the pages as returned by index_pages.
+    """
+    def __init__(self, filenames, dtype, header, pages):
+        self.filenames = filenames
+        self.dtype = dtype
+        self.header_attributes = header
+        self.pages = pages
+        self._scan = None # opened (with scanreader) only if needed
+        self._files = {} # file_id: memmap of the file
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        header_attributes = self.__dict__.get('header_attributes', {})
+        if name in header_attributes:
+            return header_attributes[name]
+        return getattr(self._open_scan(), name)
+
+    def __getstate__(self):
+        return {k: v for k, v in self.__dict__.items() if k not in ['_scan', '_files']}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state, _scan=None, _files={})
+
+    def _open_scan(self):
+        if self._scan is None:
+            import scanreader
+            self._scan = scanreader.read_scan(self.filenames, dtype=self.dtype)
+        return self._scan
+
+    def _page(self, page_id):
+        """ Pixels of one page (a view of the memory mapped file)."""
+        file_id = self.pages['file_ids'][page_id]
+        if file_id not in self._files:
+            self._files[file_id] = np.memmap(self.filenames[file_id], dtype=np.uint8,
+                                             mode='r')
+        return np.ndarray(self.pages['shapes'][file_id], self.pages['dtypes'][file_id],
+                          buffer=self._files[file_id],
+                          offset=int(self.pages['offsets'][page_id]))
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key, )
+        field_id, y, x, channel, frames = key + (slice(None), ) * (5 - len(key))
+        if not all(isinstance(i, (int, np.integer)) for i in [field_id, channel]):
+            return self._open_scan()[key]
+
+        # Find pages of the field
+        frame_ids = np.arange(self.num_frames)[frames]
+        pages_per_frame = self.num_channels * (self.num_scanning_depths +
+                                               self._num_fly_back_frames)
+        if self.is_multiROI:
+            field = self.fields[field_id]
+            slice_id = field.slice_id
+        else:
+            slice_id = field_id
+        page_ids = (np.atleast_1d(frame_ids) * pages_per_frame + slice_id *
+                    self.num_channels + channel)
+        if np.any(self.pages['offsets'][page_ids] < 0): # compressed pages
+            return self._open_scan()[key]
+
+        # Read them
+        height, width = self.field_heights[field_id], self.field_widths[field_id]
+        out_shape = np.empty((height, width), dtype=bool)[y, x].shape
+        result = np.empty(out_shape + (len(page_ids), ), dtype=self.dtype)
+        for i, page_id in enumerate(page_ids):
+            page = self._page(page_id)
+            if self.is_multiROI:
+                image = np.empty((height, width), dtype=page.dtype)
+                for ys, xs, out_ys, out_xs in zip(field.yslices, field.xslices,
+                                                  field.output_yslices,
+                                                  field.output_xslices):
+                    image[out_ys, out_xs] = page[ys, xs]
+                page = image
+            result[..., i] = page[y, x]
+
+        return result[..., 0] if np.ndim(frame_ids) == 0 else result
+
+
+def _is_valid(indexed_scan, scan):
+    """ Whether pages read from the index match those read with scanreader.
+
+    :param IndexedScan indexed_scan: Scan reading pages from the index.
+    :param scan: Same scan opened with scanreader.
+
+    :returns: True if the first and last frame of every field and channel match.
+    """
+    if indexed_scan.header_attributes.get('_num_averaged_frames', 1) != 1:
+        return False
+    try:
+        for field_id in range(scan.num_fields):
+            for channel in range(scan.num_channels):
+                for frame in sorted({0, scan.num_frames - 1}):
+                    if not np.array_equal(indexed_scan[field_id, :, :, channel, frame],
+                                          scan[field_id, :, :, channel, frame]):
+                        return False
+    except Exception:
+        return False
+    return True
+
+
+def files_hash(filenames):
+    """ Hash of the name, size and modification time of the files (changes if any file
+    is modified)."""
+    md5 = hashlib.md5()
+    for filename in filenames:
+        stat = os.stat(filename)
+        md5.update('{}:{}:{}'.format(os.path.abspath(filename), stat.st_size,
+                                     stat.st_mtime).encode())
+    return md5.hexdigest()
+
+
+def _index_filename(filenames):
+    """ Index file for these files (changes if any file is modified)."""
+    from .. import config
+
+    return os.path.join(config['cache.scan_index_dir'], files_hash(filenames) + '.pkl')
+
+
+def read_scan(wildcard, dtype=np.int16, use_index=True):
+    """ Open the scan (as scanreader.read_scan) using its index if available.
+
+    Archived scans (see utils.archive) are read from their archive. Otherwise, files are
+    read from the staging cache if enabled (see utils.staging).
+
+    :param string wildcard: Tiff files of the scan (or a pattern matching them).
+    :param np.dtype dtype: Data type of returned arrays.
+    :param bool use_index: Whether to read pages from the index. If False (e.g., for
+        stacks), the scan is opened with scanreader.
+
+    :returns: ArchivedScan, IndexedScan or the scan opened with scanreader if the index
+        is disabled (config['cache.scan_index_dir'] is None).
+    """
+    import scanreader
+    from .. import config
+    from . import archive, staging
+
+    archive_filename = archive.archive_filename(wildcard)
+    if archive_filename is not None and os.path.isfile(archive_filename):
+        return archive.ArchivedScan(archive_filename, dtype)
+
+    wildcard = staging.stage(wildcard) # local copy (if staging is enabled)
+    if not use_index or config.get('cache.scan_index_dir') is None:
+        return scanreader.read_scan(wildcard, dtype=dtype)
+
+    # Load index
+    filenames = sorted(glob.glob(os.path.expanduser(wildcard)))
+    if not filenames:
+        return scanreader.read_scan(wildcard, dtype=dtype) # raises the usual error
+    index_filename = _index_filename(filenames)
+    try:
+        with open(index_filename, 'rb') as f:
+            header, pages = pickle.load(f)
+        return IndexedScan(filenames, dtype, header, pages)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        pass
+
+    # Build it
+    scan = scanreader.read_scan(filenames, dtype=dtype)
+    header = {}
+    for name in HEADER_ATTRIBUTES:
+        try:
+            header[name] = getattr(scan, name)
+        except Exception: # not defined for this kind of scan
+            pass
+    pages = index_pages(filenames)
+    indexed_scan = IndexedScan(filenames, dtype, header, pages)
+    indexed_scan._scan = scan
+    if not _is_valid(indexed_scan, scan): # check pages are where we expect them
+        pages['offsets'][:] = -1 # read all pages with scanreader
+
+    os.makedirs(config['cache.scan_index_dir'], exist_ok=True)
+    tmp_filename = '{}.{}.tmp'.format(index_filename, uuid.uuid4())
+    with open(tmp_filename, 'wb') as f:
+        pickle.dump((header, pages), f)
+    os.replace(tmp_filename, index_filename)
+
+    return indexed_scan
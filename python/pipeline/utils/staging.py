@@ -0,0 +1,160 @@
+""" Node-local staging cache of raw scan files.
+
+Scans are read from the network share (config['path.mounts']) by every job that needs
+them. stage() copies the files of a scan once to a local directory
+(config['cache.staging_dir']) and returns the local wildcard, so all processes in the node
+read the same local copy. Copies are made under a file lock (other jobs wait for it) and
+the least recently used scans are deleted to keep the directory under
+config['cache.staging_size_in_GB'] (the cap should leave room for all scans being
+processed in the node; a scan could otherwise be deleted while it is read).
+
+Staging is disabled unless config['cache.staging_dir'] is set. get_stats() returns the
+number of hits, misses, copied bytes and evictions.
+"""
+import os
+import glob
+import json
+import uuid
+import shutil
+import hashlib
+import fcntl
+from contextlib import contextmanager
+
+
+@contextmanager
+def _file_lock(filename, blocking=True):
+    """ Exclusive lock on filename (created if needed). Yields whether it was acquired."""
+    with open(filename, 'a') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _is_staged(filename, staged_filename):
+    """ Whether staged_filename is a complete copy of filename."""
+    try:
+        source, copy = os.stat(filename), os.stat(staged_filename)
+    except OSError:
+        return False
+    return source.st_size == copy.st_size and source.st_mtime == copy.st_mtime
+
+
+def _directory_size(directory):
+    return sum(os.path.getsize(os.path.join(directory, f)) for f in os.listdir(directory))
+
+
+def _update_stats(staging_dir, **increments):
+    """ Add increments to the counts in stats.json."""
+    stats_filename = os.path.join(staging_dir, 'stats.json')
+    with _file_lock(stats_filename + '.lock'):
+        stats = get_stats(staging_dir)
+        for name, value in increments.items():
+            stats[name] += value
+        with open(stats_filename + '.tmp', 'w') as f:
+            json.dump(stats, f)
+        os.replace(stats_filename + '.tmp', stats_filename)
+
+
+def get_stats(staging_dir=None):
+    """ Hits, misses, bytes_copied and evictions of the staging cache.
+
+    :param string staging_dir: Staging directory. Defaults to config['cache.staging_dir'].
+
+    :returns: Dictionary with the counts (since the directory was created).
+    """
+    from .. import config
+
+    staging_dir = staging_dir or config.get('cache.staging_dir')
+    stats = {'hits': 0, 'misses': 0, 'bytes_copied': 0, 'evictions': 0}
+    try:
+        with open(os.path.join(staging_dir, 'stats.json')) as f:
+            stats.update(json.load(f))
+    except (OSError, TypeError, ValueError): # no stats yet (or staging disabled)
+        pass
+    return stats
+
+
+def evict(staging_dir, max_size_in_GB, num_bytes=0, keep=None):
+    """ Delete least recently used scans until num_bytes more fit in the staging cache.
+
+    Scans being staged by other processes (and keep) are not deleted.
+
+    :returns: Number of scans deleted.
+    """
+    if max_size_in_GB is None:
+        return 0
+
+    scan_dirs = [os.path.join(staging_dir, d) for d in os.listdir(staging_dir)]
+    scan_dirs = sorted([d for d in scan_dirs if os.path.isdir(d)], key=os.path.getmtime)
+    sizes = [_directory_size(d) for d in scan_dirs]
+    max_bytes = max_size_in_GB * 1024**3 - num_bytes
+    total_bytes, num_evicted = sum(sizes), 0
+    for scan_dir, size in zip(scan_dirs, sizes):
+        if total_bytes <= max_bytes:
+            break
+        if scan_dir == keep:
+            continue
+        with _file_lock(scan_dir + '.lock', blocking=False) as is_locked:
+            if is_locked:
+                shutil.rmtree(scan_dir, ignore_errors=True)
+                total_bytes -= size
+                num_evicted += 1
+
+    return num_evicted
+
+
+def stage(wildcard):
+    """ Copy the files of the scan to the staging cache (if not there already).
+
+    :param string wildcard: Files of the scan, e.g., as returned by
+        experiment.Scan.local_filenames_as_wildcard.
+
+    :returns: Wildcard of the local copies (or the same wildcard if staging is disabled).
+    """
+    from .. import config
+
+    staging_dir = config.get('cache.staging_dir')
+    if staging_dir is None:
+        return wildcard
+    filenames = sorted(glob.glob(os.path.expanduser(wildcard)))
+    if not filenames:
+        return wildcard # let the reader raise the usual error
+
+    os.makedirs(staging_dir, exist_ok=True)
+    name = hashlib.md5(os.path.abspath(wildcard).encode()).hexdigest()
+    scan_dir = os.path.join(staging_dir, name)
+    with _file_lock(scan_dir + '.lock'): # wait if another process is copying it
+        os.makedirs(scan_dir, exist_ok=True)
+        missing = [f for f in filenames if not
+                   _is_staged(f, os.path.join(scan_dir, os.path.basename(f)))]
+        if missing:
+            # Make space
+            num_bytes = sum(os.path.getsize(f) for f in missing)
+            num_evicted = evict(staging_dir, config.get('cache.staging_size_in_GB'),
+                                num_bytes, keep=scan_dir)
+
+            # Copy (to a temporary file first so partial copies are never used)
+            print('Staging', len(missing), 'file(s) in', scan_dir)
+            for filename in missing:
+                staged_filename = os.path.join(scan_dir, os.path.basename(filename))
+                tmp_filename = '{}.{}.tmp'.format(staged_filename, uuid.uuid4())
+                try:
+                    shutil.copy2(filename, tmp_filename)
+                    os.replace(tmp_filename, staged_filename)
+                except BaseException:
+                    if os.path.exists(tmp_filename):
+                        os.remove(tmp_filename)
+                    raise
+            _update_stats(staging_dir, misses=1, bytes_copied=num_bytes,
+                          evictions=num_evicted)
+        else:
+            _update_stats(staging_dir, hits=1)
+        os.utime(scan_dir) # mark as recently used
+
+    return os.path.join(scan_dir, os.path.basename(wildcard))
@@ -35,8 +35,8 @@ for pipe in [reso, meso]:
     pipe.Quality.populate(next_scans, reserve_jobs=True, suppress_errors=True)
     pipe.RasterCorrection.populate(next_scans, reserve_jobs=True, suppress_errors=True)
     pipe.MotionCorrection.populate(next_scans, reserve_jobs=True, suppress_errors=True)
-    pipe.SummaryImages.populate(next_scans, reserve_jobs=True, suppress_errors=True)
     pipe.Segmentation.populate(next_scans, reserve_jobs=True, suppress_errors=True)
+    pipe.SummaryImages.populate(next_scans, reserve_jobs=True, suppress_errors=True) # also extracts traces
     pipe.Fluorescence.populate(next_scans, reserve_jobs=True, suppress_errors=True)
     pipe.MaskClassification.populate(next_scans, {'classification_method': 2},
                                      reserve_jobs=True, suppress_errors=True)
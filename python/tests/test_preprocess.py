@@ -1,25 +1,55 @@
 """ Test suite for pre processing routines."""
+import os
+import sys
+import glob
+import json
+import time
+import queue
+import threading
+import multiprocessing as mp
+from types import SimpleNamespace
 import numpy as np
+import pytest
 from numpy.testing import assert_allclose
-from pipeline.utils import galvo_corrections
+from scipy import ndimage, interpolate, stats
+from pipeline.exceptions import PipelineException
+from pipeline import config
+from pipeline.utils import (galvo_corrections, performance, online, caching, demux,
+                            scan_index, staging, archive, enhancement)
+
+@pytest.fixture
+def random_state():
+    """ Seeded random generator so tests with random inputs are reproducible."""
+    return np.random.RandomState(0)
+
+class FieldScan: # scanreader-like indexing of a (height x width x num_frames) field
+    def __init__(self, field):
+        self.field = field
+        self.num_frames = field.shape[-1]
+        self.frames_read = 0
+    def __getitem__(self, key):
+        chunk = self.field[key[1], key[2], key[4]]
+        self.frames_read += chunk.shape[-1] if chunk.ndim > 2 else 1
+        return chunk
 
 ##### Motion correction
 
 def test_motion_correction_type():
     # Double to double
     test_scan = np.double(np.arange(16).reshape([4, 4]))
-    result = galvo_corrections.correct_motion(test_scan, xy_motion=np.array([0.1, -0.1]))
+    result = galvo_corrections.correct_motion(test_scan, x_shifts=[0.1], y_shifts=[-0.1])
     assert (result.dtype == np.double), 'Motion correction is changing the scan dtype'
 
-    #int to double
+    #int to float
     test_scan = np.arange(16).reshape([4, 4])
-    result = galvo_corrections.correct_motion(test_scan, xy_motion=np.array([0.1, -0.1]))
-    assert (result.dtype == np.double), 'Motion correction is not changing the scan ' \
-                                        'dtype from int64 to double'
+    result = galvo_corrections.correct_motion(test_scan, x_shifts=[0.1], y_shifts=[-0.1])
+    assert (result.dtype == np.float32), 'Motion correction is not changing the scan ' \
+                                         'dtype from int64 to float32'
 
 def test_motion_correction_is_accurate():
     test_scan = np.double(np.arange(36).reshape([6, 6]))
-    result = galvo_corrections.correct_motion(test_scan, xy_motion=np.array([0.1, -0.1]))
+    result = galvo_corrections.correct_motion(test_scan, x_shifts=np.array([0.1]),
+                                              y_shifts=np.array([-0.1]))
     desired_result = [[6.5, 7.5, 8.5, 9.5], [12.5, 13.5, 14.5, 15.5],
                       [18.5, 19.5, 20.5, 21.5], [24.5, 25.5, 26.5, 27.5]]
 
@@ -28,8 +58,8 @@ def test_motion_correction_is_accurate():
 
 def test_motion_correction_with_ndimensional_input():
     test_scan = np.double(np.arange(128).reshape([4, 4, 2, 2, 2]))
-    xy_motion = np.reshape(np.arange(16)/10, [2,1,2,2,2])
-    result = galvo_corrections.correct_motion(test_scan, xy_motion=xy_motion)
+    x_shifts, y_shifts = np.arange(8) / 10, np.arange(8, 16) / 10
+    result = galvo_corrections.correct_motion(test_scan, x_shifts, y_shifts)
     desired_first_image = [[25.6, 33.6, 41.6, 49.6], [57.6, 65.6, 73.6, 81.6],
                            [89.6, 97.6, 105.6, 113.6], [96, 104, 112, 120]]
 
@@ -39,43 +69,97 @@ def test_motion_correction_with_ndimensional_input():
 
 def test_motion_correction_no_motion():
     test_scan = np.double(np.arange(1, 17).reshape([4, 4]))
-    result = galvo_corrections.correct_motion(test_scan, xy_motion=np.array([0, 0]))
+    result = galvo_corrections.correct_motion(test_scan, x_shifts=np.array([0]),
+                                              y_shifts=np.array([0]))
     assert_allclose(result, np.arange(1, 17).reshape([4, 4]),
-                    err_msg='Motion correction with zero xy_motion changes the result')
+                    err_msg='Motion correction with zero shifts changes the result')
 
 def test_motion_correction_list_input():
     test_scan = np.double(np.arange(36).reshape([6, 6]))
-    result = galvo_corrections.correct_motion(test_scan, [0.1, -0.1])
+    result = galvo_corrections.correct_motion(test_scan, [0.1], [-0.1])
     desired_result = [[6.5, 7.5, 8.5, 9.5], [12.5, 13.5, 14.5, 15.5],
                       [18.5, 19.5, 20.5, 21.5], [24.5, 25.5, 26.5, 27.5]]
 
     assert_allclose(result[1:-1, 1:-1], desired_result,
-                    err_msg='Motion correction can not handle xy_motion as a list.')
+                    err_msg='Motion correction can not handle shifts as a list.')
 
-def test_motion_correction_nan_xy_motion():
+def test_motion_correction_nan_shifts():
     test_scan = np.double(np.arange(16).reshape([4, 4]))
-    result = galvo_corrections.correct_motion(test_scan,
-                                              xy_motion=np.array([np.nan, 0.1]))
+    result = galvo_corrections.correct_motion(test_scan, x_shifts=np.array([np.nan]),
+                                              y_shifts=np.array([0.1]))
     assert_allclose(result, np.arange(16).reshape([4, 4]),
-                    err_msg='Motion correction cannot handle nan in xy_motion')
+                    err_msg='Motion correction cannot handle nan in shifts')
 
 def test_motion_correction_not_in_place():
     test_scan = np.double(np.arange(16).reshape([4, 4]))
-    result = galvo_corrections.correct_motion(test_scan, xy_motion=[0.1, -0.1],
+    result = galvo_corrections.correct_motion(test_scan, x_shifts=[0.1], y_shifts=[-0.1],
                                               in_place=False)
     assert_allclose(test_scan, np.arange(16).reshape([4, 4]),
                     err_msg='Motion correction is not creating a copy of the scan when '
                             'asked to (in_place=False)')
 
+def test_motion_correction_fourier(random_state):
+    test_scan = random_state.rand(8, 8, 2)
+    result = galvo_corrections.correct_motion(test_scan, x_shifts=[2, 0.5],
+                                              y_shifts=[-3, 0], method='fourier',
+                                              in_place=False)
+    desired_first_image = np.roll(test_scan[:, :, 0], (3, -2), axis=(0, 1))
+
+    assert_allclose(result[:, :, 0], desired_first_image,
+                    err_msg='Fourier motion correction with integer shifts is not exact')
+    assert_allclose(result[:, :, 1].mean(), test_scan[:, :, 1].mean(),
+                    err_msg='Fourier motion correction is not preserving the mean')
+
+def test_motion_shifts_integer_shifts(random_state):
+    template = random_state.rand(128, 128)
+    test_scan = np.stack([np.roll(template, shifts, axis=(0, 1)) for shifts in
+                          [(0, 0), (2, -3), (-4, 1)]], axis=-1)
+    y_shifts, x_shifts = galvo_corrections.compute_motion_shifts(test_scan, template)
+
+    assert_allclose(y_shifts, [0, 2, -4], atol=0.1,
+                    err_msg='Motion shifts in y are not accurate')
+    assert_allclose(x_shifts, [0, -3, 1], atol=0.1,
+                    err_msg='Motion shifts in x are not accurate')
+
+def test_motion_shifts_in_blocks(random_state):
+    template = random_state.rand(512, 512)
+    shifts = random_state.randint(-5, 6, size=(2, 18)) # blocks of 16 frames
+    test_scan = np.stack([np.roll(template, s, axis=(0, 1)) for s in zip(*shifts)],
+                         axis=-1)
+    y_shifts, x_shifts = galvo_corrections.compute_motion_shifts(test_scan, template)
+
+    assert_allclose([y_shifts, x_shifts], shifts, atol=0.1,
+                    err_msg='Motion shifts in the last (padded) block are not accurate')
+    assert len(galvo_corrections._fft_plans) <= galvo_corrections.MAX_FFT_PLANS
+
+
+def test_motion_shifts_pyramid_matches_full_resolution(random_state):
+    image = ndimage.gaussian_filter(random_state.rand(300, 300), 1)
+    y_shifts, x_shifts = random_state.uniform(-10, 10, (2, 10))
+    test_scan = np.stack([ndimage.shift(image, shifts)[22:-22, 22:-22] for shifts in
+                          zip(y_shifts, x_shifts)], axis=-1)
+    test_scan += random_state.normal(scale=image.std() / 2, size=test_scan.shape)
+    template = image[22:-22, 22:-22]
+
+    desired = galvo_corrections.compute_motion_shifts(test_scan, template)
+    result = galvo_corrections.compute_motion_shifts_pyramid(test_scan, template, 20, 20)
+
+    assert_allclose(result, desired, atol=0.3, err_msg='Coarse-to-fine motion shifts '
+                                                       'differ from full resolution ones')
+    assert_allclose(result, [y_shifts, x_shifts], atol=0.3,
+                    err_msg='Coarse-to-fine motion shifts are not accurate')
+
+
 
 ##### Raster correction
 
 def test_raster_correction_is_accurate():
     test_scan = np.double(np.arange(128).reshape([4,4,2,2,2]))
-    result = galvo_corrections.correct_raster(test_scan, raster_phase=0.5, fill_fraction=1)
-    # taken from Matlab
-    desired_first_image = [[6.542, 15.917, 22.938, 60],[60, 33.06, 40.083, 49.457],
-                           [70.543, 79.917, 86.938, 60],[60, 97.062, 104.083, 113.457]]
+    result = galvo_corrections.correct_raster(test_scan, raster_phase=0.5,
+                                              temporal_fill_fraction=1)
+    # linear interpolation at the shifted scan angles (zero outside the scan line)
+    desired_first_image = [[6.366, 14.366, 22.366, 0], [0, 33.634, 41.634, 49.634],
+                           [70.366, 78.366, 86.366, 0], [0, 97.634, 105.634, 113.634]]
 
     assert_allclose(result[:,:,0,0,0], desired_first_image, rtol=0.01,
                     err_msg='Raster correction is not accurate enough')
@@ -83,24 +167,28 @@ def test_raster_correction_is_accurate():
 def test_raster_correction_type():
     # Double to double
     test_scan = np.double(np.arange(128).reshape([4, 4, 2, 2, 2]))
-    result = galvo_corrections.correct_raster(test_scan, raster_phase=0.5, fill_fraction=1)
+    result = galvo_corrections.correct_raster(test_scan, raster_phase=0.5,
+                                              temporal_fill_fraction=1)
     assert (result.dtype == np.double), 'Raster correction is changing the scan dtype'
 
-    #int to double
+    #int to float
     test_scan = np.arange(128).reshape([4, 4, 2, 2, 2])
-    result = galvo_corrections.correct_raster(test_scan, raster_phase=0.5, fill_fraction=1)
-    assert (result.dtype == np.double), 'Raster correction is not changing the scan ' \
-                                        'dtype from int64 to double'
+    result = galvo_corrections.correct_raster(test_scan, raster_phase=0.5,
+                                              temporal_fill_fraction=1)
+    assert (result.dtype == np.float32), 'Raster correction is not changing the scan ' \
+                                         'dtype from int64 to float32'
 
 def test_raster_correction_with_smaller_input():
     test_scan = np.double(np.arange(32).reshape([4, 4, 2]))
-    result = galvo_corrections.correct_raster(test_scan, raster_phase=0.5, fill_fraction=1)
+    result = galvo_corrections.correct_raster(test_scan, raster_phase=0.5,
+                                              temporal_fill_fraction=1)
     assert (result.ndim == 3), 'Dimensions of result do not match those of the scan in ' \
                                'raster correction'
 
 def test_raster_correction_with_zero_raster_phase():
     test_scan = np.double(np.arange(128).reshape([4, 4, 2, 2, 2]))
-    result = galvo_corrections.correct_raster(test_scan, raster_phase=0, fill_fraction=1)
+    result = galvo_corrections.correct_raster(test_scan, raster_phase=0,
+                                              temporal_fill_fraction=1)
     desired_first_image = [[0, 8, 16, 24], [32, 40, 48, 56], [64, 72, 80, 88],
                            [96, 104, 112, 120]]
 
@@ -109,18 +197,776 @@ def test_raster_correction_with_zero_raster_phase():
 
 def test_raster_correction_nonsquare_images():
     test_scan = np.double(np.arange(24).reshape([3, 4, 2]))
-    result = galvo_corrections.correct_raster(test_scan, raster_phase=0.5, fill_fraction=1)
+    result = galvo_corrections.correct_raster(test_scan, raster_phase=0.5,
+                                              temporal_fill_fraction=1)
     assert (result.shape == (3,4,2)), 'Shape of result is different from shape of scan ' \
                                       'in raster correction'
 
 def test_raster_correction_not_in_place():
     test_scan = np.double(np.arange(128).reshape([4, 4, 2, 2, 2]))
-    result = galvo_corrections.correct_raster(test_scan, raster_phase=0.5, fill_fraction=1,
+    result = galvo_corrections.correct_raster(test_scan, raster_phase=0.5,
+                                              temporal_fill_fraction=1,
                                               in_place=False)
     assert_allclose(test_scan, np.arange(128).reshape([4, 4, 2, 2, 2]),
                     err_msg='Raster correction is not creating a copy of the scan when '
                             'asked to (in_place=False)')
 
+def test_raster_correction_matches_interp1d(random_state):
+    test_scan = random_state.rand(8, 10, 5) * 100
+    result = galvo_corrections.correct_raster(test_scan, raster_phase=0.05,
+                                              temporal_fill_fraction=0.7, in_place=False)
+
+    # Correct each image with interp1d (as it was done before vectorizing it)
+    max_angle = (np.pi / 2) * 0.7
+    scan_angles = np.linspace(-max_angle, max_angle, 10 + 2)[1:-1]
+    desired_result = test_scan.copy()
+    for i in range(5):
+        for rows, phase in [(slice(0, None, 2), 0.05), (slice(1, None, 2), -0.05)]:
+            interp_function = interpolate.interp1d(scan_angles, test_scan[rows, :, i],
+                                                   bounds_error=False, fill_value=0)
+            desired_result[rows, :, i] = interp_function(scan_angles + phase)
+
+    assert_allclose(result, desired_result, err_msg='Raster correction does not match '
+                                                    'interpolation with interp1d')
+
+def test_raster_phase_pyramid_matches_full_resolution(random_state):
+    image = ndimage.gaussian_filter(random_state.rand(256, 256), 1)
+    for raster_phase in [-0.02, 0, 0.0123]:
+        test_image = galvo_corrections.correct_raster(image, -raster_phase, 0.7,
+                                                      in_place=False)
+        desired = galvo_corrections.compute_raster_phase(test_image, 0.7)
+        result = galvo_corrections.compute_raster_phase_pyramid(test_image, 0.7)
+
+        assert_allclose(result, desired, atol=1e-4,
+                        err_msg='Coarse-to-fine raster phase differs from full resolution')
+        assert_allclose(result, raster_phase, atol=2e-3,
+                        err_msg='Coarse-to-fine raster phase is not accurate')
+
+
+##### Online correction
+
+def test_online_correction_follows_tiff_files(random_state, tmp_path):
+    tifffile = pytest.importorskip('tifffile')
+
+    # Create scan with two channels (cells that move now and then in the second one)
+    image = np.zeros((64, 64))
+    image[random_state.randint(0, 64, 40), random_state.randint(0, 64, 40)] = 1
+    image = ndimage.gaussian_filter(image, 1.5) * 5000 + 5
+    y_shifts, x_shifts = (random_state.randint(-3, 4, (2, 60)) *
+                          (random_state.rand(2, 60) < 0.3))
+    frames = np.stack([random_state.poisson(np.roll(image, shifts, axis=(0, 1))) for
+                       shifts in zip(y_shifts, x_shifts)], axis=-1).astype(np.int16)
+    pages = [page for i in range(60) for page in [np.zeros((64, 64), dtype=np.int16),
+                                                  frames[:, :, i]]]
+
+    # Write it page by page (in two files) while it is being read
+    directory = str(tmp_path)
+    def acquire():
+        for i, file_pages in enumerate([pages[:70], pages[70:]]):
+            filename = os.path.join(directory, 'scan_{:05d}.tif'.format(i + 1))
+            with tifffile.TiffWriter(filename) as tif:
+                for page in file_pages:
+                    tif.write(page)
+                    time.sleep(0.002)
+    writer = threading.Thread(target=acquire)
+    writer.start()
+
+    tail = online.TiffTail(os.path.join(directory, 'scan*.tif'), num_channels=2,
+                           channel=1)
+    corrector = online.OnlineMotionCorrection(fill_fraction=0.7, is_bidirectional=False,
+                                              num_template_frames=20)
+    read_frames = []
+    for chunk in tail.follow(chunk_size=10, poll_interval=0.02, timeout=0.5):
+        read_frames.append(chunk)
+        corrector.update(chunk)
+    results = corrector.finish()
+    writer.join()
+
+    assert_allclose(np.concatenate(read_frames, axis=-1), frames,
+                    err_msg='Frames read during acquisition are not the scan frames')
+    y_errors = results['y_shifts'] - np.median(results['y_shifts']) - y_shifts
+    x_errors = results['x_shifts'] - np.median(results['x_shifts']) - x_shifts
+    assert np.mean(np.abs(y_errors)) < 0.4, 'Online motion shifts in y are not accurate'
+    assert np.mean(np.abs(x_errors)) < 0.4, 'Online motion shifts in x are not accurate'
+
+
+##### Sample cache
+
+def test_center_frames_are_read_once(random_state, tmp_path, monkeypatch):
+    pytest.importorskip('datajoint') # for key_hash
+    monkeypatch.setitem(config, 'cache.samples_dir', str(tmp_path))
+    monkeypatch.setitem(config, 'cache.samples_size_in_GB', 10000 / 1024**3)
+    scan = FieldScan(random_state.randint(0, 100, (8, 8, 100)).astype(np.int16))
+    key = {'animal_id': 1, 'session': 1, 'scan_idx': 1}
+
+    assert_allclose(caching.center_frames(key, scan, 0, 0, 40), scan.field[..., 30:70])
+    assert scan.frames_read == 40, 'Frames not requested were read'
+    assert_allclose(caching.center_frames(key, scan, 0, 0, 20), scan.field[..., 40:60])
+    assert scan.frames_read == 40, 'Cached frames were read again'
+    assert_allclose(caching.center_frames(key, scan, 0, 0, 60), scan.field[..., 20:80])
+    assert_allclose(caching.center_frames(key, scan, 0, 0, 40), scan.field[..., 30:70])
+    assert scan.frames_read == 100
+
+    # A sample of another scan (7680 bytes) evicts this one (cache fits 10000 bytes)
+    caching.center_frames({**key, 'scan_idx': 2}, scan, 0, 0, 60)
+    assert len(os.listdir(str(tmp_path))) == 1, 'Least recently used sample was kept'
+
+
+##### Demultiplexing
+
+def test_demultiplex_multiroi_tiff_files(random_state, tmp_path):
+    tifffile = pytest.importorskip('tifffile')
+
+    # Two slices (plus a fly back frame): two ROIs in the first slice and one field made
+    # of two side by side ROIs in the second
+    fields = [SimpleNamespace(slice_id=0, height=8, width=10, yslices=[slice(0, 8)],
+                              xslices=[slice(0, 10)], output_yslices=[slice(0, 8)],
+                              output_xslices=[slice(0, 10)]),
+              SimpleNamespace(slice_id=0, height=6, width=10, yslices=[slice(12, 18)],
+                              xslices=[slice(0, 10)], output_yslices=[slice(0, 6)],
+                              output_xslices=[slice(0, 10)]),
+              SimpleNamespace(slice_id=1, height=6, width=20,
+                              yslices=[slice(0, 6), slice(10, 16)],
+                              xslices=[slice(0, 10), slice(0, 10)],
+                              output_yslices=[slice(0, 6), slice(0, 6)],
+                              output_xslices=[slice(0, 10), slice(10, 20)])]
+    num_frames, num_channels, num_slices = 5, 2, 2
+    pages = random_state.randint(0, 1000, (num_frames, num_slices + 1, num_channels, 18, 10))
+    pages = pages.astype(np.int16)
+
+    # Write pages (in two files)
+    directory = str(tmp_path)
+    pages_ = list(pages.reshape(-1, 18, 10))
+    filenames = [os.path.join(directory, 'scan_00001.tif'),
+                 os.path.join(directory, 'scan_00002.tif')]
+    for filename, file_pages in zip(filenames, [pages_[:13], pages_[13:]]):
+        with tifffile.TiffWriter(filename) as tif:
+            for page in file_pages:
+                tif.write(page)
+
+    demux_dir = os.path.join(directory, 'demux')
+    demux.demultiplex(filenames, fields, num_frames, num_channels, num_slices,
+                      num_flyback_frames=1, directory=demux_dir)
+    scan = demux.DemuxedScan(demux_dir, dtype=np.float32)
+
+    assert scan.num_fields == 3 and scan.num_frames == num_frames
+    for channel in range(num_channels):
+        expected = [pages[:, 0, channel, :8], pages[:, 0, channel, 12:],
+                    np.concatenate([pages[:, 1, channel, :6],
+                                    pages[:, 1, channel, 10:16]], axis=-1)]
+        for field_id, field in enumerate(expected):
+            field = np.moveaxis(field, 0, -1)
+            assert_allclose(scan[field_id, :, :, channel, :], field,
+                            err_msg='Demultiplexed field is not the scan field')
+            assert scan[field_id, :, :, channel, :].dtype == np.float32
+            assert_allclose(scan[field_id, 1:-1, 2:, channel, 3], field[1:-1, 2:, 3])
+
+
+def test_demultiplex_fails_without_pages(tmp_path):
+    pytest.importorskip('tifffile')
+    field = SimpleNamespace(slice_id=0, height=4, width=4, yslices=[slice(0, 4)],
+                            xslices=[slice(0, 4)], output_yslices=[slice(0, 4)],
+                            output_xslices=[slice(0, 4)])
+    with pytest.raises(PipelineException):
+        demux.demultiplex([], [field], 0, 1, 1, directory=str(tmp_path / 'demux'))
+
+def test_demultiplexed_is_created_again_if_files_change(random_state, tmp_path,
+                                                        monkeypatch):
+    tifffile = pytest.importorskip('tifffile')
+    pytest.importorskip('datajoint')
+    monkeypatch.setitem(config, 'cache.demux_dir', str(tmp_path / 'demux'))
+    key = {'animal_id': 1, 'session': 1, 'scan_idx': 1}
+    filename = str(tmp_path / 'scan_00001.tif')
+    field = SimpleNamespace(slice_id=0, height=4, width=6, yslices=[slice(0, 4)],
+                            xslices=[slice(0, 6)], output_yslices=[slice(0, 4)],
+                            output_xslices=[slice(0, 6)])
+    scan = SimpleNamespace(filenames=[filename], fields=[field], num_frames=3,
+                           num_channels=1, num_scanning_depths=1,
+                           _num_fly_back_frames=0, _num_averaged_frames=1,
+                           dtype=np.int16)
+
+    for i in range(2):
+        pages = random_state.randint(0, 1000, (3, 4, 6)).astype(np.int16)
+        with tifffile.TiffWriter(filename) as tif:
+            for page in pages:
+                tif.write(page)
+        os.utime(filename, (i, i)) # mtime changes even if written within the same tick
+        demuxed_scan = demux.demultiplexed(key, scan)
+        assert_allclose(demuxed_scan[0, :, :, 0, :], np.moveaxis(pages, 0, -1),
+                        err_msg='Demultiplexed scan does not match the files')
+    assert len(glob.glob(str(tmp_path / 'demux' / '*' / 'metadata.json'))) == 2
+
+    scan._num_averaged_frames = 2 # not supported: pages are not one per frame
+    assert demux.demultiplexed(key, scan) is scan
+
+
+##### Scan index
+
+class PageScan: # scanreader-like reading of (num_frames x num_fields x num_channels) pages
+    def __init__(self, pages):
+        self.pages = pages
+        self.num_frames, self.num_fields, self.num_channels = pages.shape[:3]
+    def __getitem__(self, key):
+        field = np.moveaxis(self.pages[:, key[0], key[3]], 0, -1)
+        return field[key[1], key[2], key[4]]
+
+def write_scan(directory, pages, num_files=2):
+    """ Writes pages (num_frames x num_pages_per_frame x height x width) in tiff files."""
+    tifffile = pytest.importorskip('tifffile')
+    pages_ = np.array_split(pages.reshape(-1, *pages.shape[-2:]), num_files)
+    filenames = [os.path.join(str(directory), 'scan_{:05d}.tif'.format(i + 1)) for i in
+                 range(num_files)]
+    for filename, file_pages in zip(filenames, pages_):
+        with tifffile.TiffWriter(filename) as tif:
+            for page in file_pages:
+                tif.write(page)
+    return filenames
+
+def test_indexed_scan_reads_pages_at_offsets(random_state, tmp_path):
+    # Two fields and two channels (plus a fly back frame) written in two files
+    num_frames, num_channels, num_fields = 6, 2, 2
+    pages = random_state.randint(-500, 500, (num_frames, num_fields + 1, num_channels, 12,
+                                             16)).astype(np.int16)
+    filenames = write_scan(tmp_path, pages)
+
+    header = {'is_multiROI': False, 'num_frames': num_frames,
+              'num_channels': num_channels, 'num_scanning_depths': num_fields,
+              '_num_fly_back_frames': 1, 'field_heights': [12, 12],
+              'field_widths': [16, 16]}
+    scan = scan_index.IndexedScan(filenames, np.float32, header,
+                                  scan_index.index_pages(filenames))
+
+    field = np.moveaxis(pages[:, 1, 1], 0, -1)
+    assert_allclose(scan[1, :, :, 1, :], field,
+                    err_msg='Pages read from their offsets are not the scan pages')
+    assert scan[1, :, :, 1, :].dtype == np.float32
+    assert_allclose(scan[1, 2:-2, ::3, 1, 4], field[2:-2, ::3, 4])
+    assert_allclose(scan[0, :, :, 0, [5, 1]], np.moveaxis(pages[[5, 1], 0, 0], 0, -1))
+
+def test_indexed_scan_is_validated_on_every_field_and_channel(random_state, tmp_path):
+    # Reso scan: three fields and two channels, no fly back frames
+    num_frames, num_channels, num_fields = 5, 2, 3
+    pages = random_state.randint(-500, 500, (num_frames, num_fields, num_channels, 10,
+                                             8)).astype(np.int16)
+    filenames = write_scan(tmp_path, pages, num_files=3)
+    header = {'is_multiROI': False, 'num_frames': num_frames,
+              'num_channels': num_channels, 'num_scanning_depths': num_fields,
+              '_num_fly_back_frames': 0, 'field_heights': [10] * 3,
+              'field_widths': [8] * 3}
+    scan = scan_index.IndexedScan(filenames, np.int16, header,
+                                  scan_index.index_pages(filenames))
+
+    assert scan_index._is_valid(scan, PageScan(pages))
+    for field_id in range(num_fields):
+        assert_allclose(scan[field_id, :, :, 1, :], np.moveaxis(pages[:, field_id, 1], 0, -1))
+
+    # Layout differs only in the last page (e.g., a missing page at the end of the scan)
+    other_pages = pages.copy()
+    other_pages[-1, -1, -1] += 1
+    assert not scan_index._is_valid(scan, PageScan(other_pages)), 'Wrong layout passed'
+
+
+##### Archive
+
+def test_archived_scan_matches_scan(random_state, tmp_path):
+    pytest.importorskip('h5py')
+
+    class Scan: # scanreader-like scan with two fields and two channels
+        def __init__(self, data):
+            self.data = data # num_fields x height x width x num_channels x num_frames
+            self.num_fields, height, width, self.num_channels, _ = data.shape
+            self.num_frames = data.shape[-1]
+            self.field_heights, self.field_widths = [height] * 2, [width] * 2
+            self.fps = 15.0
+            self.dtype = data.dtype
+        def __getitem__(self, key):
+            return self.data[key]
+
+    # Smooth images with Poisson noise (like a real scan)
+    images = ndimage.gaussian_filter(random_state.rand(2, 40, 50, 2, 1), (0, 2, 2, 0, 0))
+    data = random_state.poisson(images * 50 + np.arange(150) * 0.1).astype(np.int16)
+    scan = Scan(data)
+
+    filename = str(tmp_path / 'scan.h5')
+    archive.archive_scan(scan, filename, chunk_frames=16, tile_size=32)
+    archived = archive.ArchivedScan(filename, dtype=np.float32)
+
+    assert archived.num_frames == 150 and archived.fps == 15.0
+    assert os.path.getsize(filename) < data.nbytes / 2, 'Archive is not compressed'
+    for key in [(1, slice(None), slice(None), 0, slice(None)),
+                (0, slice(5, 30), slice(10, None, 2), 1, slice(20, 100)),
+                (1, slice(None), 3, 1, 7), (0, slice(None), slice(None), 1, [40, 3, 3]),
+                (1, [0, 5], slice(None), 0, slice(None, None, -10))]:
+        field_id, y, x, channel, frames = key
+        expected = data[field_id, :, :, channel][y, x][..., frames]
+        assert archived[key].dtype == np.float32
+        assert_allclose(archived[key], expected,
+                        err_msg='Archived scan differs for {}'.format(key))
+
+
+##### Staging
+
+def test_staging_copies_scan_once(tmp_path, monkeypatch):
+    # Two scans of 1 MB
+    directory = str(tmp_path)
+    for scan_name in ['scan1', 'scan2']:
+        for part in range(2):
+            filename = os.path.join(directory, '{}_{:05d}.tif'.format(scan_name, part))
+            with open(filename, 'wb') as f:
+                f.write(os.urandom(2**19))
+
+    monkeypatch.setitem(config, 'cache.staging_dir', os.path.join(directory, 'staging'))
+    monkeypatch.setitem(config, 'cache.staging_size_in_GB', 1.5 / 1024) # fits one scan
+
+    # Stage the same scan from many jobs at once
+    wildcard = os.path.join(directory, 'scan1*.tif')
+    staged = []
+    threads = [threading.Thread(target=lambda: staged.append(staging.stage(wildcard)))
+               for i in range(4)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    assert len(set(staged)) == 1 and staged[0] != wildcard
+    for original, copy in zip(sorted(glob.glob(wildcard)), sorted(glob.glob(staged[0]))):
+        with open(original, 'rb') as f1, open(copy, 'rb') as f2:
+            assert f1.read() == f2.read(), 'Staged file differs from the original'
+    stats = staging.get_stats()
+    assert (stats['misses'], stats['hits'], stats['bytes_copied']) == (1, 3, 2**20)
+
+    # Staging another scan evicts the first one
+    staging.stage(os.path.join(directory, 'scan2*.tif'))
+    assert not glob.glob(staged[0]), 'Least recently used scan was not evicted'
+    assert staging.get_stats()['evictions'] == 1
+
+
+##### Summary images
+
+def test_correlation_image_matches_pairwise_correlations(random_state):
+    scan = random_state.rand(7, 9, 60) + np.linspace(0, 1, 60)
+    expected = np.zeros((7, 9))
+    for y in range(7):
+        for x in range(9):
+            neighbors = [(y + dy, x + dx) for dy in [-1, 0, 1] for dx in [-1, 0, 1]
+                         if (dy or dx) and 0 <= y + dy < 7 and 0 <= x + dx < 9]
+            expected[y, x] = np.mean([np.corrcoef(scan[y, x], scan[n])[0, 1] for n in
+                                      neighbors])
+
+    assert_allclose(enhancement.create_correlation_image(scan, chunk_size=25),
+                    expected, rtol=1e-10) # accumulated in float64
+
+
+def test_summary_statistics_merge_matches_single_pass(random_state):
+    field = (random_state.rand(10, 12, 80) * 100).astype(np.float32)
+    expected = {'mean': field.mean(axis=-1), 'max': field.max(axis=-1),
+                'std': field.std(axis=-1), 'skewness': stats.skew(field, axis=-1)}
+    noise = np.sqrt(np.mean(np.diff(field, axis=-1) ** 2, axis=-1) / 2)
+    expected['pnr'] = (expected['max'] - expected['mean']) / noise
+    for name, statistic_class in performance.SUMMARY_STATISTICS.items():
+        single_pass = statistic_class(10, 12).update(field)
+        parts = [statistic_class(10, 12).update(field[..., s]) for s in
+                 [slice(50, 80), slice(0, 20), slice(20, 50)]]
+        merged = parts[0].merge(parts[1]).merge(parts[2])
+
+        assert merged.num_frames == 80
+        if name not in ['l6norm', 'pnr']: # depend on the chunks
+            assert_allclose(merged.image(), single_pass.image(), rtol=1e-5, atol=1e-6,
+                            err_msg='Merged {} does not match'.format(name))
+        if name in expected:
+            assert_allclose(single_pass.image(), expected[name], rtol=1e-4, atol=1e-6,
+                            err_msg='{} image is wrong'.format(name))
+
+
+##### Proxy movie
+
+class LockedOutputs(dict): # as SharedOutputs (with a lock)
+    lock = threading.Lock()
+
+def test_proxy_movie_matches_binned_field(random_state):
+    field = random_state.rand(18, 25, 47).astype(np.float32)
+    num_frames, bin_size, factor = field.shape[-1], 5, 4
+    num_proxy_frames = int(np.ceil(num_frames / bin_size))
+    specs = performance.summary_outputs(18, 25, num_proxy_frames, factor)
+    outputs = LockedOutputs({name: np.zeros(shape) for name, (shape, _) in specs.items()})
+
+    chunks = queue.Queue()
+    for start in range(0, num_frames, 13): # chunks not aligned with the bins
+        frames = slice(start, min(start + 13, num_frames))
+        chunks.put((frames, field[..., frames].copy()))
+    chunks.put((None, None))
+    performance.parallel_summary_images(chunks, [], 0, 0.7, np.zeros(num_frames),
+                                        np.zeros(num_frames), outputs=outputs,
+                                        proxy_bin_size=bin_size, proxy_factor=factor)
+    proxy_movie = performance.reduce_proxy_movie(outputs['proxy'], num_frames, bin_size)
+
+    blocks = field[:16, :24].reshape(4, 4, 6, 4, num_frames).mean(axis=(1, 3))
+    expected = np.stack([blocks[..., i: i + bin_size].mean(axis=-1) for i in
+                         range(0, num_frames, bin_size)], axis=-1)
+    assert proxy_movie.shape == (4, 6, num_proxy_frames)
+    assert_allclose(proxy_movie, expected, atol=1e-5)
+
+
+##### Corrected scan
+
+@pytest.mark.parametrize('parallel', [False, True])
+def test_corrected_scan_matches_corrected_field(random_state, parallel):
+    field = random_state.rand(20, 24, 55).astype(np.float32)
+    original_field = field.copy()
+    raster_phase, fill_fraction = 0.005, 0.7
+    y_shifts, x_shifts = random_state.rand(2, 55) * 4 - 2
+    expected = galvo_corrections.correct_raster(field.copy(), raster_phase, fill_fraction)
+    expected = galvo_corrections.correct_motion(expected, x_shifts, y_shifts)
+
+    scan = caching.CorrectedScan(FieldScan(field), 0, 0, raster_phase, fill_fraction,
+                                 y_shifts, x_shifts, chunk_size=10, cache_size=2,
+                                 parallel=parallel)
+    assert scan.shape == expected.shape
+    assert_allclose(np.asarray(scan), expected, atol=1e-5)
+    for key in [(Ellipsis, slice(5, 33)), (slice(2, -3), 4, slice(None, None, -7)),
+                (slice(None), slice(None), 17), (Ellipsis, [3, 40, 41, 2])]:
+        assert_allclose(scan[key], expected[key], atol=1e-5,
+                        err_msg='Corrected scan does not match for {}'.format(key))
+    assert_allclose(scan[0, slice(1, 5), slice(None), 0, slice(30, 50)],
+                    expected[1:5, :, 30:50], atol=1e-5) # as in map_frames
+    assert_allclose(field, original_field, err_msg='Original field was modified')
+    assert abs(scan.min() - expected.min()) < 1e-5
+    assert abs(scan.max() - expected.max()) < 1e-5
+
+
+##### Autotuning
+
+def write_cgroup_files(directory, files):
+    for filename, contents in files.items():
+        path = directory / filename
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(contents + '\n')
+
+@pytest.mark.parametrize('files, expected', [
+    ({}, 8),
+    ({'cpu.max': '150000 100000'}, 2), # cgroup v2
+    ({'cpu.max': 'max 100000'}, 8),
+    ({'cpu/cpu.cfs_quota_us': '250000', 'cpu/cpu.cfs_period_us': '100000'}, 3), # v1
+    ({'cpu/cpu.cfs_quota_us': '-1', 'cpu/cpu.cfs_period_us': '100000'}, 8),
+    ({'cpu.max': '20000 100000'}, 1), # at least one CPU
+])
+def test_cpu_limit_reads_cgroup_quota(tmp_path, monkeypatch, files, expected):
+    write_cgroup_files(tmp_path, files)
+    monkeypatch.setattr(performance, 'CGROUP_DIR', str(tmp_path))
+    monkeypatch.setattr(os, 'sched_getaffinity', lambda pid: set(range(8)),
+                        raising=False)
+    assert performance.get_cpu_limit() == expected
+
+@pytest.mark.parametrize('files, limited', [
+    ({}, False),
+    ({'memory.max': str(2**30)}, True), # cgroup v2
+    ({'memory.max': 'max'}, False),
+    ({'memory/memory.limit_in_bytes': str(2**30)}, True), # v1
+    ({'memory/memory.limit_in_bytes': str(2**63 - 4096)}, False), # v1 without limit
+])
+def test_memory_limit_reads_cgroup_limit(tmp_path, monkeypatch, files, limited):
+    write_cgroup_files(tmp_path, files)
+    monkeypatch.setattr(performance, 'CGROUP_DIR', str(tmp_path))
+    physical_memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    expected = min(2**30, physical_memory) if limited else physical_memory
+    assert performance.get_memory_limit() == expected
+
+def test_autotune_fits_in_memory_budget(monkeypatch):
+    monkeypatch.setitem(config, 'performance.memory_budget_in_GB', 4)
+    monkeypatch.setattr(performance, 'get_cpu_limit', lambda: 5)
+    chunk_size_in_GB, num_processes, queue_size = performance.autotune(2**20, 10000)
+    assert (num_processes, queue_size) == (4, 4) # one CPU left for the producer
+    assert_allclose(chunk_size_in_GB, 4 / (4 + performance.WORKER_MEMORY_FACTOR * 4))
+
+    # Chunks of at least ~100 frames: less processes
+    monkeypatch.setitem(config, 'performance.memory_budget_in_GB', 1)
+    chunk_size_in_GB, num_processes, queue_size = performance.autotune(2**20, 10000)
+    assert (num_processes, queue_size) == (2, 2)
+    assert chunk_size_in_GB >= 100 * 2**20 / 1024**3
+    assert ((queue_size + performance.WORKER_MEMORY_FACTOR * num_processes) *
+            chunk_size_in_GB <= 1)
+
+    # Budget too small: one process with (at least) one frame per chunk
+    monkeypatch.setitem(config, 'performance.memory_budget_in_GB', 1e-6)
+    chunk_size_in_GB, num_processes, _ = performance.autotune(2**20, 10000)
+    assert num_processes == 1
+    assert chunk_size_in_GB == 2**20 / 1024**3
+
+def test_autotune_fields_fits_in_memory_budget(monkeypatch):
+    monkeypatch.setitem(config, 'performance.memory_budget_in_GB', 1)
+    monkeypatch.setattr(performance, 'get_cpu_limit', lambda: 5)
+    assert performance.autotune_fields(0.05 * 1024**3, 10) == (4, 4)
+    assert performance.autotune_fields(0.1 * 1024**3, 10) == (2, 2)
+    assert performance.autotune_fields(0.05 * 1024**3, 3) == (3, 3) # one per field
+    assert performance.autotune_fields(10 * 1024**3, 10) == (1, 2)
+
+
+##### Parallel mapping
+
+def failing_worker(chunks, results): # module-level so it can be sent to the pool
+    chunks.get()
+    raise ValueError('Worker failed')
+
+def record_pid(chunks, results):
+    while True:
+        frames, chunk = chunks.get()
+        if chunk is None:
+            return
+        results.append(os.getpid())
+
+def test_map_frames_uses_num_processes_of_the_pool():
+    scan = FieldScan(np.zeros((8, 8, 50), dtype=np.float32))
+    pool = performance.WorkerPool(3)
+    try:
+        pids = performance.map_frames(record_pid, scan, 0, 0, chunk_size_in_GB=1e-6,
+                                      num_processes=2, queue_size=2, pool=pool)
+        assert len(pids) == 13 # 4-frame chunks
+        assert len(set(pids)) <= 2, 'Job ran in more processes than requested'
+        assert pool.is_alive and len(pool.processes) == 3, 'Pool was restarted'
+    finally:
+        pool.close()
+
+def test_map_fields_tunes_num_processes(monkeypatch):
+    monkeypatch.setitem(config, 'performance.memory_budget_in_GB', 1)
+    scan = FieldScan(np.zeros((8, 8, 10), dtype=np.float32))
+    pool = performance.WorkerPool(2)
+    try:
+        pids = performance.map_fields(record_pid, scan, field_ids=[0, 0, 0], channel=0,
+                                      pool=pool)
+        assert len(pids) == 3
+        assert len(set(pids)) <= 2
+    finally:
+        pool.close()
+
+def test_map_frames_logs_stats_per_chunk(tmp_path, monkeypatch):
+    stats_log = tmp_path / 'stats.jsonl'
+    monkeypatch.setitem(config, 'performance.stats_log', str(stats_log))
+    scan = FieldScan(np.zeros((8, 8, 50), dtype=np.float32))
+    performance.map_frames(sum_frames, scan, 0, 0, chunk_size_in_GB=1e-6,
+                           num_processes=2, queue_size=2) # 4-frame chunks
+
+    lines = [json.loads(line) for line in stats_log.read_text().splitlines()]
+    records, summary = lines[:-1], lines[-1]
+    assert sorted(record['frames'][0] for record in records) == list(range(0, 50, 4))
+    for record in records:
+        assert record['job'] == 'map_frames(sum_frames)'
+        assert record['frames'][1] - record['frames'][0] <= 4
+        assert record['bytes'] == (record['frames'][1] - record['frames'][0]) * 8 * 8 * 4
+        assert all(record[name] >= 0 for name in performance.ChunkStats.TIMES)
+        assert record['queue_depth'] >= 0 and isinstance(record['pid'], int)
+    assert summary['summary'] and summary['num_chunks'] == 13
+    assert summary['num_frames'] == 50 and summary['frames_per_s'] > 0
+
+def test_map_frames_fails_when_worker_raises():
+    scan = FieldScan(np.zeros((8, 8, 200), dtype=np.float32))
+    pool = performance.WorkerPool(2)
+    try:
+        with pytest.raises(PipelineException):
+            performance.map_frames(failing_worker, scan, 0, 0, chunk_size_in_GB=1e-6,
+                                   queue_size=2, pool=pool) # 4-frame chunks
+    finally:
+        pool.close(terminate=True)
+
+def test_map_frames_only_waits_for_its_own_job():
+    scan = FieldScan(np.zeros((8, 8, 20), dtype=np.float32))
+    pool = performance.WorkerPool(3)
+    try:
+        # Another job still running and one that failed
+        running_chunks, failed_chunks = pool.manager.Queue(), pool.manager.Queue()
+        running_job = pool.submit(record_pid, running_chunks, [], num_workers=1)
+        failed_job = pool.submit(failing_worker, failed_chunks, [], num_workers=1)
+        failed_chunks.put((slice(0, 1), np.zeros(1)))
+        time.sleep(1) # let it fail
+
+        pids = performance.map_frames(record_pid, scan, 0, 0, chunk_size_in_GB=1e-6,
+                                      num_processes=1, queue_size=2, pool=pool)
+        assert len(pids) == 5 # 4-frame chunks
+
+        running_chunks.put((None, None))
+        pool.wait(running_job)
+        with pytest.raises(PipelineException):
+            pool.wait(failed_job)
+    finally:
+        pool.close(terminate=True)
+
+def sum_frames(chunks, results):
+    while True:
+        frames, chunk = chunks.get()
+        if chunk is None:
+            return
+        results.append((frames, chunk.sum(axis=(0, 1))))
+
+class UnreadableScan(FieldScan): # fails to read frames after the first 8
+    def __getitem__(self, key):
+        if isinstance(key[4], slice) and key[4].start >= 8:
+            raise IOError('Could not read frames {}'.format(key[4]))
+        return super().__getitem__(key)
+
+def test_imap_frames_fails_when_reading_fails():
+    pool = performance.WorkerPool(2)
+    pids = [p.pid for p in pool.processes]
+    try:
+        results = performance.imap_frames(sum_frames,
+                                          UnreadableScan(np.zeros((8, 8, 40))), 0, 0,
+                                          chunk_size_in_GB=1e-6, queue_size=2, pool=pool)
+        with pytest.raises(IOError):
+            list(results)
+
+        assert [p.pid for p in pool.processes] == pids, 'Pool was restarted'
+        scan = FieldScan(np.zeros((8, 8, 20), dtype=np.float32))
+        assert len(performance.map_frames(record_pid, scan, 0, 0, chunk_size_in_GB=1e-6,
+                                          pool=pool)) == 5, 'Pool is not usable'
+    finally:
+        pool.close(terminate=True)
+
+def test_imap_frames_stopped_early_keeps_the_pool():
+    scan = FieldScan(np.zeros((8, 8, 200), dtype=np.float32))
+    pool = performance.WorkerPool(2)
+    pids = [p.pid for p in pool.processes]
+    try:
+        results = performance.imap_frames(sum_frames, scan, 0, 0, chunk_size_in_GB=1e-6,
+                                          queue_size=2, pool=pool) # 4-frame chunks
+        frames, _ = next(results)
+        assert frames == slice(0, 4)
+        results.close()
+
+        assert [p.pid for p in pool.processes] == pids, 'Pool was restarted'
+        assert len(pool._pending) == 0, 'Workers of the stopped job are still running'
+    finally:
+        pool.close(terminate=True)
+
+def test_fuse_frames_matches_separate_maps(random_state):
+    field = random_state.rand(16, 16, 60).astype(np.float32)
+    y_shifts, x_shifts = random_state.rand(2, 60) * 2 - 1
+    corrections = {'raster_phase': 0.005, 'fill_fraction': 0.7, 'y_shifts': y_shifts,
+                   'x_shifts': x_shifts}
+    summary_kwargs = {**corrections, 'proxy_bin_size': 5}
+    summary_outputs = performance.summary_outputs(16, 16, 12)
+    mask_pixels = [np.arange(10, 30), np.arange(100, 140)]
+    trace_kwargs = {**corrections, 'mask_pixels': mask_pixels,
+                    'mask_weights': [np.ones(20), random_state.rand(40)]}
+    trace_outputs = {'traces': ((2, 60), np.float32)}
+    kernels = {'sums': {'f': sum_frames},
+               'summary': {'f': performance.parallel_summary_images,
+                           'kwargs': summary_kwargs, 'outputs': summary_outputs},
+               'traces': {'f': performance.parallel_fluorescence,
+                          'kwargs': trace_kwargs, 'outputs': trace_outputs}}
+    scan = FieldScan(field)
+    fused = performance.fuse_frames(kernels, scan, 0, 0, chunk_size_in_GB=1e-5)
+    single_scan = FieldScan(field)
+    sums = performance.map_frames(sum_frames, single_scan, 0, 0, chunk_size_in_GB=1e-5)
+    assert scan.frames_read == single_scan.frames_read, 'Scan was read more than once'
+    assert_allclose(np.concatenate([s for _, s in sorted(fused['sums'],
+                                                         key=lambda r: r[0].start)]),
+                    np.concatenate([s for _, s in sorted(sums, key=lambda r: r[0].start)]))
+    _, summary = performance.map_frames(performance.parallel_summary_images,
+                                        FieldScan(field), 0, 0, chunk_size_in_GB=1e-5,
+                                        kwargs=summary_kwargs, outputs=summary_outputs)
+    for name, array in summary.items():
+        assert_allclose(fused['summary'][1][name], array, rtol=1e-5, atol=1e-5,
+                        err_msg='Fused {} does not match'.format(name))
+    _, traces = performance.map_frames(performance.parallel_fluorescence,
+                                       FieldScan(field), 0, 0, chunk_size_in_GB=1e-5,
+                                       kwargs=trace_kwargs, outputs=trace_outputs)
+    assert_allclose(fused['traces'][1]['traces'], traces['traces'], rtol=1e-5)
+
+def test_fuse_frames_fails_when_a_kernel_raises():
+    kernels = {'sums': {'f': sum_frames}, 'failing': {'f': failing_worker}}
+    with pytest.raises(PipelineException):
+        performance.fuse_frames(kernels, FieldScan(np.zeros((8, 8, 20))), 0, 0,
+                                chunk_size_in_GB=1e-6)
+
+FAKE_SCANREADER = """ # reads scans saved with np.save
+import numpy as np
+
+class Scan:
+    def __init__(self, field):
+        self.field = field
+    def __getitem__(self, key):
+        return self.field[key[1], key[2], key[4]]
+
+def read_scan(filenames, dtype=np.int16):
+    return Scan(np.load(filenames[0]).astype(dtype))
+"""
+
+@pytest.mark.parametrize('transport', ['shared_memory', 'scanreader'])
+def test_map_frames_transports_match_queue(random_state, tmp_path, monkeypatch,
+                                           transport):
+    if transport == 'shared_memory' and not performance.has_shared_memory():
+        pytest.skip('Shared memory is not available')
+    scan = FieldScan(random_state.rand(8, 8, 50).astype(np.float32))
+    if transport == 'scanreader': # workers read the scan files themselves
+        (tmp_path / 'scanreader.py').write_text(FAKE_SCANREADER)
+        monkeypatch.syspath_prepend(str(tmp_path))
+        monkeypatch.delitem(sys.modules, 'scanreader', raising=False)
+        np.save(str(tmp_path / 'scan.npy'), scan.field)
+        scan.filenames, scan.dtype = [str(tmp_path / 'scan.npy')], np.float32
+    pool = performance.WorkerPool(2) # started after the scanreader above is in the path
+    try:
+        frame_sums = {}
+        for transport_ in ['queue', transport]:
+            results = performance.map_frames(sum_frames, scan, 0, 0, chunk_size_in_GB=1e-6,
+                                             queue_size=2, transport=transport_, pool=pool)
+            results = sorted(results, key=lambda result: result[0].start)
+            frame_sums[transport_] = np.concatenate([sums for _, sums in results])
+    finally:
+        pool.close()
+
+    assert_allclose(frame_sums['queue'], scan.field.sum(axis=(0, 1)), rtol=1e-5)
+    assert np.array_equal(frame_sums[transport], frame_sums['queue']), \
+        'Results with transport={} differ'.format(transport)
+
+def hold_block(chunks): # gets a chunk and exits without giving its block back
+    chunks.get()
+
+def test_shared_memory_queue_reclaims_blocks_of_dead_workers():
+    if not performance.has_shared_memory():
+        pytest.skip('Shared memory is not available')
+    with mp.Manager() as manager:
+        chunks = performance.SharedMemoryQueue(manager, num_blocks=1)
+        try:
+            chunks.put((slice(0, 1), np.ones((4, 4))))
+            worker = mp.Process(target=hold_block, args=(chunks, ))
+            worker.start()
+            worker.join()
+
+            chunks.put((slice(1, 2), np.full((4, 4), 2.0)), timeout=5) # the only block
+            label, chunk = chunks.get()
+            assert label == slice(1, 2) and np.all(chunk == 2)
+            del chunk
+            chunks.release()
+            assert chunks._attached == {}, 'Shared memory blocks were not closed'
+        finally:
+            chunks.close()
+
+
+def test_shared_outputs_fall_back_to_memmaps(monkeypatch):
+    monkeypatch.setattr(performance, 'shared_memory', None) # as in python < 3.8
+    with mp.Manager() as manager:
+        outputs = performance.SharedOutputs(manager, {'traces': ((3, 5), np.float32)})
+        outputs['traces'][:, 2] = 1
+        directory = os.path.dirname(outputs.specs['traces'][2])
+
+        assert isinstance(outputs['traces'], np.memmap)
+        assert_allclose(outputs.copy()['traces'].sum(axis=0), [0, 0, 3, 0, 0])
+        outputs.close()
+        assert not os.path.exists(directory), 'Temporary directory was not deleted'
+
+
+def test_checkpoint_is_discarded_when_inputs_change(tmp_path):
+    directory = str(tmp_path / 'job')
+    fingerprint = performance.input_fingerprint(record_pid, {'template': np.zeros(3)}, 0)
+    checkpoint = performance.ChunkCheckpoint(directory, fingerprint)
+    checkpoint.save_result(slice(0, 4), 0, 'result')
+    checkpoint.mark_finished(slice(0, 4))
+
+    checkpoint = performance.ChunkCheckpoint(directory, fingerprint)
+    assert checkpoint.finished() == [slice(0, 4)]
+    assert checkpoint.load_results(slice(0, 4)) == ['result']
+
+    new_fingerprint = performance.input_fingerprint(record_pid, {'template': np.ones(3)},
+                                                    0)
+    assert new_fingerprint != fingerprint
+    checkpoint = performance.ChunkCheckpoint(directory, new_fingerprint)
+    assert checkpoint.finished() == [], 'Stale checkpoint was not discarded'
+
+
 if __name__ == '__main__':
-    import nose
-    nose.main()
+    pytest.main([__file__])